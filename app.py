@@ -1,139 +1,1052 @@
 import os
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import as_completed
 import google.generativeai as genai
-from flask import Flask, request, jsonify, render_template
+from google.api_core import exceptions as api_exceptions
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, g
 # from config import google_api_key # Import the API key - REMOVED
-import re
-from prompt_utils import format_svg_prompt, format_analysis_prompt # Import the prompt formatting utility and new function
-from typing import Optional, Dict, Any # Import Dict, Any
+from prompt_utils import format_svg_prompt, format_analysis_prompt, format_conversion_prompt, format_refine_prompt # Import the prompt formatting utilities
+from prompt_utils import ANALYSIS_RESPONSE_SCHEMA, PATCH_RESPONSE_SCHEMA, parse_analysis_json, parse_analysis_sections
+from prompt_utils import format_tile_note, merge_tile_sections
+from prompt_utils import PROMPT_TOKEN_BUDGETS, fit_prompt, trim_analysis_data, trim_svg_code, trim_text
+import model_utils # Runs model calls on the shared async loop
+import cache_utils
+import image_utils
+import job_utils
+import metrics_utils
+import raster_utils
+import svg_utils
+from typing import Optional, Dict, Any, List, Callable, Iterator # Import Dict, Any, List
 from dotenv import load_dotenv
-import base64
-from io import BytesIO
-from PIL import Image
+import hashlib
+from metrics_utils import span
 
 # --- Configuration & Model Initialization ---
-# Remove global model initialization - it will be created per request
-# model: Optional[genai.GenerativeModel] = None
-generation_config: Optional[genai.types.GenerationConfig] = None
+# The allowed models (MODEL_CONFIG) with their prebuilt clients and per-model generation defaults
+model_registry: Optional[model_utils.ModelRegistry] = None
 
 load_dotenv()
 
+# Logging: LOG_LEVEL (default INFO). Raw model output and parsed analyses are only logged at the PAYLOAD
+# level, below DEBUG, so they stay out of production logs unless explicitly enabled (LOG_LEVEL=PAYLOAD)
+PAYLOAD = 5
+logging.addLevelName(PAYLOAD, "PAYLOAD")
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 # Configure the Gemini API key from environment variable ONLY
 api_key = os.getenv("GOOGLE_API_KEY")
 if api_key:
     try:
         genai.configure(api_key=api_key)
-        # Set generation config here
-        # Hard-set temperature to 1.0
-        generation_config = genai.types.GenerationConfig(temperature=1.0)
-        print("Gemini API Key configured successfully.")
+        model_registry = model_utils.ModelRegistry(model_utils.MODEL_CONFIG)
+        model_registry.warm()
+        logger.info("Gemini API Key configured successfully. Models: %s", ", ".join(model_registry.names))
     except Exception as e:
-        print(f"Error configuring Google AI SDK: {e}")
-        # Ensure config is None if setup fails
-        generation_config = None
+        logger.error("Error configuring Google AI SDK: %s", e)
+        # Ensure the registry is None if setup fails
+        model_registry = None
         api_key = None # Indicate API is not usable
 else:
-    print("Warning: GOOGLE_API_KEY environment variable not set. AI features will be disabled.")
-    # Ensure config is None if key is missing
-    generation_config = None
+    logger.warning("GOOGLE_API_KEY environment variable not set. AI features will be disabled.")
 
 app = Flask(__name__)
+# Room for the largest image as a base64 data URL plus the other JSON fields
+app.config['MAX_CONTENT_LENGTH'] = image_utils.MAX_UPLOAD_BYTES * 4 // 3 + 1024 * 1024
+
+# Generated SVGs keyed on a hash of (formatted prompt, model, generation config); multi-candidate modes store
+# their whole response under (formatted prompt, mode, candidate models, generation configs)
+svg_cache = cache_utils.ResponseCache("svg")
+generate_flights = cache_utils.SingleFlight()
+# Uploaded images keyed on the SHA-256 of their bytes, and parsed analyses keyed on (image hash, context, model)
+image_cache = cache_utils.ResponseCache("image", max_entries=cache_utils.IMAGE_CACHE_SIZE)
+analysis_cache = cache_utils.ResponseCache("analysis")
+jobs = job_utils.JobStore()
+
+# Per-route latency for /metrics; streamed responses are timed until their last byte is sent
+HTTP_REQUEST_SECONDS = metrics_utils.histogram("http_request_duration_seconds", "HTTP request latency by route.",
+                                               ["route", "method", "status"])
+
+# /generate multi-candidate modes: max parallel candidates and the default best-of-N deadline (seconds)
+GENERATION_MODES = ('single', 'hedged', 'best_of_n')
+GENERATE_MAX_CANDIDATES = int(os.getenv("GENERATE_MAX_CANDIDATES", "5"))
+GENERATE_CANDIDATE_DEADLINE = float(os.getenv("GENERATE_CANDIDATE_DEADLINE", "45"))
+
+# /analyze_image asks for a JSON response matching the section schema unless disabled (per request: `structured`)
+ANALYSIS_STRUCTURED_OUTPUT = os.getenv("ANALYSIS_STRUCTURED_OUTPUT", "1").lower() in ('1', 'true', 'yes')
+ANALYSIS_JSON_CONFIG = {"response_mime_type": "application/json", "response_schema": ANALYSIS_RESPONSE_SCHEMA}
+
+# /analyze_image tiled mode: large or dense images are analysed as overlapping full-resolution tiles plus an
+# overview of the whole image, then merged. ANALYSIS_TILING "auto" (default) tiles the images
+# image_utils.should_tile picks (by default only long screenshots and banners, by aspect ratio; thresholds:
+# ANALYSIS_TILE_* env vars); a flag forces it on or off.
+# Per request: `tiled`. At most ANALYSIS_TILE_CONCURRENCY of a request's calls run at once.
+ANALYSIS_TILING = os.getenv("ANALYSIS_TILING", "auto").lower()
+ANALYSIS_TILE_CONCURRENCY = int(os.getenv("ANALYSIS_TILE_CONCURRENCY", "4"))
+
+# /refine_svg modes: "patch" asks the model for edit operations on the original and applies them here, so output
+# tokens scale with the change rather than the document; "full" regenerates the whole SVG; "auto" (default)
+# patches SVGs of at least REFINE_PATCH_MIN_BYTES. Per request: `mode`. A patch that fails falls back to "full".
+REFINE_MODES = ('auto', 'patch', 'full')
+REFINE_MODE = os.getenv("REFINE_MODE", "auto").lower()
+REFINE_PATCH_MIN_BYTES = int(os.getenv("REFINE_PATCH_MIN_BYTES", "2048"))
+REFINE_PATCH_JSON_CONFIG = {"response_mime_type": "application/json", "response_schema": PATCH_RESPONSE_SCHEMA}
+
+# Request fields that carry image uploads (as data URLs in JSON bodies)
+IMAGE_FIELDS = ('image_data', 'png_data')
+
+# /jobs/<id>/events: longest wait between checks for status changes made by other worker processes (seconds)
+JOB_EVENTS_POLL_INTERVAL = 1.0
+
+# /generate_batch limits: max items per request and max items generating at once per batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
 
 # --- Helper Functions ---
 
-def _clean_svg_response(raw_text: str) -> Optional[str]:
-    """Cleans the raw AI response to extract only the SVG code."""
+def _clean_svg_response(raw_text: str, extractor: Optional[svg_utils.SvgExtractor] = None) -> Optional[str]:
+    """Extracts the outermost <svg> element from the raw AI response, dropping code fences and prose.
+
+    Args:
+        raw_text: The full model output.
+        extractor: An extractor that was already fed the output while it streamed, so it isn't parsed twice.
+    """
     if not raw_text:
         return None
 
-    svg_code = raw_text.strip()
+    with span("svg_extract"):
+        if extractor is None:
+            extractor = svg_utils.SvgExtractor()
+            extractor.feed(raw_text)
+        svg_code, report = extractor.close()
+
+    if svg_code is None:
+        logger.warning("Model output could not be cleaned into valid SVG (%s)", "; ".join(report["errors"]))
+        logger.log(PAYLOAD, "Model output:\n%s", raw_text)
+    elif report["errors"]:
+        # Kept as before: browsers render many of these, but the optimizer will leave them untouched
+        logger.warning("Model SVG is not well-formed XML: %s", "; ".join(report["errors"]))
+    return svg_code
+
+def _optimize_svg(svg_code: str) -> tuple[str, Dict[str, Any]]:
+    """Shrinks a cleaned SVG per SVG_OPTIMIZE ("lossy", "lossless" or "off").
+
+    Returns:
+        The SVG and the extra response fields (`optimization` stats, empty when disabled).
+    """
+    if svg_utils.SVG_OPTIMIZE == 'off':
+        return svg_code, {}
+    with span("svg_optimize"):
+        svg_code, stats = svg_utils.optimize_svg(svg_code, lossless=svg_utils.SVG_OPTIMIZE == 'lossless')
+    return svg_code, {"optimization": stats}
+
+def _resolver(model_name: str, prompt: Any, **config_overrides: Any) -> model_utils.Resolver:
+    """Returns the per-attempt (client, prompt, generation config) lookup for a call to `model_name` or its fallback."""
+    def resolve(name: str) -> tuple[genai.GenerativeModel, Any, Any]:
+        return model_registry.get(name), prompt, model_registry.generation_config(name, **config_overrides)
+    return resolve
+
+def _deadline(*model_names: str) -> Optional[float]:
+    """Returns the request's deadline: now plus the timeouts of the model calls it makes in turn (None if unlimited)."""
+    timeouts = [model_registry.timeout(name) for name in model_names]
+    return None if None in timeouts else time.monotonic() + sum(timeouts)
+
+def _call_model(model_name: str, prompt: Any, deadline: Optional[float] = None,
+                **config_overrides: Any) -> tuple[Any, Dict[str, Any]]:
+    """Calls a model from a request thread with retries, the request deadline and circuit breaking.
+
+    Returns:
+        The SDK response and extra response fields (`fallback_model` when the fallback answered instead).
+    """
+    with span("model_call"):
+        response, served_by = model_utils.resilient_generate(
+            model_name, _resolver(model_name, prompt, **config_overrides),
+            deadline if deadline is not None else _deadline(model_name), model_registry.fallback(model_name)
+        )
+    return response, ({"fallback_model": served_by} if served_by != model_name else {})
+
+def _error_payload(e: Exception, label: str) -> tuple[Dict[str, Any], int]:
+    """Maps a failed model call to a JSON error payload and status; `ModelCallError`s keep their code and status."""
+    if isinstance(e, model_utils.ModelCallError):
+        logger.warning("Model call failed during %s (%s): %s", label, e.code, e)
+        payload = {"error": str(e), "code": e.code}
+        if e.retry_after is not None:
+            payload["retry_after"] = e.retry_after
+        return payload, e.status
+    logger.exception("Error during %s: %s", label, e)
+    return {"error": f"An internal error occurred during {label}."}, 500
+
+def _token_counter(model_name: str):
+    """Returns a callable that counts a prompt's tokens with the given model, for `fit_prompt`."""
+    return lambda contents: model_utils.count_tokens(model_registry.get(model_name), contents,
+                                                     timeout=model_registry.timeout(model_name))
+
+def _model_error(*model_names: Any) -> Optional[tuple[Response, int]]:
+    """Returns a 400 response if a requested model isn't in the allowlist, so nothing else is done for it."""
+    for model_name in model_names:
+        try:
+            model_registry.check(model_name)
+        except model_utils.UnknownModel as e:
+            return jsonify({"error": str(e)}), 400
+    return None
+
+def _usage(response: Any) -> Dict[str, Any]:
+    """Returns the token counts the SDK reported for a call as a `usage` response field (empty if none)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage or not getattr(usage, 'total_token_count', 0):
+        return {}
+    return {"usage": {
+        "prompt_tokens": usage.prompt_token_count,
+        "cached_tokens": getattr(usage, 'cached_content_token_count', 0),
+        "output_tokens": usage.candidates_token_count,
+        "total_tokens": usage.total_token_count,
+    }}
+
+def _prompt_warnings(prompt_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the warnings about inputs trimmed to fit the token budget as a response field (empty if none)."""
+    if prompt_info["warnings"]:
+        logger.info("Prompt trimmed to %d/%d tokens: %s", prompt_info["prompt_tokens"], prompt_info["budget"],
+                    prompt_info["warnings"])
+        return {"prompt_warnings": prompt_info["warnings"]}
+    return {}
+
+def _wants_stream() -> bool:
+    """Checks whether the client asked for a Server-Sent Events response (`?stream=1` or `Accept: text/event-stream`)."""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def _sse_event(event: str, payload: Dict[str, Any]) -> str:
+    """Formats a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def _sse_response(events: Iterator[str]) -> Response:
+    """Wraps a generator of formatted SSE events in an unbuffered event-stream response."""
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def _stream_svg_response(model_name: str, prompt: Any, label: str, cache_key: Optional[str] = None,
+                         metadata: Optional[Dict[str, Any]] = None) -> Response:
+    """Streams model output as SSE `chunk` events, then a terminal `done` (cleaned SVG) or `error` event."""
+    return _sse_response(_svg_events(model_name, prompt, label, cache_key, metadata))
+
+def _svg_events(model_name: str, prompt: Any, label: str, cache_key: Optional[str] = None,
+                metadata: Optional[Dict[str, Any]] = None,
+                on_result: Optional[Callable[[Dict[str, Any], int], None]] = None) -> Iterator[str]:
+    """Yields the SSE events of a streamed SVG generation: `chunk`s, then a terminal `done` or `error`.
+
+    Args:
+        model_name: The allowed model to call.
+        prompt: The prompt string or list of prompt parts.
+        label: Short description of the operation used in error messages (e.g. "SVG generation").
+        cache_key: If given, the cleaned SVG is stored in the response cache under this key.
+        metadata: Extra fields to include in the terminal `done` event (e.g. image preprocessing stats).
+        on_result: If given, called before the terminal event with its payload (without `metadata`) and the
+            status the equivalent non-streamed response would have.
+    """
+    resolve = _resolver(model_name, prompt)
+    report = on_result or (lambda payload, status: None)
+    served_by = [model_name]
+
+    def resolve_tracked(name: str) -> tuple[genai.GenerativeModel, Any, Any]:
+        served_by[0] = name
+        return resolve(name)
+
+    def event_stream():
+        chunks = []
+        usage = {}
+        extractor = svg_utils.SvgExtractor()
+        stream = model_utils.stream_generate(model_name, resolve_tracked, _deadline(model_name),
+                                             model_registry.fallback(model_name))
+        try:
+            # Includes the time spent sending chunks to the client
+            with span("model_stream"):
+                for chunk in stream:
+                    usage = _usage(chunk) or usage # Reported on the last chunk
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunk has no text parts (e.g. blocked or finish-only chunk)
+                        text = ''
+                    if text:
+                        chunks.append(text)
+                        extractor.feed(text)
+                        yield _sse_event('chunk', {"text": text})
+                        if extractor.complete:
+                            break # Whatever follows </svg> (fences, explanations) would be discarded anyway
+        except Exception as e:
+            payload, status = _error_payload(e, f"streamed {label}")
+            report(payload, status)
+            yield _sse_event('error', payload)
+            return
+        finally:
+            stream.close() # Cancels the upstream call if it is still running
+
+        raw_text = "".join(chunks)
+        if not raw_text:
+            error_message = f"AI generation failed during {label}. Response was empty or blocked."
+            logger.warning(error_message)
+            report({"error": error_message}, 500)
+            yield _sse_event('error', {"error": error_message})
+            return
+
+        cleaned_svg = _clean_svg_response(raw_text, extractor)
+        if cleaned_svg:
+            cleaned_svg, optimization = _optimize_svg(cleaned_svg)
+            fallback = {"fallback_model": served_by[0]} if served_by[0] != model_name else {}
+            if cache_key and not fallback:
+                svg_cache.set(cache_key, cleaned_svg)
+            payload = {"svg_code": cleaned_svg, **optimization, **usage, **fallback}
+            report(payload, 200)
+            yield _sse_event('done', {**payload, **(metadata or {})})
+        else:
+            payload = {"error": "Failed to extract valid SVG code from AI response."}
+            report(payload, 500)
+            yield _sse_event('error', payload)
+
+    return event_stream()
+
+def _coalesced_svg_events(model_name: str, prompt: Any, cache_key: str,
+                          metadata: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """Streams a /generate call, or, while an identical one (streamed or not) is running, waits for its result
+    and sends it as a single `done` (or `error`) event."""
+    future, leader = generate_flights.join(cache_key)
+    if not leader:
+        yield ": waiting for an identical request\n\n" # Sends the headers while the leader runs
+        payload, status = future.result()
+        yield _sse_event('done', {**payload, **(metadata or {})}) if status == 200 else _sse_event('error', payload)
+        return
+
+    results = []
+    try:
+        yield from _svg_events(model_name, prompt, "SVG generation", cache_key, metadata,
+                               on_result=lambda payload, status: results.append((payload, status)))
+    finally:
+        # A leader whose client went away mid-stream has no result; its followers get an error to retry on
+        generate_flights.finish(cache_key, future, results[0] if results else (
+            {"error": "The identical request this one was waiting on was cancelled. Please try again.",
+             "code": "upstream_cancelled"}, 503))
+
+def _generate_svg(full_prompt: str, selected_model_name: str, cache_key: str) -> tuple[Dict[str, Any], int]:
+    """Runs one /generate model call and returns the JSON payload and status; successful SVGs are cached."""
+    try:
+        # Make the API call with the model's own generation defaults, retries and deadline
+        response, fallback = _call_model(selected_model_name, full_prompt)
+
+        # An answer from the fallback model isn't cached under the selected model's key
+        payload, status = _generation_payload(response, None if fallback else cache_key)
+        return ({**payload, **fallback} if status == 200 else payload), status
 
-    # Attempt 1: Use regex to find the main <svg>...</svg> block
-    match = re.search(r'<svg.*?</svg>', svg_code, re.DOTALL | re.IGNORECASE)
-    if match:
-        svg_code = match.group(0)
+    except Exception as e: # Catch potential errors during generation
+        return _error_payload(e, "SVG generation")
+
+def _generation_payload(response: Any, cache_key: Optional[str]) -> tuple[Dict[str, Any], int]:
+    """Turns a /generate model response into the JSON payload and status, caching the cleaned SVG under `cache_key`."""
+    # Check response and clean it using the helper function (R1)
+    if hasattr(response, 'text') and response.text:
+        cleaned_svg = _clean_svg_response(response.text)
+        if cleaned_svg:
+            cleaned_svg, optimization = _optimize_svg(cleaned_svg)
+            if cache_key:
+                svg_cache.set(cache_key, cleaned_svg)
+            return {"svg_code": cleaned_svg, **optimization, **_usage(response)}, 200
+        else:
+            # Cleaning failed, return specific error
+            return {"error": "Failed to extract valid SVG code from AI response."}, 500
     else:
-        # Fallback: Remove potential markdown fences if no <svg> block found
-        if svg_code.startswith("```"):
-            # Remove first line (e.g., ```svg or ```xml)
-            parts = svg_code.split('\n', 1)
-            svg_code = parts[1] if len(parts) > 1 else ''
-        if svg_code.endswith("```"):
-            svg_code = svg_code[:-3]
-        svg_code = svg_code.strip()
-
-    # Final validation: check if it looks like SVG after cleaning
-    if svg_code.startswith('<svg') and svg_code.endswith('</svg>'):
-        return svg_code
+        # Handle cases where the response might be blocked or empty
+        error_message = "AI generation failed. Response was empty or blocked."
+        # Add specific feedback if available (check Gemini API documentation for details)
+        # if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+        #    error_message += f" Reason: {response.prompt_feedback}"
+        logger.warning(error_message)
+        return {"error": error_message}, 500
+
+async def _generate_candidate(index: int, model_name: str, full_prompt: str) -> Dict[str, Any]:
+    """Generates and locally scores one candidate for hedged/best-of-N generation."""
+    started = time.monotonic()
+    candidate: Dict[str, Any] = {"index": index, "model": model_name}
+    try:
+        response, served_by = await model_utils.resilient_generate_async(
+            model_name, _resolver(model_name, full_prompt), _deadline(model_name),
+            model_registry.fallback(model_name)
+        )
+        cleaned_svg = _clean_svg_response(response.text) if getattr(response, 'text', None) else None
+        candidate.update(_usage(response))
+        if served_by != model_name:
+            candidate["fallback_model"] = served_by
+    except Exception as e:
+        logger.warning("Error generating candidate %d with '%s': %s", index, model_name, e)
+        cleaned_svg = None
+        candidate["error"] = "Generation failed."
+        if isinstance(e, model_utils.ModelCallError):
+            candidate["code"] = e.code
+    candidate["latency_seconds"] = round(time.monotonic() - started, 3)
+    if cleaned_svg:
+        # Optimize first so candidates are scored on the bytes that would be returned
+        cleaned_svg, optimization = _optimize_svg(cleaned_svg)
+        candidate.update(optimization)
+        candidate.update(svg_utils.score_svg(cleaned_svg))
+        candidate["svg_code"] = cleaned_svg
     else:
-        print(f"Warning: Model output could not be cleaned into valid SVG:\n{raw_text}")
-        return None
+        candidate.update({"valid": False, "score": None})
+    return candidate
+
+async def _race_candidates(full_prompt: str, model_names: List[str], mode: str, deadline: float) -> List[Dict[str, Any]]:
+    """Runs candidates in parallel and returns the finished ones once the mode's stopping rule is met.
+
+    Hedged mode stops at the first valid candidate. Best-of-N waits for all candidates or the deadline,
+    whichever comes first, and then keeps waiting only until one valid candidate exists.
+    Unfinished candidates are cancelled.
+    """
+    pending = {asyncio.ensure_future(_generate_candidate(i, name, full_prompt)) for i, name in enumerate(model_names)}
+    finished: List[Dict[str, Any]] = []
+    loop = asyncio.get_running_loop()
+    deadline_at = loop.time() + deadline
+    try:
+        while pending:
+            remaining = deadline_at - loop.time()
+            # Past the deadline we are only waiting for a first valid candidate, however long that takes
+            timeout = remaining if remaining > 0 else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finished.extend(task.result() for task in done)
+            if any(c["valid"] for c in finished) and (mode == 'hedged' or loop.time() >= deadline_at):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    return finished
+
+def _generate_candidates(full_prompt: str, model_names: List[str], mode: str, deadline: float,
+                         use_cache: bool) -> tuple[Dict[str, Any], int]:
+    """Hedged/best-of-N generation; returns the winning SVG plus a summary of every finished candidate.
+
+    The whole response is cached under the mode and candidate models (one entry per candidate, so N counts),
+    apart from single-mode results: a single generation never answers a multi-candidate request.
+    """
+    cache_key = cache_utils.make_key(full_prompt, mode, model_names,
+                                     [model_registry.generation_config(name) for name in dict.fromkeys(model_names)])
+    if use_cache:
+        cached = svg_cache.get(cache_key)
+        if cached:
+            return {**cached, "cached": True}, 200
+
+    try:
+        finished = model_utils.submit(_race_candidates(full_prompt, model_names, mode, deadline)).result()
+    except Exception as e:
+        logger.exception("Error during %s generation: %s", mode, e)
+        return {"error": "An internal error occurred during SVG generation."}, 500
+
+    summary = [{k: v for k, v in c.items() if k != 'svg_code'} for c in finished]
+    valid = [c for c in finished if c["valid"]]
+    if not valid:
+        return {"error": "None of the generated candidates contained valid SVG code.", "candidates": summary}, 500
+
+    # Hedged: the first valid one to arrive; best-of-N: the highest local score
+    winner = valid[0] if mode == 'hedged' else max(valid, key=lambda c: c["score"])
+    payload = {"svg_code": winner["svg_code"], "model": winner.get("fallback_model", winner["model"]), "mode": mode,
+               "candidates": summary}
+    if "fallback_model" not in winner:
+        svg_cache.set(cache_key, payload)
+    return payload, 200
+
+def _generation_field_error(fields: Dict[str, Any]) -> Optional[str]:
+    """Returns an error message if a generation request's fields have the wrong types, else None."""
+    if not isinstance(fields.get('prompt'), str):
+        return "'prompt' must be a string."
+    for name in ('complexity', 'colorUsage'):
+        value = fields.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return f"'{name}' must be a number."
+    if not isinstance(fields.get('model', ''), str):
+        return "'model' must be a string."
+    return None
+
+async def _generate_batch_item(index: int, item: Any, slots: asyncio.Semaphore) -> Dict[str, Any]:
+    """Generates one /generate_batch item on the model-call loop and returns its NDJSON result line.
+
+    Any failure, including an unexpected one, becomes the item's error line; the rest of the batch goes on.
+    """
+    if not isinstance(item, dict) or not item.get('prompt'):
+        return {"index": index, "error": "Missing 'prompt' in item"}
+    field_error = _generation_field_error(item)
+    if field_error:
+        return {"index": index, "error": field_error}
+    try:
+        return await _generate_checked_batch_item(index, item, slots)
+    except Exception as e:
+        return {"index": index, **_error_payload(e, f"batch item {index} generation")[0]}
+
+async def _generate_checked_batch_item(index: int, item: Dict[str, Any], slots: asyncio.Semaphore) -> Dict[str, Any]:
+    """`_generate_batch_item` for an item whose fields have the right types."""
+    selected_model_name = item.get('model', 'gemini-2.5-pro-exp-03-25')
+    try:
+        model_registry.check(selected_model_name)
+    except model_utils.UnknownModel as e:
+        return {"index": index, "error": str(e)}
+    try:
+        # Estimated only: counting tokens is a blocking API call and this runs on the model-call loop
+        full_prompt, prompt_info = fit_prompt(
+            lambda p: format_svg_prompt(p, complexity=item.get('complexity', 5), colorUsage=item.get('colorUsage', 5)),
+            item['prompt'], trim_text, PROMPT_TOKEN_BUDGETS['generate']
+        )
+    except ValueError as e:
+        return {"index": index, "error": str(e)}
+
+    generation_config = model_registry.generation_config(selected_model_name)
+    cache_key = cache_utils.make_key(full_prompt, selected_model_name, generation_config)
+    if item.get('cache', True) is not False:
+        cached_svg = svg_cache.get(cache_key)
+        if cached_svg:
+            return {"index": index, "svg_code": cached_svg, "cached": True}
+
+    async with slots:
+        try:
+            response, served_by = await model_utils.resilient_generate_async(
+                selected_model_name, _resolver(selected_model_name, full_prompt),
+                _deadline(selected_model_name), model_registry.fallback(selected_model_name)
+            )
+        except Exception as e:
+            return {"index": index, **_error_payload(e, f"batch item {index} generation")[0]}
+
+    fallback = {"fallback_model": served_by} if served_by != selected_model_name else {}
+    payload, _ = _generation_payload(response, None if fallback else cache_key)
+    return {"index": index, **payload, **fallback, **_prompt_warnings(prompt_info)}
+
+def _run_image_analysis(image: Any, context_prompt: str, model_name: str, structured: bool = ANALYSIS_STRUCTURED_OUTPUT,
+                        deadline: Optional[float] = None) -> tuple[Dict[str, str], bool, Dict[str, Any]]:
+    """Runs the multimodal analysis call and parses the five sections.
+
+    With `structured`, the model returns JSON matching the section schema; otherwise Markdown sections
+    are split in one pass over the headers. Unparseable JSON falls back to the Markdown parser, and a
+    model that rejects the response schema is asked again for Markdown.
+
+    Returns:
+        The sections dict, whether any section was found in the response, and extra response fields
+        (token `usage`, `prompt_warnings`, `fallback_model`).
+    """
+    # --- Gemini API Call using prompt_utils ---
+    prompt_parts, prompt_info = fit_prompt(
+        lambda context: format_analysis_prompt(context, image, structured=structured), context_prompt,
+        lambda context, excess: trim_text(context, excess, "context prompt"),
+        PROMPT_TOKEN_BUDGETS['analyze'], _token_counter(model_name)
+    )
+    try:
+        response, fallback = _call_model(model_name, prompt_parts, deadline, **(ANALYSIS_JSON_CONFIG if structured else {}))
+    except api_exceptions.InvalidArgument as e:
+        if not structured:
+            raise
+        logger.warning("'%s' rejected the structured analysis request (%s); retrying with Markdown sections.",
+                       model_name, e)
+        return _run_image_analysis(image, context_prompt, model_name, False, deadline)
+    analysis_text = response.text
+    logger.log(PAYLOAD, "Raw analysis response:\n%s", analysis_text)
+
+    # --- Parse the response ---
+    with span("analysis_parse"):
+        sections, parsed = parse_analysis_json(analysis_text) if structured else parse_analysis_sections(analysis_text)
+    if not parsed:
+        logger.warning("No analysis sections found in the %s response from '%s'.",
+                       "JSON" if structured else "Markdown", model_name)
+    logger.log(PAYLOAD, "Parsed analysis sections: %s", sections)
+
+    return sections, parsed, {**_usage(response), **_prompt_warnings(prompt_info), **fallback}
+
+def _wants_tiles(data: Dict[str, Any], image_data: bytes) -> bool:
+    """Reads the request's `tiled` field (default ANALYSIS_TILING): a flag, or "auto" to tile the images that
+    downscaling would make illegible."""
+    tiled = data.get('tiled', ANALYSIS_TILING)
+    if isinstance(tiled, str) and tiled.strip().lower() == 'auto':
+        try:
+            return image_utils.should_tile(image_utils.image_size(image_data))
+        except OSError:
+            return False # Not an image; preprocessing reports it
+    return _is_truthy(tiled)
+
+async def _analyze_tiles(model_name: str, resolvers: List[model_utils.Resolver], deadline: Optional[float]) -> List[Any]:
+    """Runs analysis calls on the model-call loop, at most ANALYSIS_TILE_CONCURRENCY at once.
+
+    Returns:
+        Each call's (response, served_by), or the exception it raised, in order.
+    """
+    slots = asyncio.Semaphore(ANALYSIS_TILE_CONCURRENCY)
+    fallback = model_registry.fallback(model_name)
+
+    async def analyze(resolve: model_utils.Resolver) -> tuple[Any, str]:
+        async with slots:
+            return await model_utils.resilient_generate_async(model_name, resolve, deadline, fallback)
+
+    return await asyncio.gather(*(analyze(resolve) for resolve in resolvers), return_exceptions=True)
+
+def _run_tiled_analysis(image: Any, image_data: bytes, context_prompt: str, model_name: str,
+                        structured: bool = ANALYSIS_STRUCTURED_OUTPUT) -> tuple[Dict[str, str], bool, Dict[str, Any]]:
+    """Analyses the downscaled whole image and its overlapping full-resolution tiles concurrently, and merges
+    the tiles' layout and OCR, mapped onto the whole image, into the overview's sections.
+
+    A failed tile is noted in its region of the merged sections; the analysis only fails if the overview
+    or every tile does.
+
+    Returns:
+        As `_run_image_analysis`; the extra response fields also have a `tiling` summary. Results with
+        failed tiles count as unparsed, so they aren't cached.
+    """
+    image_size = image_utils.image_size(image_data)
+    boxes = image_utils.plan_tiles(image_size)
+    if len(boxes) == 1: # Fits one tile: the overview alone sees it all
+        return _run_image_analysis(image, context_prompt, model_name, structured)
+    tiles = image_utils.crop_tiles(image_data, boxes)
+
+    # The overview first, then the tiles in reading order
+    resolvers = []
+    prompt_infos = []
+    for index, prompt_image in enumerate([image, *tiles]):
+        tile_note = format_tile_note(index, len(tiles), boxes[index - 1], image_size) if index else None
+        prompt_parts, prompt_info = fit_prompt(
+            lambda context: format_analysis_prompt(context, prompt_image, structured=structured, tile_note=tile_note),
+            context_prompt, lambda context, excess: trim_text(context, excess, "context prompt"),
+            PROMPT_TOKEN_BUDGETS['analyze'], _token_counter(model_name)
+        )
+        resolvers.append(_resolver(model_name, prompt_parts, **(ANALYSIS_JSON_CONFIG if structured else {})))
+        prompt_infos.append(prompt_info)
+    # Calls run in waves of ANALYSIS_TILE_CONCURRENCY; each wave gets a model timeout
+    waves = -(-len(resolvers) // ANALYSIS_TILE_CONCURRENCY)
+    with span("model_call"):
+        results = model_utils.submit(_analyze_tiles(model_name, resolvers, _deadline(*[model_name] * waves))).result()
+
+    overview_result, tile_results = results[0], results[1:]
+    if structured and isinstance(overview_result, api_exceptions.InvalidArgument):
+        logger.warning("'%s' rejected the structured analysis request (%s); retrying with Markdown sections.",
+                       model_name, overview_result)
+        return _run_tiled_analysis(image, image_data, context_prompt, model_name, False)
+    if isinstance(overview_result, BaseException):
+        raise overview_result
+    if all(isinstance(result, BaseException) for result in tile_results):
+        raise tile_results[0]
+
+    parse = parse_analysis_json if structured else parse_analysis_sections
+    responses = [overview_result[0]]
+    tile_sections = []
+    failed = []
+    with span("analysis_parse"):
+        logger.log(PAYLOAD, "Raw overview analysis response:\n%s", overview_result[0].text)
+        overview, parsed = parse(overview_result[0].text)
+        for number, (box, result) in enumerate(zip(boxes, tile_results), 1):
+            if isinstance(result, BaseException):
+                logger.warning("Analysis of tile %d/%d from '%s' failed: %s", number, len(boxes), model_name, result)
+                failed.append(number)
+                tile_sections.append((box, None))
+                continue
+            responses.append(result[0])
+            logger.log(PAYLOAD, "Raw analysis response for tile %d:\n%s", number, result[0].text)
+            tile_sections.append((box, parse(result[0].text)[0]))
+        sections = merge_tile_sections(overview, tile_sections, image_size)
+    logger.log(PAYLOAD, "Merged analysis sections: %s", sections)
+
+    usage: Dict[str, int] = {}
+    for response in responses:
+        for key, value in _usage(response).get("usage", {}).items():
+            usage[key] = usage.get(key, 0) + (value or 0)
+    fallbacks = [result[1] for result in results if not isinstance(result, BaseException) and result[1] != model_name]
+    tiling = {"tiles": len(boxes), "calls": len(resolvers), "image_size": list(image_size),
+              "tile_size": [boxes[0][2] - boxes[0][0], boxes[0][3] - boxes[0][1]], "failed_tiles": failed}
+    return sections, parsed and not failed, {
+        "tiling": tiling, **({"usage": usage} if usage else {}), **_prompt_warnings(prompt_infos[0]),
+        **({"fallback_model": fallbacks[0]} if fallbacks else {}),
+    }
+
+def _conversion_prompt(image: Any, analysis_data: Dict[str, str], selected_model_name: str) -> tuple[List[Any], Dict[str, Any]]:
+    """Builds the recreation prompt, trimming the analysis sections to the 'convert' token budget if needed."""
+    return fit_prompt(
+        lambda sections: format_conversion_prompt(image, sections), analysis_data, trim_analysis_data,
+        PROMPT_TOKEN_BUDGETS['convert'], _token_counter(selected_model_name)
+    )
+
+def _run_conversion(prompt_parts: List[Any], selected_model_name: str,
+                    deadline: Optional[float] = None) -> tuple[Dict[str, Any], int]:
+    """Runs the SVG recreation call for a prepared conversion prompt and returns the JSON payload and status."""
+    try:
+        # Generate with the model's own defaults, retries and deadline
+        response, fallback = _call_model(selected_model_name, prompt_parts, deadline)
+
+        # Process Response
+        if hasattr(response, 'text') and response.text:
+            cleaned_svg = _clean_svg_response(response.text)
+            if cleaned_svg:
+                cleaned_svg, optimization = _optimize_svg(cleaned_svg)
+                return {"svg_code": cleaned_svg, **optimization, **_usage(response), **fallback}, 200
+            else:
+                # Cleaning failed (the raw output is logged at the PAYLOAD level)
+                logger.warning("Recreation cleaning failed.")
+                return {"error": "Failed to extract valid SVG code from AI response."}, 500
+        else:
+            # Handle blocked or empty response
+            error_message = "AI generation failed during SVG recreation. Response was empty or blocked."
+            logger.warning(error_message)
+            # Consider adding more specific feedback if the API provides it
+            return {"error": error_message}, 500
+
+    except Exception as e:
+        return _error_payload(e, "SVG recreation")
+
+def _refine_with_patch(svg_code: str, refinement_prompt: str, png_image: Any, png_note: Optional[str],
+                       selected_model_name: str) -> tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """Refines an SVG by asking the model for edit operations on its elements and applying them here.
+
+    Returns:
+        The refinement payload, or None when the caller should fall back to full regeneration, and extra
+        response fields (`patch_error` and the patch call's `patch_usage` when falling back).
+    """
+    try:
+        annotated_svg = svg_utils.annotate_svg(svg_code)
+    except svg_utils.PatchError as e:
+        return None, {"patch_error": str(e)}
+    # The model must see every element it may address, so a document that needs trimming isn't patched
+    prompt_parts, prompt_info = fit_prompt(
+        lambda svg: format_refine_prompt(svg, refinement_prompt, png_image, png_note, patch=True), annotated_svg,
+        trim_svg_code, PROMPT_TOKEN_BUDGETS['refine'], _token_counter(selected_model_name)
+    )
+    if prompt_info["warnings"]:
+        return None, {"patch_error": "The SVG is too large for the prompt token budget without trimming."}
+
+    response, fallback = _call_model(selected_model_name, prompt_parts, **REFINE_PATCH_JSON_CONFIG)
+    raw_text = getattr(response, 'text', None)
+    logger.log(PAYLOAD, "Raw refinement patch:\n%s", raw_text)
+    try:
+        if not raw_text:
+            raise svg_utils.PatchError("The patch response was empty or blocked.")
+        with span("patch_apply"):
+            ops = svg_utils.parse_patch(raw_text)
+            refined_svg = svg_utils.apply_patch(svg_code, ops)
+    except svg_utils.PatchError as e:
+        logger.warning("Refinement patch from '%s' did not apply, regenerating in full: %s", selected_model_name, e)
+        patch_usage = _usage(response)
+        return None, {"patch_error": str(e), **({"patch_usage": patch_usage["usage"]} if patch_usage else {})}
+
+    refined_svg, optimization = _optimize_svg(refined_svg)
+    return {"svg_code": refined_svg, "refine_mode": "patch", "patch_ops": len(ops), **optimization,
+            **_usage(response), **fallback}, {}
+
+def _analysis_error_payload(e: Exception) -> tuple[Dict[str, Any], int]:
+    """Maps an analysis failure to a user-facing error payload and status without overly technical details."""
+    if isinstance(e, model_utils.ModelCallError):
+        return _error_payload(e, "image analysis")
+    logger.exception("Error during image analysis: %s", e) # Log the error
+    error_message = f"An error occurred during analysis: {str(e)}"
+    if "API key" in str(e):
+         error_message = "API key validation failed. Please check server configuration."
+    elif isinstance(e, genai.types.generation_types.BlockedPromptException):
+         error_message = "Analysis request was blocked due to safety concerns."
+    elif isinstance(e, genai.types.generation_types.StopCandidateException):
+         error_message = "Analysis stopped unexpectedly. The image might be unsuitable or the request too complex."
+    return {"error": error_message}, 500
+
+def _is_truthy(value: Any) -> bool:
+    """Interprets JSON booleans and form/query strings such as "1" or "true" as flags."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def _wants_job(data: Dict[str, Any]) -> bool:
+    """Checks whether the client asked for job mode (an `async` field or query parameter)."""
+    return _is_truthy(data.get('async', request.args.get('async', False)))
+
+def _job_response(kind: str, run: Callable[[], tuple[Dict[str, Any], int]], data: Dict[str, Any],
+                  *uploads: Optional[bytes]) -> tuple[Response, int]:
+    """Queues `run` as a background job and returns 202 with the job's ID and where to follow it.
+
+    With an `Idempotency-Key` header, a retry of the same request (same fields and uploaded images)
+    gets the job the first attempt created, with 200, instead of starting the model calls again.
+    """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    request_hash = None
+    if idempotency_key:
+        fields = {k: v for k, v in data.items() if k not in IMAGE_FIELDS} # Uploads are hashed separately
+        request_hash = cache_utils.make_key(kind, fields, [hashlib.sha256(u).hexdigest() if u else None for u in uploads])
+    try:
+        job, created = jobs.submit(kind, run, idempotency_key, request_hash)
+    except job_utils.IdempotencyConflict as e:
+        return jsonify({"error": str(e)}), 422
+    job_id = job["job_id"]
+    return jsonify({**job, "status_url": f"/jobs/{job_id}", "events_url": f"/jobs/{job_id}/events"}), 202 if created else 200
+
+def _image_to_svg_pipeline(image_data: bytes, context_prompt: str, analysis_model_name: str,
+                           selected_model_name: str, include_analysis: bool,
+                           structured: bool = ANALYSIS_STRUCTURED_OUTPUT) -> tuple[Dict[str, Any], int]:
+    """Analyses an image and recreates it as SVG in one pass, reusing the preprocessed image and parsed sections.
+
+    Both model calls share one deadline: the sum of the two models' timeouts.
+    """
+    deadline = _deadline(analysis_model_name, selected_model_name)
+    image, image_stats = image_utils.preprocess_image(image_data)
+    image_id = hashlib.sha256(image_data).hexdigest()
+    analysis_id = cache_utils.make_key(image_id, context_prompt, analysis_model_name)
+    image_cache.set(image_id, image["data"])
+
+    cached = analysis_cache.get(analysis_id)
+    analysis_fields: Dict[str, Any] = {}
+    if cached:
+        sections = cached["sections"]
+    else:
+        try:
+            sections, parsed, analysis_fields = _run_image_analysis(image, context_prompt, analysis_model_name,
+                                                                    structured, deadline)
+        except Exception as e:
+            return _analysis_error_payload(e)
+        if parsed:
+            analysis_cache.set(analysis_id, {"image_id": image_id, "sections": sections})
+
+    prompt_parts, prompt_info = _conversion_prompt(image, sections, selected_model_name)
+    payload, status = _run_conversion(prompt_parts, selected_model_name, deadline)
+    if status != 200:
+        return payload, status
+
+    payload.update({"image_id": image_id, "analysis_id": analysis_id, "image_stats": image_stats})
+    if "usage" in analysis_fields:
+        payload["analysis_usage"] = analysis_fields["usage"]
+    if "fallback_model" in analysis_fields:
+        payload["analysis_fallback_model"] = analysis_fields["fallback_model"]
+    warnings = analysis_fields.get("prompt_warnings", []) + _prompt_warnings(prompt_info).get("prompt_warnings", [])
+    if warnings:
+        payload["prompt_warnings"] = warnings
+    if include_analysis:
+        payload["analysis"] = sections
+    return payload, status
+
+def _request_fields() -> Dict[str, Any]:
+    """Returns the request's fields from a JSON body, multipart form fields, or the query string (raw image bodies)."""
+    if request.is_json:
+        with span("request_parse"):
+            return request.get_json()
+    if request.mimetype == 'multipart/form-data':
+        with span("request_parse"):
+            return request.form.to_dict()
+    if request.mimetype.startswith('image/'):
+        return request.args.to_dict()
+    raise ValueError("Request must be JSON, multipart/form-data or a raw image/* body")
+
+def _request_image(data: Dict[str, Any], field: str) -> Optional[bytes]:
+    """Returns the uploaded image bytes from a raw image body, a multipart file, or a base64 data URL in JSON.
+
+    Binary uploads are read in chunks with a size cap, avoiding the base64 inflation and JSON string copies.
+
+    Raises:
+        ValueError: If the image data is malformed (`UploadTooLarge` if it exceeds the size cap).
+    """
+    if request.mimetype.startswith('image/'):
+        with span("upload_read"):
+            return image_utils.read_limited(request.stream)
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get(field)
+        if not upload:
+            return None
+        with span("upload_read"):
+            return image_utils.read_limited(upload.stream)
+    data_url = data.get(field)
+    return image_utils.decode_data_url(data_url) if data_url else None
 
 # --- Routes ---
 
+@app.before_request
+def start_request_trace():
+    """Starts the request's latency measurement and its per-stage timing trace."""
+    g.request_started = time.perf_counter()
+    g.trace = metrics_utils.start_trace()
+
+@app.after_request
+def record_request_metrics(response):
+    """Records the request's latency and logs one line with its stage timings once the response is fully sent."""
+    route = request.url_rule.rule if request.url_rule else "unmatched" # Route patterns keep the label set small
+    method, status = request.method, response.status_code
+    started, trace = g.get('request_started', time.perf_counter()), g.get('trace', [])
+
+    def record():
+        elapsed = time.perf_counter() - started
+        HTTP_REQUEST_SECONDS.observe(elapsed, route=route, method=method, status=status)
+        logger.info("%s %s %d %.1fms %s", method, route, status, elapsed * 1000, metrics_utils.format_trace(trace))
+
+    response.call_on_close(record)
+    return response
+
+@app.errorhandler(413)
+def request_too_large(error):
+    """Returns upload size errors as JSON like the other API errors."""
+    return jsonify({"error": f"Upload too large. The limit is {image_utils.MAX_UPLOAD_BYTES} bytes per image."}), 413
+
 @app.route('/')
 def index():
     """Serves the main HTML page."""
-    return render_template('index.html')
+    # Lets the frontend skip rendering/uploading a PNG for refinement when the server can render it
+    return render_template('index.html', server_render=raster_utils.is_available())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Exposes request, stage, model and cache metrics in the Prometheus text format."""
+    return Response(metrics_utils.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Lists the models clients may select, with their generation defaults (temperature, max tokens, timeout)."""
+    if model_registry is None:
+        return jsonify({"error": "AI SDK not configured or API key missing."}), 503
+    return jsonify({"models": model_registry.settings})
 
 @app.route('/generate', methods=['POST'])
 def generate_svg():
     """Handles SVG generation requests using the selected model."""
-    # Use api_key (from env var) and check generation_config
-    if not api_key or not generation_config:
+    # Use api_key (from env var) and check the model registry
+    if not api_key or model_registry is None:
         return jsonify({"error": "AI SDK not configured or API key missing."}), 503
 
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 400
 
-    data = request.get_json()
+    data = _request_fields()
     prompt = data.get('prompt')
     complexity = data.get('complexity', 5)
     colorUsage = data.get('colorUsage', 5)
     selected_model_name = data.get('model', 'gemini-2.5-pro-exp-03-25') # Get selected model, default
 
+    # Optional multi-candidate modes: "hedged" returns the first valid of N, "best_of_n" the best within a deadline
+    mode = data.get('mode', 'single')
+
     if not prompt:
         return jsonify({"error": "Missing 'prompt' in request"}), 400
+    field_error = _generation_field_error(data)
+    if field_error:
+        return jsonify({"error": field_error}), 400
+    if mode not in GENERATION_MODES:
+        return jsonify({"error": f"Unknown 'mode'; expected one of {', '.join(GENERATION_MODES)}"}), 400
+    model_error = _model_error(selected_model_name)
+    if model_error:
+        return model_error
 
     try:
-        # Format the prompt using the utility function
-        full_prompt = format_svg_prompt(prompt, complexity=complexity, colorUsage=colorUsage)
+        # Format the prompt using the utility function, trimming the user prompt to the token budget if needed
+        full_prompt, prompt_info = fit_prompt(
+            lambda text: format_svg_prompt(text, complexity=complexity, colorUsage=colorUsage), prompt, trim_text,
+            PROMPT_TOKEN_BUDGETS['generate'], _token_counter(selected_model_name)
+        )
     except ValueError as e:
         return jsonify({"error": str(e)}), 400 # Prompt format error
+    prompt_warnings = _prompt_warnings(prompt_info)
 
-    try:
-        # Initialize the model dynamically based on selection
-        try:
-            dynamic_model = genai.GenerativeModel(selected_model_name)
-        except Exception as model_init_error:
-            print(f"Error initializing model '{selected_model_name}': {model_init_error}")
-            return jsonify({"error": f"Failed to initialize selected AI model: {selected_model_name}"}), 500
-
-        # Make the API call using the dynamic model and global config
-        response = dynamic_model.generate_content(
-            full_prompt,
-            generation_config=generation_config
-        )
+    # Job mode returns a job ID right away; its result is the JSON response (streaming doesn't apply)
+    job_mode = _wants_job(data)
+    # Identical prompt + model + config => identical request; serve it from cache unless the client opts out
+    use_cache = data.get('cache', True) is not False
 
-        # Check response and clean it using the helper function (R1)
-        if hasattr(response, 'text') and response.text:
-            cleaned_svg = _clean_svg_response(response.text)
-            if cleaned_svg:
-                return jsonify({"svg_code": cleaned_svg})
-            else:
-                # Cleaning failed, return specific error
-                return jsonify({"error": "Failed to extract valid SVG code from AI response."}), 500
-        else:
-            # Handle cases where the response might be blocked or empty
-            error_message = "AI generation failed. Response was empty or blocked."
-            # Add specific feedback if available (check Gemini API documentation for details)
-            # if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-            #    error_message += f" Reason: {response.prompt_feedback}"
-            print(error_message)
-            return jsonify({"error": error_message}), 500
+    if mode != 'single':
+        if _wants_stream() and not job_mode:
+            return jsonify({"error": f"Streaming is not supported in '{mode}' mode."}), 400
+        try:
+            n = max(1, min(int(data.get('n', 3)), GENERATE_MAX_CANDIDATES))
+            deadline = float(data.get('deadline', GENERATE_CANDIDATE_DEADLINE))
+        except (TypeError, ValueError):
+            return jsonify({"error": "'n' and 'deadline' must be numbers."}), 400
+        # Candidates rotate across the given models (e.g. from the model selector), else all use the selected one
+        model_names = data.get('models') or [selected_model_name]
+        if not isinstance(model_names, list) or not all(isinstance(name, str) for name in model_names):
+            return jsonify({"error": "'models' must be a list of model names."}), 400
+        model_error = _model_error(*model_names)
+        if model_error:
+            return model_error
+        model_names = [model_names[i % len(model_names)] for i in range(n)]
+
+        def generate():
+            return _generate_candidates(full_prompt, model_names, mode, deadline, use_cache)
+    else:
+        cache_key = cache_utils.make_key(full_prompt, selected_model_name, model_registry.generation_config(selected_model_name))
+
+        if _wants_stream() and not job_mode:
+            cached_svg = svg_cache.get(cache_key) if use_cache else None
+            if cached_svg:
+                return Response(_sse_event('done', {"svg_code": cached_svg, "cached": True, **prompt_warnings}),
+                                mimetype='text/event-stream')
+            if not use_cache:
+                return _stream_svg_response(selected_model_name, full_prompt, "SVG generation", cache_key=cache_key,
+                                            metadata=prompt_warnings)
+            # Concurrent identical requests share a single upstream call, streamed or not
+            return _sse_response(_coalesced_svg_events(selected_model_name, full_prompt, cache_key, prompt_warnings))
+
+        def generate():
+            if not use_cache:
+                return _generate_svg(full_prompt, selected_model_name, cache_key)
+            cached_svg = svg_cache.get(cache_key)
+            if cached_svg:
+                return {"svg_code": cached_svg, "cached": True}, 200
+            # Concurrent identical requests share a single upstream call
+            return generate_flights.do(cache_key, lambda: _generate_svg(full_prompt, selected_model_name, cache_key))
+
+    def run():
+        payload, status = generate()
+        return ({**payload, **prompt_warnings} if status == 200 else payload), status
+
+    if job_mode:
+        return _job_response('generate', run, data)
+    payload, status = run()
+    return jsonify(payload), status
+
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    """Generates many SVGs in one request, streaming one NDJSON line per item as soon as it finishes.
+
+    Body: {"items": [{"prompt", "complexity", "colorUsage", "model"}, ...], "concurrency": optional int}.
+    Each line is {"index", "svg_code"} or {"index", "error"}; a final {"done": true, ...} line ends the stream.
+    In job mode (`async`), the job's result is one object with all item `results` in order.
+    """
+    if not api_key or model_registry is None:
+        return jsonify({"error": "AI SDK not configured or API key missing."}), 503
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
 
-    except Exception as e: # Catch potential errors during generation
-        print(f"Error during AI generation: {e}")
-        return jsonify({"error": "An internal error occurred during SVG generation."}), 500
+    data = _request_fields()
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing 'items' list in request"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items; the limit is {BATCH_MAX_ITEMS} per batch."}), 400
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_CONCURRENCY)), BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'concurrency' must be an integer."}), 400
+
+    def start_items():
+        # Items fan out on the shared model-call loop, bounded per batch
+        slots = asyncio.Semaphore(concurrency)
+        return [model_utils.submit(_generate_batch_item(i, item, slots)) for i, item in enumerate(items)]
+
+    if _wants_job(data):
+        def run():
+            started = time.monotonic()
+            results = sorted((future.result() for future in as_completed(start_items())), key=lambda r: r["index"])
+            return {"results": results, "count": len(items), "errors": sum('error' in r for r in results),
+                    "elapsed_seconds": round(time.monotonic() - started, 3)}, 200
+        return _job_response('generate_batch', run, data)
+
+    futures = start_items()
+
+    def result_lines():
+        started = time.monotonic()
+        errors = 0
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                errors += 'error' in result
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"done": True, "count": len(items), "errors": errors,
+                              "elapsed_seconds": round(time.monotonic() - started, 3)}) + "\n"
+        finally:
+            for future in futures: # Client went away: don't keep spending quota
+                future.cancel()
+
+    return Response(stream_with_context(result_lines()), mimetype='application/x-ndjson')
 
 # --- New Extractor Endpoints (MVP Placeholders) ---
 
@@ -142,285 +1055,394 @@ def analyze_image():
     if not api_key:
         return jsonify({"error": "API key not configured"}), 500
 
-    if not request.is_json:
-        return jsonify({"error": "Request must be JSON"}), 400
-
-    data = request.get_json()
-    image_data_url = data.get('image_data')
+    # Accepts JSON with an `image_data` data URL, multipart with an `image_data` file, or a raw image/* body
+    try:
+        data = _request_fields()
+        image_data = _request_image(data, 'image_data')
+    except image_utils.UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     context_prompt = data.get('context_prompt', '') # Renamed for clarity
     model_name = data.get('model', 'gemini-2.0-flash')
+    structured = _is_truthy(data.get('structured', ANALYSIS_STRUCTURED_OUTPUT)) # JSON instead of Markdown sections
+    model_error = _model_error(model_name)
+    if model_error:
+        return model_error
 
-    if not image_data_url:
+    if not image_data:
         return jsonify({"error": "No image data provided"}), 400
+    tiled = _wants_tiles(data, image_data)
 
-    try:
-        # Decode image
-        header, encoded = image_data_url.split(",", 1)
-        image_data = base64.b64decode(encoded)
-        image = Image.open(BytesIO(image_data))
-
-        # --- Gemini API Call using prompt_utils ---
-        model = genai.GenerativeModel(model_name)
-        prompt_parts = format_analysis_prompt(context_prompt, image) # Use the new function
-
-        response = model.generate_content(prompt_parts)
-        analysis_text = response.text
-
-        # --- Log Raw API Response --- 
-        print("--- Raw Gemini API Response ---")
-        print(analysis_text)
-        print("-------------------------------")
-
-        # --- Parse the response (Updated Section Names & Order) ---
-        sections = {
-            "metadata": "Metadata analysis not found.",
-            "semantic": "Semantic analysis not found.", # New key
-            "layout": "Layout analysis not found.",
-            "content_styling": "Content & Styling analysis not found.",
-            "ocr": "OCR analysis not found."
-            # Removed svg_summary key
-        }
-
-        # Use regex (adjusting for new section names and order)
-        metadata_match = re.search(r"\*\*Metadata Analysis:\*\*(.*?)(?=\*\*Semantic Analysis:\*\*|\Z)", analysis_text, re.DOTALL | re.IGNORECASE)
-        semantic_match = re.search(r"\*\*Semantic Analysis:\*\*(.*?)(?=\*\*Layout Analysis:\*\*|\Z)", analysis_text, re.DOTALL | re.IGNORECASE)
-        layout_match = re.search(r"\*\*Layout Analysis:\*\*(.*?)(?=\*\*Content & Styling Analysis:\*\*|\Z)", analysis_text, re.DOTALL | re.IGNORECASE)
-        content_styling_match = re.search(r"\*\*Content & Styling Analysis:\*\*(.*?)(?=\*\*OCR Analysis:\*\*|\Z)", analysis_text, re.DOTALL | re.IGNORECASE)
-        ocr_match = re.search(r"\*\*OCR Analysis:\*\*(.*?)\Z", analysis_text, re.DOTALL | re.IGNORECASE) # OCR is now last
-
-        if metadata_match:
-            sections["metadata"] = metadata_match.group(1).strip()
-        if semantic_match:
-            sections["semantic"] = semantic_match.group(1).strip()
-        if layout_match:
-            sections["layout"] = layout_match.group(1).strip()
-        if content_styling_match:
-            sections["content_styling"] = content_styling_match.group(1).strip()
-        if ocr_match:
-            sections["ocr"] = ocr_match.group(1).strip()
-            if not sections["ocr"]: 
-                 sections["ocr"] = "No text detected."
-        # Removed svg_summary check
-
-        # --- Log Parsed Sections --- 
-        print("--- Parsed Sections Dictionary ---")
-        print(sections)
-        print("---------------------------------")
-
-        return jsonify(sections)
+    def run():
+        try:
+            # Same image + context + model => same analysis; keep the image so /convert_to_svg can refer to it by ID
+            image_id = hashlib.sha256(image_data).hexdigest()
+            analysis_id = cache_utils.make_key(image_id, context_prompt, model_name, *(['tiled'] if tiled else []))
+
+            cached = analysis_cache.get(analysis_id)
+            if cached and image_cache.get(image_id) is not None:
+                return {**cached["sections"], "image_id": image_id, "analysis_id": analysis_id, "cached": True}, 200
+
+            # Downscale/re-encode once; the processed bytes are what /convert_to_svg reuses by ID
+            image, image_stats = image_utils.preprocess_image(image_data)
+            image_cache.set(image_id, image["data"])
+            if cached:
+                return {**cached["sections"], "image_id": image_id, "analysis_id": analysis_id, "cached": True}, 200
+
+            if tiled:
+                sections, parsed, response_fields = _run_tiled_analysis(image, image_data, context_prompt, model_name,
+                                                                        structured)
+            else:
+                sections, parsed, response_fields = _run_image_analysis(image, context_prompt, model_name, structured)
+            if parsed:
+                # Don't cache unparseable output; a re-run is the user's only remedy
+                analysis_cache.set(analysis_id, {"image_id": image_id, "sections": sections})
 
-    except Exception as e:
-        print(f"Error during image analysis: {e}") # Log the error
-        # Check for specific Gemini API errors if possible/needed
-        # Example: hasattr(e, 'message')
-        error_message = f"An error occurred during analysis: {str(e)}"
-        # Avoid sending overly technical details to the frontend if it's a server issue
-        if "API key" in str(e):
-             error_message = "API key validation failed. Please check server configuration."
-        elif isinstance(e, genai.types.generation_types.BlockedPromptException):
-             error_message = "Analysis request was blocked due to safety concerns."
-        elif isinstance(e, genai.types.generation_types.StopCandidateException):
-             error_message = "Analysis stopped unexpectedly. The image might be unsuitable or the request too complex."
-
-        return jsonify({"error": error_message}), 500
+            return {**sections, "image_id": image_id, "analysis_id": analysis_id, "image_stats": image_stats,
+                    **response_fields}, 200
+
+        except Exception as e:
+            return _analysis_error_payload(e)
+
+    if _wants_job(data):
+        return _job_response('analyze_image', run, data, image_data)
+    payload, status = run()
+    return jsonify(payload), status
 
 @app.route('/convert_to_svg', methods=['POST'])
 def convert_to_svg():
     """Handles SVG recreation requests using image + analysis data."""
     if not api_key: # Use the globally configured api_key
         return jsonify({"error": "API key not configured"}), 500
-    # Ensure generation_config is available (for temperature etc.)
-    if not generation_config:
+    # Ensure the model registry (per-model temperature etc.) is available
+    if model_registry is None:
         return jsonify({"error": "Generation config not set."}), 503
 
-    if not request.is_json:
-        return jsonify({"error": "Request must be JSON"}), 400
-
-    data = request.get_json()
-    image_data_url = data.get('image_data') # Renamed for consistency
+    # Accepts JSON with an `image_data` data URL, multipart with an `image_data` file, or a raw image/* body
+    try:
+        data = _request_fields()
+        uploaded_image = _request_image(data, 'image_data')
+    except image_utils.UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    image_id = data.get('image_id') # Hash returned by /analyze_image, instead of re-uploading the image
     analysis_data = data.get('analysis_data') # Expecting dict with the 5 analysis texts
+    if isinstance(analysis_data, str):
+        # Multipart/query fields carry the analysis as a JSON string
+        try:
+            analysis_data = json.loads(analysis_data)
+        except ValueError:
+            return jsonify({"error": "'analysis_data' must be a JSON object."}), 400
+    analysis_id = data.get('analysis_id') # ID returned by /analyze_image, instead of sending the analysis back
     # Update default model here
     selected_model_name = data.get('model', 'gemini-2.5-flash-preview-04-17') # New Default
-    
-    if not image_data_url or not analysis_data:
-        return jsonify({"error": "Missing 'image_data' or 'analysis_data' in request"}), 400
+    model_error = _model_error(selected_model_name)
+    if model_error:
+        return model_error
+
+    if analysis_id and (not analysis_data or not (uploaded_image or image_id)):
+        cached_analysis = analysis_cache.get(analysis_id)
+        if not cached_analysis:
+            return jsonify({"error": "Unknown or expired 'analysis_id'. Please re-run the analysis."}), 404
+        analysis_data = analysis_data or cached_analysis["sections"]
+        image_id = image_id or cached_analysis["image_id"]
+
+    if not (uploaded_image or image_id) or not analysis_data:
+        return jsonify({"error": "Missing 'image_data'/'image_id' or 'analysis_data'/'analysis_id' in request"}), 400
+
+    image_data = None
+    if not uploaded_image:
+        image_data = image_cache.get(image_id)
+        if image_data is None:
+            return jsonify({"error": "Unknown or expired 'image_id'. Please re-upload the image."}), 404
 
     # Validate analysis_data structure (optional but good practice)
     required_keys = ['metadata', 'semantic', 'layout', 'content_styling', 'ocr']
     if not all(key in analysis_data for key in required_keys):
         return jsonify({"error": "Incomplete 'analysis_data' provided."}), 400
 
-    print(f"Received SVG recreation request for model: {selected_model_name}")
+    logger.info("Received SVG recreation request for model: %s", selected_model_name)
+    job_mode = _wants_job(data)
+    stream = _wants_stream() and not job_mode
 
-    try:
-        # 1. Decode Image
-        header, encoded = image_data_url.split(",", 1)
-        image_data = base64.b64decode(encoded)
-        image = Image.open(BytesIO(image_data))
-
-        # 2. Construct Prompt
-        prompt_parts = [
-            "You are an expert SVG generator. Your task is to recreate the provided image as accurately as possible in SVG format, paying close attention to text content, formatting, and layout, using the provided analysis as a guide.",
-            "\n\n**Input Image:**",
-            image,
-            "\n\n**Image Analysis Results (Use this information heavily to guide the recreation):**",
-
-            "\n\n--- METADATA ANALYSIS ---",
-            analysis_data.get('metadata', 'N/A'),
-
-            "\n\n--- SEMANTIC ANALYSIS --- (Purpose/Meaning)",
-            analysis_data.get('semantic', 'N/A'),
-
-            "\n\n--- LAYOUT ANALYSIS --- (Structure/Placement)",
-            analysis_data.get('layout', 'N/A'),
-
-            "\n\n--- CONTENT & STYLING ANALYSIS --- (Text Content/Visuals)",
-            analysis_data.get('content_styling', 'N/A'),
-
-            "\n\n--- OCR ANALYSIS --- (Detailed Text/Structure)",
-            analysis_data.get('ocr', 'N/A'),
-
-            "\n\n**SVG Generation Instructions:**",
-            "1. Recreate the visual structure, element placement, shapes, colors, and styling based *primarily* on the image, using the analysis sections to clarify details and ensure accuracy.",
-            "2. **CRITICAL:** Accurately reproduce ALL text content identified in the OCR Analysis. Preserve its formatting (bold, italic), alignment, size, and relative positioning as described in the analysis. Use appropriate `<text>` elements with relevant attributes (`x`, `y`, `font-family`, `font-size`, `font-weight`, `font-style`, `fill`, `text-anchor`).",
-            "3. Use standard SVG elements (`<rect>`, `<circle>`, `<path>`, `<line>`, `<text>`, `<g>`, etc.).",
-            "4. The root `<svg>` element MUST include `xmlns=\"http://www.w3.org/2000/svg\"` and a relevant `viewBox` (estimate based on analysis or image aspect ratio, e.g., `viewBox=\"0 0 width height\"`).",
-            "5. Pay attention to layering (e.g., text should generally be on top of background shapes). Use `<g>` elements for grouping where logical.",
-            "6. Prioritize visual accuracy and clean, standard SVG code. Use presentation attributes (e.g., `fill`, `stroke`) over inline `style` attributes unless necessary.",
-            "7. Output ONLY the raw SVG code, starting strictly with `<svg` and ending strictly with `</svg>`. No markdown fences, no XML declaration, no comments, no other text.",
-        ]
-
-        # 3. Initialize Model and Generate
+    def run():
         try:
-            model = genai.GenerativeModel(selected_model_name)
-        except Exception as model_init_error:
-            print(f"Error initializing model '{selected_model_name}': {model_init_error}")
-            return jsonify({"error": f"Failed to initialize selected AI model: {selected_model_name}"}), 500
-
-        response = model.generate_content(
-            prompt_parts,
-            generation_config=generation_config # Use the global config
-        )
-
-        # 4. Process Response
-        if hasattr(response, 'text') and response.text:
-            cleaned_svg = _clean_svg_response(response.text)
-            if cleaned_svg:
-                return jsonify({"svg_code": cleaned_svg})
+            # 1. Decode and preprocess the image (images looked up by ID were preprocessed on upload)
+            image_stats = None
+            if image_data is None:
+                image, image_stats = image_utils.preprocess_image(uploaded_image)
             else:
-                # Cleaning failed
-                 print(f"Recreation cleaning failed. Raw response:\n{response.text}")
-                 return jsonify({"error": "Failed to extract valid SVG code from AI response."}), 500
-        else:
-            # Handle blocked or empty response
-            error_message = "AI generation failed during SVG recreation. Response was empty or blocked."
-            print(error_message)
-            # Consider adding more specific feedback if the API provides it
-            return jsonify({"error": error_message}), 500
-
-    except Exception as e:
-        print(f"Error during SVG recreation: {e}")
-        # Add more specific error checking if needed (like for API key errors during this call)
-        return jsonify({"error": "An internal error occurred during SVG recreation."}), 500
+                image = image_utils.image_blob(image_data)
+            response_metadata = {"image_stats": image_stats} if image_stats else {}
+
+            # 2. Construct Prompt (analysis sections trimmed to the token budget if needed)
+            prompt_parts, prompt_info = _conversion_prompt(image, analysis_data, selected_model_name)
+            response_metadata.update(_prompt_warnings(prompt_info))
+
+            if stream:
+                # 3. Stream the generation
+                return _stream_svg_response(selected_model_name, prompt_parts, "SVG recreation", metadata=response_metadata)
+
+            # 3-4. Generate and process the response
+            payload, status = _run_conversion(prompt_parts, selected_model_name)
+            if status == 200:
+                payload.update(response_metadata)
+            return payload, status
+
+        except Exception as e:
+            logger.exception("Error during SVG recreation: %s", e)
+            # Add more specific error checking if needed (like for API key errors during this call)
+            return {"error": "An internal error occurred during SVG recreation."}, 500
+
+    if job_mode:
+        return _job_response('convert_to_svg', run, data, uploaded_image)
+    result = run()
+    if isinstance(result, Response):
+        return result
+    payload, status = result
+    return jsonify(payload), status
 
 @app.route('/refine_svg', methods=['POST'])
 def refine_svg():
     """Handles SVG refinement requests."""
     if not api_key:
         return jsonify({"error": "API key not configured"}), 500
-    if not generation_config:
+    if model_registry is None:
         return jsonify({"error": "Generation config not set."}), 503
-    if not request.is_json:
-        return jsonify({"error": "Request must be JSON"}), 400
-
-    data = request.get_json()
+    # Accepts JSON with a `png_data` data URL, multipart with a `png_data` file, or a raw image/png body
+    try:
+        data = _request_fields()
+    except image_utils.UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     original_svg_code = data.get('svg_code')
     refinement_prompt = data.get('refinement_prompt', '') # Default to empty string
-    png_data_url = data.get('png_data') # Get optional PNG data URL
+    has_png = bool(data.get('png_data') or request.files.get('png_data') or request.mimetype.startswith('image/')) # Optional rendered PNG
+    # Without a client PNG, render one server-side (if a renderer is installed) unless `server_render` is false
+    server_render = not has_png and raster_utils.is_available() and _is_truthy(data.get('server_render', True))
     # Update default model here
     selected_model_name = data.get('model', 'gemini-2.5-flash-preview-04-17') # New Default
+    refine_mode = str(data.get('mode') or REFINE_MODE).lower()
+    render_size = data.get('render_size') or None # Long edge of the server-side render
 
     if not original_svg_code:
         return jsonify({"error": "Missing 'svg_code' in request"}), 400
+    if not isinstance(original_svg_code, str):
+        return jsonify({"error": "'svg_code' must be a string."}), 400
+    if refine_mode not in REFINE_MODES:
+        return jsonify({"error": f"Unknown 'mode' {refine_mode!r}; expected one of: {', '.join(REFINE_MODES)}."}), 400
+    if render_size is not None:
+        try:
+            render_size = int(render_size)
+        except (TypeError, ValueError):
+            return jsonify({"error": "'render_size' must be a whole number of pixels."}), 400
     # refinement_prompt is now optional
-
-    print(f"Received SVG refinement request for model: {selected_model_name}")
-    if png_data_url:
-        print("PNG data included for self-critique.")
+    model_error = _model_error(selected_model_name)
+    if model_error:
+        return model_error
+
+    logger.info("Received SVG refinement request for model: %s", selected_model_name)
+    if has_png:
+        logger.debug("PNG data included for self-critique.")
+    elif server_render:
+        logger.debug("Rendering PNG server-side for self-critique.")
+
+    # The upload is read here, while the request is open; everything after may run as a job
+    png_data = None
+    png_error = None
+    if has_png:
+        try:
+            png_data = _request_image(data, 'png_data')
+        except image_utils.UploadTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+        except ValueError as img_err: # Undecodable: refine without the preview
+            png_error = img_err
+    job_mode = _wants_job(data)
+    stream = _wants_stream() and not job_mode
+    patch_mode = refine_mode == 'patch' or (
+        refine_mode == 'auto' and len(original_svg_code.encode('utf-8')) >= REFINE_PATCH_MIN_BYTES)
+
+    def run():
+        try:
+            # --- Rendered PNG (client-supplied, or rendered here when the client sent none) ---
+            png_image = None
+            png_note = None
+            response_metadata = {}
+            if has_png:
+                try:
+                    if png_error:
+                        raise png_error
+                    png_image, image_stats = image_utils.preprocess_image(png_data)
+                    response_metadata["image_stats"] = image_stats
+                except Exception as img_err:
+                    logger.warning("Failed to decode/load PNG data: %s", img_err)
+                    png_note = "\n\n(Error loading rendered PNG preview)"
+            elif server_render:
+                try:
+                    # Rendered at the requested long edge and cached by SVG hash; already compact, so no preprocessing
+                    with span("svg_render"):
+                        rendered_png = raster_utils.render_png(original_svg_code, render_size)
+                    png_image = image_utils.image_blob(rendered_png)
+                    response_metadata["server_rendered"] = True
+                except (raster_utils.RasterizeError, ValueError) as render_err:
+                    logger.warning("Server-side SVG rendering failed: %s", render_err)
+                    png_note = "\n\n(Error rendering PNG preview)"
+
+            def full_prompt() -> tuple[List[Any], Dict[str, Any]]:
+                """Original SVG (minified/truncated to the token budget if needed), PNG and user instructions."""
+                prompt_parts, prompt_info = fit_prompt(
+                    lambda svg: format_refine_prompt(svg, refinement_prompt, png_image, png_note), original_svg_code,
+                    trim_svg_code, PROMPT_TOKEN_BUDGETS['refine'], _token_counter(selected_model_name)
+                )
+                return prompt_parts, _prompt_warnings(prompt_info)
+
+            if stream and patch_mode:
+                def patch_events() -> Iterator[str]:
+                    # A patch isn't SVG to stream: the applied result is the `done` event; a failed patch falls
+                    # back to a streamed full regeneration
+                    yield ": applying edit operations\n\n" # Sends the headers while the patch call runs
+                    try:
+                        payload, patch_fields = _refine_with_patch(original_svg_code, refinement_prompt, png_image,
+                                                                   png_note, selected_model_name)
+                        if payload is not None:
+                            yield _sse_event('done', {**payload, **response_metadata})
+                            return
+                        prompt_parts, warnings = full_prompt()
+                    except Exception as e:
+                        yield _sse_event('error', _error_payload(e, "streamed SVG refinement")[0])
+                        return
+                    yield from _svg_events(selected_model_name, prompt_parts, "SVG refinement", metadata={
+                        "refine_mode": "full", **response_metadata, **patch_fields, **warnings})
+                return _sse_response(patch_events())
+
+            # --- Patch mode: edit operations applied here; on failure, fall through to full regeneration ---
+            if patch_mode:
+                payload, patch_fields = _refine_with_patch(original_svg_code, refinement_prompt, png_image, png_note,
+                                                           selected_model_name)
+                if payload is not None:
+                    return {**payload, **response_metadata}, 200
+                response_metadata.update(patch_fields)
+
+            prompt_parts, warnings = full_prompt()
+            response_metadata.update(warnings)
+
+            # 2. Generate with the model's own defaults, retries and deadline
+            if stream:
+                return _stream_svg_response(selected_model_name, prompt_parts, "SVG refinement",
+                                            metadata={"refine_mode": "full", **response_metadata})
+
+            response, fallback = _call_model(selected_model_name, prompt_parts) # Send the list of parts
+            response_metadata.update(fallback)
+
+            # 3. Process Response
+            if hasattr(response, 'text') and response.text:
+                cleaned_svg = _clean_svg_response(response.text)
+                if cleaned_svg:
+                    cleaned_svg, optimization = _optimize_svg(cleaned_svg)
+                    return {"svg_code": cleaned_svg, "refine_mode": "full", **optimization, **_usage(response),
+                            **response_metadata}, 200
+                else:
+                    logger.warning("Refinement cleaning failed.") # The raw output is logged at the PAYLOAD level
+                    return {"error": "Failed to extract valid SVG code from refinement response."}, 500
+            else:
+                error_message = "AI generation failed during SVG refinement. Response was empty or blocked."
+                logger.warning(error_message)
+                return {"error": error_message}, 500
+
+        except Exception as e:
+            return _error_payload(e, "SVG refinement")
+
+    if job_mode:
+        return _job_response('refine_svg', run, data, png_data)
+    result = run()
+    if isinstance(result, Response):
+        return result
+    payload, status = result
+    return jsonify(payload), status
+
+@app.route('/image_to_svg', methods=['POST'])
+def image_to_svg():
+    """Analyses an image and converts it to SVG server-side in a single request.
+
+    Takes the same image upload formats as /analyze_image. Set `async` to get a job ID back immediately
+    (like every generation endpoint); set `include_analysis` to also return the intermediate sections.
+    """
+    if not api_key or model_registry is None:
+        return jsonify({"error": "AI SDK not configured or API key missing."}), 503
 
     try:
-        prompt_parts = [
-            f"You are an expert SVG editor performing a refinement task. "
-            f"You will analyze the provided original SVG code, its rendered appearance (shown in the PNG image), and optional user refinement instructions. "
-            f"Your goal is to improve the SVG based on both the user's feedback AND your own expert critique of the rendered PNG compared to common SVG best practices or the likely original intent."
-        ]
-
-        # --- Include Original SVG --- 
-        prompt_parts.extend([
-            f"\n\n**Original SVG Code:**\n```svg\n{original_svg_code}\n```\n"
-        ])
-
-        # --- Include Rendered PNG --- 
-        png_image = None
-        if png_data_url:
-            try:
-                header, encoded = png_data_url.split(",", 1)
-                png_data = base64.b64decode(encoded)
-                png_image = Image.open(BytesIO(png_data))
-                prompt_parts.extend([
-                    "\n\n**Rendered PNG of Original SVG:**",
-                    png_image,
-                    "(This image shows how the 'Original SVG Code' above currently renders.)"
-                ])
-            except Exception as img_err:
-                print(f"Warning: Failed to decode/load PNG data: {img_err}")
-                prompt_parts.append("\n\n(Error loading rendered PNG preview)")
-
-        # --- Include User Refinement Prompt --- 
-        prompt_parts.extend([
-            f"\n\n**User's Explicit Refinement Instructions:**\n{refinement_prompt if refinement_prompt else 'None provided.'}\n"
-        ])
-
-        # --- Include Detailed Instructions --- 
-        prompt_parts.extend([
-            f"\n\n**IMPORTANT Instructions for Refinement & Self-Correction:**\n",
-            f"1. **Analyze PNG vs SVG:** Compare the rendered PNG image to the Original SVG Code. Identify any discrepancies, rendering issues, or areas where the SVG deviates from expected visual quality (e.g., incorrect layering, alignment, text formatting, missing elements, unintended artifacts).",
-            f"2. **Self-Critique:** Based on your analysis in step 1, determine necessary corrections even if the user didn't mention them. Prioritize fixing obvious errors or significant visual deviations.",
-            f"3. **Apply User Feedback:** If the user provided explicit instructions, address them precisely.",
-            f"4. **Combine & Prioritize:** Integrate your self-corrections (from step 2) with the user's requested changes (from step 3). If there's a conflict, generally prioritize fixing rendering errors/major quality issues first, then apply user cosmetic requests.",
-            f"5. **Minimal Changes:** Apply only the necessary changes. Do NOT add unrelated elements or completely redesign.",
-            f"6. **Preserve Structure:** Maintain existing SVG structure (groups, IDs, classes) unless modification is essential for the fix.",
-            f"7. **Validity & Format:** Ensure the output is valid SVG code starting strictly with `<svg` and ending strictly with `</svg>`. No markdown, XML declaration, comments, or explanations."
-        ])
-
-        # 2. Initialize Model and Generate
-        try:
-            model = genai.GenerativeModel(selected_model_name)
-        except Exception as model_init_error:
-            print(f"Error initializing model '{selected_model_name}': {model_init_error}")
-            return jsonify({"error": f"Failed to initialize selected AI model: {selected_model_name}"}), 500
-
-        response = model.generate_content(
-            prompt_parts, # Send the list of parts
-            generation_config=generation_config
-        )
+        data = _request_fields()
+        image_data = _request_image(data, 'image_data')
+    except image_utils.UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not image_data:
+        return jsonify({"error": "No image data provided"}), 400
 
-        # 3. Process Response
-        if hasattr(response, 'text') and response.text:
-            cleaned_svg = _clean_svg_response(response.text)
-            if cleaned_svg:
-                return jsonify({"svg_code": cleaned_svg})
-            else:
-                print(f"Refinement cleaning failed. Raw response:\n{response.text}")
-                return jsonify({"error": "Failed to extract valid SVG code from refinement response."}), 500
-        else:
-            error_message = "AI generation failed during SVG refinement. Response was empty or blocked."
-            print(error_message)
-            return jsonify({"error": error_message}), 500
+    context_prompt = data.get('context_prompt', '')
+    analysis_model_name = data.get('analysis_model', 'gemini-2.0-flash')
+    selected_model_name = data.get('model', 'gemini-2.5-flash-preview-04-17')
+    model_error = _model_error(analysis_model_name, selected_model_name)
+    if model_error:
+        return model_error
+    include_analysis = _is_truthy(data.get('include_analysis', False))
+    structured = _is_truthy(data.get('structured', ANALYSIS_STRUCTURED_OUTPUT))
 
+    def run_pipeline():
+        return _image_to_svg_pipeline(image_data, context_prompt, analysis_model_name, selected_model_name,
+                                      include_analysis, structured)
+
+    if _wants_job(data):
+        return _job_response('image_to_svg', run_pipeline, data, image_data)
+
+    try:
+        payload, status = run_pipeline()
     except Exception as e:
-        print(f"Error during SVG refinement: {e}")
-        return jsonify({"error": "An internal error occurred during SVG refinement."}), 500
+        logger.exception("Error during image to SVG pipeline: %s", e)
+        return jsonify({"error": "An internal error occurred during image to SVG conversion."}), 500
+    return jsonify(payload), status
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Returns the status of a background job and, once finished, its result."""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown or expired job ID."}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Streams a job's progress as SSE: a `status` event per status change, then `done` with the finished job."""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown or expired job ID."}), 404
+
+    def event_stream():
+        current = job
+        last_status = None
+        while current is not None:
+            if current["status"] in job_utils.FINISHED_STATUSES:
+                yield _sse_event('done', current)
+                return
+            if current["status"] != last_status:
+                last_status = current["status"]
+                yield _sse_event('status', current)
+            else:
+                yield ": keep-alive\n\n" # Also lets the server notice a client that went away
+            # Woken early by jobs of this process; others are seen on the next check
+            jobs.wait(JOB_EVENTS_POLL_INTERVAL)
+            current = jobs.get(job_id)
+        yield _sse_event('error', {"error": "Unknown or expired job ID."})
+
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 # --- Run the App ---
 
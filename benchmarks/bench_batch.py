@@ -0,0 +1,65 @@
+"""Throughput of /generate_batch versus sequential /generate calls against the stub model.
+
+Usage:
+    python -m benchmarks.bench_batch [--items 200] [--latency 0.2] [--concurrency 1 8 32 64]
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault("GOOGLE_API_KEY", "stub-key")
+os.environ.setdefault("BATCH_CONCURRENCY", "256")
+
+from benchmarks import stub_model  # noqa: E402
+
+stub_model.install()
+
+import app as app_module  # noqa: E402
+
+
+def _items(count: int, run: str):
+    # Unique prompts so the response cache never short-circuits the model
+    return [{"prompt": f"icon {run}-{i}", "complexity": 3, "colorUsage": 3, "model": "gemini-2.0-flash"} for i in range(count)]
+
+
+def bench_sequential(client, count: int) -> float:
+    start = time.perf_counter()
+    for item in _items(count, "seq"):
+        response = client.post("/generate", json=item)
+        assert response.status_code == 200, response.get_json()
+    return time.perf_counter() - start
+
+
+def bench_batch(client, count: int, concurrency: int) -> float:
+    start = time.perf_counter()
+    response = client.post("/generate_batch", json={"items": _items(count, f"batch{concurrency}"), "concurrency": concurrency})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    elapsed = time.perf_counter() - start
+    assert lines[-1]["done"] and lines[-1]["errors"] == 0, lines[-1]
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean stub latency in seconds")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--sequential-items", type=int, default=20, help="Items for the sequential /generate baseline")
+    args = parser.parse_args()
+
+    stub_model.StubConfig.latency = args.latency
+    stub_model.StubConfig.jitter = args.latency / 4
+    client = app_module.app.test_client()
+
+    elapsed = bench_sequential(client, args.sequential_items)
+    print(f"{'mode':<26} {'items':>6} {'seconds':>8} {'items/s':>8}")
+    print(f"{'sequential /generate':<26} {args.sequential_items:>6} {elapsed:>8.2f} {args.sequential_items / elapsed:>8.1f}")
+    for concurrency in args.concurrency:
+        elapsed = bench_batch(client, args.items, concurrency)
+        label = f"/generate_batch c={concurrency}"
+        print(f"{label:<26} {args.items:>6} {elapsed:>8.2f} {args.items / elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""SVG extraction from model output: the single-pass expat extractor versus the previous regex.
+
+The regex version is the `_clean_svg_response` that app.py used before
+(`re.search(r'<svg.*?</svg>', ..., re.DOTALL | re.IGNORECASE)` plus fence
+stripping). Inputs cover large outputs, streamed chunks and adversarial text
+with many unclosed `<svg` openings, which makes the lazy match rescan to the
+end of the text from each one. `result bytes` shows where the regex cuts a
+nested or prose-quoted `<svg>` short (the full element is 178 bytes).
+
+Usage:
+    python -m benchmarks.bench_extract [--size-kb 500] [--repeat 5]
+"""
+import argparse
+import re
+import time
+
+import svg_utils
+
+
+def regex_clean(raw_text):
+    """The previous regex-based cleaner, without the logging."""
+    svg_code = raw_text.strip()
+    match = re.search(r'<svg.*?</svg>', svg_code, re.DOTALL | re.IGNORECASE)
+    if match:
+        svg_code = match.group(0)
+    else:
+        if svg_code.startswith("```"):
+            parts = svg_code.split('\n', 1)
+            svg_code = parts[1] if len(parts) > 1 else ''
+        if svg_code.endswith("```"):
+            svg_code = svg_code[:-3]
+        svg_code = svg_code.strip()
+    if svg_code.startswith('<svg') and svg_code.endswith('</svg>'):
+        return svg_code
+    return None
+
+
+def extractor_clean(raw_text):
+    return svg_utils.extract_svg(raw_text)[0]
+
+
+def extractor_clean_streamed(raw_text, chunk_size=256):
+    extractor = svg_utils.SvgExtractor()
+    for i in range(0, len(raw_text), chunk_size):
+        extractor.feed(raw_text[i:i + chunk_size])
+        if extractor.complete:
+            break
+    return extractor.close()[0]
+
+
+def _large_svg(size_kb: int) -> str:
+    path = '<path d="M10.123456 20.654321 C30.000000 40.000000 50.000000 60.000000 70.000000 80.000000 Z" fill="#336699"/>'
+    count = size_kb * 1024 // len(path)
+    return '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1000 1000">' + path * count + '</svg>'
+
+
+def _inputs(size_kb: int):
+    svg = _large_svg(size_kb)
+    nested = ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100">'
+              '<svg x="10" y="10" width="40" height="40"><rect width="10" height="10"/></svg>'
+              '<circle cx="70" cy="70" r="20"/></svg>')
+    return {
+        "large, fenced": f"Here is the SVG:\n```svg\n{svg}\n```\n",
+        "large + explanation": f"```svg\n{svg}\n```\n" + "This SVG uses paths for each shape. " * 2000,
+        "nested <svg>": f"```svg\n{nested}\n```",
+        "quoted <svg> in prose": f"Here is the `<svg>` code:\n```svg\n{nested}\n```",
+        # A model quoting many tags in prose, with the real document truncated
+        "adversarial": "Use <svg elements, e.g. " * (size_kb * 1024 // 200) + svg[: len(svg) // 2],
+    }
+
+
+def _time(fn, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-kb", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cleaners = {"regex": regex_clean, "extractor": extractor_clean, "extractor, streamed": extractor_clean_streamed}
+    print(f"{'input':<22} {'cleaner':<20} {'ms':>9} {'result bytes':>12}")
+    for name, text in _inputs(args.size_kb).items():
+        for cleaner_name, fn in cleaners.items():
+            elapsed, result = _time(fn, text, args.repeat)
+            size = len(result) if result is not None else "None"
+            print(f"{name:<22} {cleaner_name:<20} {elapsed * 1000:>9.2f} {size:>12}")
+
+
+if __name__ == "__main__":
+    main()
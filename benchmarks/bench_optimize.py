@@ -0,0 +1,61 @@
+"""Size reduction and run time of the SVG optimizer on the sample corpus.
+
+The corpus in benchmarks/corpus/ holds SVGs in the shape the models return them
+(6-decimal coordinates, repeated sibling attributes, empty groups, indentation).
+Add real outputs there as `.svg` files to measure on them too. When a renderer
+is installed, each optimized SVG is also rendered and compared pixel by pixel
+with the original (a 512px render; `px changed` counts pixels off by more than 8
+grey levels).
+
+Usage:
+    python -m benchmarks.bench_optimize [--repeat 20] [--precision 3]
+"""
+import argparse
+import glob
+import os
+import time
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+import raster_utils
+import svg_utils
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+
+
+def _changed_pixels(original: str, optimized: str) -> int:
+    """Number of pixels whose grey level differs by more than antialiasing noise between the two renders."""
+    renders = [Image.open(BytesIO(raster_utils.render_png(svg, 512))).convert("L") for svg in (original, optimized)]
+    return sum(ImageChops.difference(*renders).histogram()[9:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--precision", type=int, default=svg_utils.SVG_PRECISION)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(CORPUS_DIR, "*.svg")))
+    print(f"{'file':<20} {'mode':<9} {'bytes':>7} {'optimized':>9} {'saved':>6} {'ms':>7} {'px changed':>10}")
+    totals = {"lossless": [0, 0], "lossy": [0, 0]}
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            svg_code = f.read()
+        for mode in ("lossless", "lossy"):
+            lossless = mode == "lossless"
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                optimized, stats = svg_utils.optimize_svg(svg_code, precision=args.precision, lossless=lossless)
+            elapsed_ms = (time.perf_counter() - start) / args.repeat * 1000
+            diff = _changed_pixels(svg_code, optimized) if raster_utils.is_available() else "n/a"
+            totals[mode][0] += stats["original_bytes"]
+            totals[mode][1] += stats["optimized_bytes"]
+            print(f"{os.path.basename(path):<20} {mode:<9} {stats['original_bytes']:>7} {stats['optimized_bytes']:>9} "
+                  f"{stats['bytes_saved'] / stats['original_bytes']:>6.1%} {elapsed_ms:>7.2f} {diff:>10}")
+    for mode, (before, after) in totals.items():
+        print(f"{'total':<20} {mode:<9} {before:>7} {after:>9} {1 - after / before:>6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Tokens and latency of patch-mode versus full-regeneration /refine_svg on the sample corpus, against the stub model.
+
+For each SVG in benchmarks/corpus/, the same small edit (a fill change on the
+first element) is requested once as a full regeneration, where the stub answers
+with the whole edited document, and once as a patch, where it answers with a
+one-operation patch. The stub charges `--latency` per call plus
+`--ms-per-token` per output token (real models decode at very roughly 100-250
+tokens/s), so latency follows output size as it does upstream. `fallback` runs
+patch mode with a patch that doesn't apply, i.e. the cost of a failed patch
+plus the full regeneration that replaces it. `same` checks that both modes
+return the same SVG.
+
+Usage:
+    python -m benchmarks.bench_refine_patch [--repeat 3] [--latency 0.3] [--ms-per-token 5]
+"""
+import argparse
+import glob
+import os
+import statistics
+import time
+
+os.environ.setdefault("GOOGLE_API_KEY", "stub-key")
+os.environ.setdefault("LOG_LEVEL", "ERROR") # The fallback runs log a warning per request
+
+from benchmarks import stub_model  # noqa: E402
+
+stub_model.install()
+
+import app as app_module  # noqa: E402
+import svg_utils  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+BROKEN_PATCH = '{"ops": [{"op": "delete", "id": "e999999"}]}'
+
+
+def _refine(client, svg_code: str, mode: str, repeat: int):
+    """Returns the median latency (ms), the last response payload and its total prompt/output tokens."""
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        response = client.post("/refine_svg", json={"svg_code": svg_code, "refinement_prompt": f"make it red {i}",
+                                                     "mode": mode, "server_render": False})
+        latencies.append((time.perf_counter() - start) * 1000)
+        payload = response.get_json()
+        assert response.status_code == 200, payload
+    usages = [payload.get("usage", {}), payload.get("patch_usage", {})]
+    return (statistics.median(latencies), payload, sum(u.get("prompt_tokens", 0) for u in usages),
+            sum(u.get("output_tokens", 0) for u in usages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.3, help="Stub latency per call in seconds")
+    parser.add_argument("--ms-per-token", type=float, default=5.0, help="Stub decoding time per output token")
+    args = parser.parse_args()
+
+    stub_model.StubConfig.latency = args.latency
+    stub_model.StubConfig.jitter = 0.0
+    stub_model.StubConfig.seconds_per_output_token = args.ms_per_token / 1000
+    client = app_module.app.test_client()
+    ops = svg_utils.parse_patch(stub_model.SAMPLE_PATCH)
+
+    print(f"{'file':<20} {'bytes':>6} {'mode':<9} {'in tok':>7} {'out tok':>8} {'ms':>8} {'saved out':>9} "
+          f"{'saved ms':>8} {'same':>5}")
+    totals = {mode: [0, 0, 0.0] for mode in ("full", "patch", "fallback")}
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, "*.svg"))):
+        with open(path, encoding="utf-8") as f:
+            svg_code = f.read()
+        # The full regeneration returns what the patch produces, so both modes do the same edit
+        stub_model.StubConfig.svg_reply = svg_utils.apply_patch(svg_code, ops)
+        results = {}
+        for mode, patch_reply in (("full", None), ("patch", stub_model.SAMPLE_PATCH), ("fallback", BROKEN_PATCH)):
+            stub_model.StubConfig.patch_reply = patch_reply
+            results[mode] = _refine(client, svg_code, "full" if mode == "full" else "patch", args.repeat)
+            assert results[mode][1]["refine_mode"] == ("patch" if mode == "patch" else "full"), results[mode][1]
+        full_ms, full_payload, _, full_out = results["full"]
+        for mode, (ms, payload, tokens_in, tokens_out) in results.items():
+            totals[mode][0] += tokens_in
+            totals[mode][1] += tokens_out
+            totals[mode][2] += ms
+            same = "yes" if payload["svg_code"] == full_payload["svg_code"] else "NO"
+            print(f"{os.path.basename(path):<20} {len(svg_code):>6} {mode:<9} {tokens_in:>7} {tokens_out:>8} {ms:>8.0f} "
+                  f"{1 - tokens_out / full_out:>9.1%} {1 - ms / full_ms:>8.1%} {same:>5}")
+    _, full_out, full_ms = totals["full"]
+    for mode, (tokens_in, tokens_out, ms) in totals.items():
+        print(f"{'total':<20} {'':>6} {mode:<9} {tokens_in:>7} {tokens_out:>8} {ms:>8.0f} "
+              f"{1 - tokens_out / full_out:>9.1%} {1 - ms / full_ms:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
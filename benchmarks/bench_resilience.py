@@ -0,0 +1,91 @@
+"""Outcomes and latency of /generate under injected upstream faults, with and without retries and fallback.
+
+Each scenario sends `--requests` /generate calls from `--threads` client
+threads against the stub model with faults injected (see stub_model.StubConfig)
+and reports the share that succeeded, the error codes returned, latency
+percentiles and how many calls the fallback model served. Scenario models get
+fresh names, so every scenario starts with a closed circuit breaker.
+
+Usage:
+    python -m benchmarks.bench_resilience [--requests 200] [--threads 16] [--latency 0.05] [--timeout 2]
+"""
+import argparse
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("GOOGLE_API_KEY", "stub-key")
+
+from benchmarks import stub_model  # noqa: E402
+
+stub_model.install()
+
+import app as app_module  # noqa: E402
+import model_utils  # noqa: E402
+
+# name: (stub fault settings, retries, whether the model has a fallback)
+SCENARIOS = {
+    "healthy": ({}, 3, False),
+    "30% 503, no retries": ({"failure_rate": 0.3}, 0, False),
+    "30% 503, retries": ({"failure_rate": 0.3}, 3, False),
+    "30% 429, retries": ({"failure_rate": 0.3, "failure": stub_model.api_exceptions.TooManyRequests}, 3, False),
+    "10% hang": ({"hang_rate": 0.1}, 3, False),
+    "outage, no fallback": ({"failure_rate": 1.0}, 3, False),
+    "outage, fallback": ({"failure_rate": 1.0}, 3, True),
+}
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def run_scenario(client, index, faults, retries, with_fallback, args):
+    primary, fallback = f"primary-{index}", f"fallback-{index}"
+    config = {primary: {"timeout": args.timeout, "fallback": fallback if with_fallback else None},
+              fallback: {"timeout": args.timeout}}
+    app_module.model_registry = model_utils.ModelRegistry(config)
+    model_utils.MODEL_MAX_RETRIES = retries
+    for key, value in {"failure_rate": 0.0, "hang_rate": 0.0, "failure": stub_model.api_exceptions.ServiceUnavailable,
+                       **faults}.items():
+        setattr(stub_model.StubConfig, key, value)
+    stub_model.StubConfig.faulty_models = {primary}
+
+    def one(i):
+        start = time.perf_counter()
+        response = client.post("/generate", json={"prompt": f"icon {index}-{i}", "model": primary, "cache": False})
+        body = response.get_json()
+        outcome = "ok" if response.status_code == 200 else body.get("code", str(response.status_code))
+        return outcome, "fallback_model" in body, time.perf_counter() - start
+
+    with ThreadPoolExecutor(args.threads) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    outcomes = Counter(outcome for outcome, _, _ in results)
+    latencies = [latency for _, _, latency in results]
+    return outcomes, sum(used for _, used, _ in results), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean stub latency in seconds")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Per-request deadline in seconds")
+    args = parser.parse_args()
+
+    stub_model.StubConfig.latency = args.latency
+    stub_model.StubConfig.jitter = args.latency / 4
+    client = app_module.app.test_client()
+
+    print(f"{'scenario':<22} {'ok':>6} {'fallback':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}  errors")
+    for index, (name, (faults, retries, with_fallback)) in enumerate(SCENARIOS.items()):
+        outcomes, fallbacks, latencies = run_scenario(client, index, faults, retries, with_fallback, args)
+        errors = ", ".join(f"{code}: {count}" for code, count in outcomes.items() if code != "ok") or "-"
+        print(f"{name:<22} {outcomes['ok'] / args.requests:>6.1%} {fallbacks:>8} "
+              f"{_percentile(latencies, 50) * 1000:>8.0f} {_percentile(latencies, 95) * 1000:>8.0f} "
+              f"{max(latencies) * 1000:>8.0f}  {errors}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Wall-clock time and OCR accuracy of tiled versus single-call /analyze_image on synthetic dense images.
+
+Two images are drawn with known text: a long screenshot (a 1200x4800 table)
+and a dashboard (3200x2400, four columns of figures). Each is analysed once
+with `tiled: false` (one call on the image downscaled to IMAGE_MAX_EDGE) and
+once with `tiled: true` (an overview plus overlapping full-resolution tiles).
+Reported per mode: wall time, model calls, output tokens, and against the
+ground truth the share of text lines found in the OCR section (`recall`),
+lines reported more than once (`dupes`) and found lines whose box, mapped onto
+the whole image, lands on the true line (`boxes`; tiled mode only, since the
+single-call prompt asks for relative positions). `single*` is the single call
+with a reader that reads text of any size, i.e. the time one call would take
+to transcribe as much as the tiles do (stub only).
+
+By default the model is the stub, with a simulated reader standing in for it:
+it transcribes the lines that are wholly inside the image it is sent (or
+partly, where a tile edge cuts them) and at least `--legible-px` tall after
+downscaling, and charges `--ms-per-token` per output token on top of
+`--latency` per call. That measures the tiling, merging and coordinate mapping
+end to end, and the resolution effect only as modelled. With `--live`, the
+real model (GOOGLE_API_KEY) reads the images instead, which spends API quota.
+
+Usage:
+    python -m benchmarks.bench_tiled_analysis [--latency 1.0] [--ms-per-token 5] [--legible-px 9]
+        [--live --model gemini-2.0-flash]
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_SIZE = 16
+_TILE_RE = re.compile(r"covering pixels x (\d+)-(\d+), y (\d+)-(\d+)")
+_BOX_RE = re.compile(r"\[\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\]")
+
+
+def _draw(size, columns: int, pitch: int, seed: int):
+    """Draws rows of distinct text lines in `columns` columns; returns the image and [(text, box)]."""
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=FONT_SIZE)
+    lines = []
+    column_width = size[0] // columns
+    for column in range(columns):
+        for row, y in enumerate(range(24, size[1] - pitch, pitch)):
+            text = f"C{column}R{row:03d} INV-{rng.randint(10000, 99999)} {rng.choice('ABCDEFGH')}{rng.randint(10, 99)}.{rng.randint(10, 99)}"
+            x = column * column_width + 40
+            draw.text((x, y), text, fill="black", font=font)
+            lines.append((text, draw.textbbox((x, y), text, font=font)))
+    return image, lines
+
+
+def _data_url(image: Image.Image) -> str:
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def make_reader(lines, image_size, legible_px: float):
+    """A stand-in for the model's reading of the image it is sent (see the module docstring)."""
+    width, height = image_size
+
+    def read(parts, json_output: bool) -> str:
+        prompt = " ".join(part for part in parts if isinstance(part, str))
+        blob = next(part for part in parts if isinstance(part, dict))
+        received = Image.open(BytesIO(blob["data"])).size
+        tile = _TILE_RE.search(prompt)
+        left, right, top, bottom = (int(v) for v in tile.groups()) if tile else (0, width, 0, height)
+        scale = received[1] / (bottom - top)
+        ocr = []
+        for text, (x0, y0, x1, y1) in lines:
+            if y0 < top or y1 > bottom or x0 < left or x0 >= right or (y1 - y0) * scale < legible_px:
+                continue
+            visible = (min(x1, right) - x0) / (x1 - x0) # A tile edge may cut the line off
+            if visible < 0.3:
+                continue
+            text = text[:int(len(text) * visible)] if visible < 1 else text
+            if tile:
+                box = [round((y0 - top) / (bottom - top) * 1000), round((x0 - left) / (right - left) * 1000),
+                       round((y1 - top) / (bottom - top) * 1000), round((min(x1, right) - left) / (right - left) * 1000)]
+                ocr.append(f"- {text} {box}")
+            else:
+                ocr.append(f"- {text}")
+        sections = {"metadata": f"- Dimensions: {received[0]}x{received[1]}", "semantic": "- Rows of invoice figures.",
+                    "layout": "- Text lines stacked in columns.", "content_styling": "- Black text on white.",
+                    "ocr": "\n".join(ocr) or "No text detected."}
+        if json_output:
+            return json.dumps(sections)
+        return "\n\n".join(f"**{header}:**\n{sections[key]}" for key, header in (
+            ("metadata", "Metadata Analysis"), ("semantic", "Semantic Analysis"), ("layout", "Layout Analysis"),
+            ("content_styling", "Content & Styling Analysis"), ("ocr", "OCR Analysis")))
+
+    return read
+
+
+def score(ocr: str, lines, image_size, tiled: bool):
+    """Returns (recall, duplicate lines, share of found lines with a correct box or None)."""
+    width, height = image_size
+    found = duplicates = boxed = 0
+    ocr_lines = ocr.splitlines()
+    for text, (x0, y0, x1, y1) in lines:
+        matches = [line for line in ocr_lines if re.search(rf"(?<![\w-]){re.escape(text)}(?![\w.])", line)]
+        if not matches:
+            continue
+        found += 1
+        duplicates += len(matches) > 1
+        box = _BOX_RE.search(matches[0])
+        if box:
+            ymin, xmin, ymax, xmax = (int(v) for v in box.groups())
+            cx, cy = (xmin + xmax) / 2000 * width, (ymin + ymax) / 2000 * height
+            boxed += x0 - 4 <= cx <= x1 + 4 and y0 - 4 <= cy <= y1 + 4
+    return found / len(lines), duplicates, (boxed / found if tiled and found else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=1.0, help="Stub latency per call in seconds")
+    parser.add_argument("--ms-per-token", type=float, default=5.0, help="Stub decoding time per output token")
+    parser.add_argument("--legible-px", type=float, default=9.0, help="Smallest text height the simulated reader reads")
+    parser.add_argument("--live", action="store_true", help="Use the real model instead of the stub")
+    parser.add_argument("--model", default="gemini-2.0-flash")
+    args = parser.parse_args()
+
+    if not args.live:
+        os.environ.setdefault("GOOGLE_API_KEY", "stub-key")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    from benchmarks import stub_model
+    if not args.live:
+        stub_model.install()
+        stub_model.StubConfig.latency = args.latency
+        stub_model.StubConfig.jitter = 0.0
+        stub_model.StubConfig.seconds_per_output_token = args.ms_per_token / 1000
+    import app as app_module
+    client = app_module.app.test_client()
+
+    images = {"long_screenshot": _draw((1200, 4800), 1, 32, 1), "dashboard": _draw((3200, 2400), 4, 30, 2)}
+    print(f"{'image':<16} {'mode':<7} {'lines':>5} {'calls':>5} {'out tok':>7} {'seconds':>7} "
+          f"{'recall':>7} {'dupes':>5} {'boxes':>6}")
+    modes = [("single", False, args.legible_px), ("tiled", True, args.legible_px)]
+    if not args.live:
+        modes.insert(1, ("single*", False, 0.0))
+    for name, (image, lines) in images.items():
+        data_url = _data_url(image)
+        for mode, tiled, legible_px in modes:
+            stub_model.StubConfig.analysis_reader = make_reader(lines, image.size, legible_px)
+            start = time.perf_counter()
+            # A fresh context each run, so the analysis cache never answers
+            response = client.post("/analyze_image", json={"image_data": data_url, "model": args.model,
+                                                            "tiled": tiled, "context_prompt": f"bench {time.time()}"})
+            elapsed = time.perf_counter() - start
+            payload = response.get_json()
+            assert response.status_code == 200, payload
+            recall, duplicates, boxes = score(payload["ocr"], lines, image.size, tiled)
+            calls = payload.get("tiling", {}).get("calls", 1)
+            print(f"{name:<16} {mode:<7} {len(lines):>5} {calls:>5} "
+                  f"{payload.get('usage', {}).get('output_tokens', 0):>7} {elapsed:>7.2f} {recall:>7.1%} "
+                  f"{duplicates:>5} {'n/a' if boxes is None else f'{boxes:.1%}':>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compares request parsing cost of the three image upload formats.
+
+For each image size, builds a JSON body with a base64 data URL, a multipart
+body and a raw image/* body, then measures the time and peak Python heap
+(tracemalloc) needed to get from the WSGI request to the image bytes via the
+same helpers the routes use.
+
+Usage:
+    python -m benchmarks.bench_upload [--sizes-mb 5 10 20] [--repeat 3]
+"""
+import argparse
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("MAX_UPLOAD_BYTES", str(32 * 1024 * 1024))
+
+import app as app_module  # noqa: E402
+
+
+def _bodies(image: bytes):
+    data_url = "data:image/jpeg;base64," + base64.b64encode(image).decode("ascii")
+    json_body = json.dumps({"image_data": data_url, "context_prompt": "bench", "model": "bench"}).encode()
+
+    boundary = "benchboundary"
+    multipart_body = b"".join([
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"context_prompt\"\r\n\r\nbench\r\n".encode(),
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"image_data\"; filename=\"x.jpg\"\r\n"
+        "Content-Type: image/jpeg\r\n\r\n".encode(),
+        image,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return {
+        "json+base64": (json_body, "application/json", ""),
+        "multipart": (multipart_body, f"multipart/form-data; boundary={boundary}", ""),
+        "raw image/*": (image, "image/jpeg", "context_prompt=bench"),
+    }
+
+
+def _parse_once(body: bytes, content_type: str, query: str):
+    with app_module.app.test_request_context(
+        "/analyze_image", method="POST", data=body, content_type=content_type, query_string=query
+    ):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fields = app_module._request_fields()
+        image = app_module._request_image(fields, "image_data")
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak, len(image)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>6}  {'format':<12} {'parse ms':>9} {'peak MB':>8}")
+    for size_mb in args.sizes_mb:
+        image = os.urandom(int(size_mb * 1024 * 1024)) # Incompressible stand-in for image bytes
+        for name, (body, content_type, query) in _bodies(image).items():
+            runs = [_parse_once(body, content_type, query) for _ in range(args.repeat)]
+            best_time = min(r[0] for r in runs)
+            peak = max(r[1] for r in runs)
+            assert all(r[2] == len(image) for r in runs)
+            print(f"{size_mb:>5g}M  {name:<12} {best_time * 1000:>9.1f} {peak / 1024 / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
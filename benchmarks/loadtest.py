@@ -0,0 +1,256 @@
+"""Load test of the API endpoints under gunicorn, against the stub model (no API quota spent).
+
+For each `--configs` entry (WORKERSxTHREADS), starts gunicorn with gunicorn.conf.py
+serving benchmarks.stub_app, then drives one endpoint at a time with
+`--concurrency` client threads, each on its own keep-alive connection, for
+`--requests` requests after `--warmup` unmeasured ones. Every request is
+distinct (unique prompt or context), so the response caches don't answer in
+place of the model. Reported per endpoint: successes, errors, throughput,
+p50/p95/p99 latency and the peak RSS of the gunicorn master plus workers
+(sampled from /proc every 50 ms while the endpoint runs; Linux only).
+
+The stub's latency distribution and streaming are set with `--latency`,
+`--distribution`, `--sigma` and `--chunk-size` (see stub_model.StubConfig).
+With `--max-p95` and/or `--max-error-rate`, the command exits with status 1
+when any endpoint exceeds them, so it can gate a deploy.
+
+Usage:
+    python -m benchmarks.loadtest [--configs 1x16 2x32] [--endpoints generate analyze_image ...]
+        [--requests 300] [--concurrency 32] [--latency 0.2] [--distribution lognormal]
+        [--max-p95 MS] [--max-error-rate 0.01]
+"""
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+import prompt_utils
+from benchmarks import stub_model
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _image_data_url() -> str:
+    image = Image.linear_gradient("L").resize((768, 512)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _endpoints():
+    """Endpoint name -> function of the request index returning (path, JSON body)."""
+    image = _image_data_url()
+    sections, _ = prompt_utils.parse_analysis_sections(stub_model.SAMPLE_ANALYSIS)
+    with open(os.path.join(REPO_ROOT, "benchmarks", "corpus", "icon_gear.svg"), encoding="utf-8") as f:
+        svg_code = f.read()
+    return {
+        "generate": lambda i: ("/generate", {"prompt": f"load test icon {i}", "cache": False}),
+        "generate_stream": lambda i: ("/generate?stream=1", {"prompt": f"load test stream {i}", "cache": False}),
+        "analyze_image": lambda i: ("/analyze_image", {"image_data": image, "context_prompt": f"load test {i}",
+                                                       "model": "gemini-2.0-flash"}),
+        "convert_to_svg": lambda i: ("/convert_to_svg", {"image_data": image, "analysis_data": sections}),
+        "refine_svg": lambda i: ("/refine_svg", {"svg_code": svg_code, "refinement_prompt": f"variation {i}"}),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_bytes(root_pid: int) -> int:
+    """Resident memory of a process and its direct children (gunicorn master and workers)."""
+    pids = [root_pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # Field 4 (ppid) follows the parenthesised command name
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == root_pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Tracks the peak RSS of a process tree on a background thread."""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_bytes(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Server:
+    """A gunicorn process tree serving benchmarks.stub_app with the given workers and threads."""
+
+    def __init__(self, workers: int, threads: int, stub_env):
+        self.port = _free_port()
+        self.log = tempfile.TemporaryFile()
+        env = {**os.environ, **stub_env, "WEB_CONCURRENCY": str(workers), "GUNICORN_THREADS": str(threads),
+               "PORT": str(self.port), "GOOGLE_API_KEY": "stub-key"}
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "benchmarks.stub_app:app"],
+            cwd=REPO_ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+        self._wait_ready()
+
+    def _wait_ready(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=2)
+            try:
+                connection.request("GET", "/models")
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            finally:
+                connection.close()
+            time.sleep(0.2)
+        self.stop()
+        self.log.seek(0)
+        raise RuntimeError("gunicorn did not start:\n" + self.log.read().decode(errors="replace")[-2000:])
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def drive(port: int, request_for, count: int, concurrency: int, offset: int = 0):
+    """Sends `count` requests from `concurrency` threads; returns [(ok, latency seconds)] and the wall time."""
+    results = []
+    lock = threading.Lock()
+    next_index = iter(range(offset, offset + count))
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                break
+            path, body = request_for(i)
+            start = time.perf_counter()
+            try:
+                connection.request("POST", path, body=json.dumps(body), headers={"Content-Type": "application/json"})
+                response = connection.getresponse()
+                data = response.read()
+                # Streams always answer 200; their outcome is the terminal event
+                ok = response.status == 200 and (b"event: error" not in data)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+                ok = False
+            with lock:
+                results.append((ok, time.perf_counter() - start))
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--configs", nargs="+", default=["1x16", "2x32"], help="gunicorn WORKERSxTHREADS settings")
+    endpoints = _endpoints()
+    parser.add_argument("--endpoints", nargs="+", default=list(endpoints), choices=list(endpoints))
+    parser.add_argument("--requests", type=int, default=300, help="Measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=32, help="Client threads")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean stub latency in seconds")
+    parser.add_argument("--distribution", default="lognormal", choices=["uniform", "exponential", "lognormal"])
+    parser.add_argument("--sigma", type=float, default=0.5, help="Lognormal shape")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Characters per streamed chunk")
+    parser.add_argument("--max-p95", type=float, help="Fail if any endpoint's p95 exceeds this many ms")
+    parser.add_argument("--max-error-rate", type=float, help="Fail if any endpoint's error rate exceeds this share")
+    args = parser.parse_args()
+
+    stub_env = {"STUB_LATENCY": str(args.latency), "STUB_JITTER": str(args.latency / 4),
+                "STUB_DISTRIBUTION": args.distribution, "STUB_SIGMA": str(args.sigma),
+                "STUB_CHUNK_SIZE": str(args.chunk_size)}
+    failures = []
+    print(f"{'config':<8} {'endpoint':<16} {'ok':>6} {'errors':>6} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12}")
+    for config in args.configs:
+        workers, threads = (int(n) for n in config.lower().split("x"))
+        server = Server(workers, threads, stub_env)
+        try:
+            for name in args.endpoints:
+                request_for = endpoints[name]
+                drive(server.port, request_for, args.warmup, min(args.concurrency, args.warmup or 1), offset=10 ** 6)
+                with RssSampler(server.process.pid) as rss:
+                    results, elapsed = drive(server.port, request_for, args.requests, args.concurrency)
+                latencies = [latency * 1000 for _, latency in results]
+                ok = sum(1 for success, _ in results if success)
+                errors = len(results) - ok
+                p95 = _percentile(latencies, 95)
+                print(f"{config:<8} {name:<16} {ok:>6} {errors:>6} {len(results) / elapsed:>8.1f} "
+                      f"{_percentile(latencies, 50):>8.0f} {p95:>8.0f} {_percentile(latencies, 99):>8.0f} "
+                      f"{rss.peak / 2 ** 20:>12.1f}")
+                if args.max_p95 is not None and p95 > args.max_p95:
+                    failures.append(f"{config} {name}: p95 {p95:.0f} ms > {args.max_p95:.0f} ms")
+                if args.max_error_rate is not None and errors / len(results) > args.max_error_rate:
+                    failures.append(f"{config} {name}: error rate {errors / len(results):.1%} > {args.max_error_rate:.1%}")
+        finally:
+            server.stop()
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""WSGI entry point serving the real app against the stub model, for load tests under gunicorn.
+
+    gunicorn -c gunicorn.conf.py benchmarks.stub_app:app
+
+The stub is configured from STUB_* env vars (see stub_model.configure_from_env).
+"""
+import os
+
+os.environ.setdefault("GOOGLE_API_KEY", "stub-key")
+
+from benchmarks import stub_model  # noqa: E402
+
+stub_model.configure_from_env()
+stub_model.install()
+
+from app import app  # noqa: E402,F401
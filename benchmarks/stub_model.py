@@ -0,0 +1,199 @@
+"""Local stand-in for `genai.GenerativeModel` so benchmarks never spend API quota.
+
+`install()` swaps the SDK class for `StubModel`, which sleeps for a simulated
+latency and returns canned SVG or analysis text depending on the prompt.
+Import and install it before the first request is served.
+
+Latency follows `StubConfig.distribution`: "uniform" (mean +/- jitter),
+"exponential" or "lognormal" (mean `latency`, shape `sigma`; a long tail like
+real model calls). Streamed replies arrive in `chunk_size`-character chunks,
+with `first_chunk_share` of the latency spent before the first one. A
+`seconds_per_output_token` cost can be added on top, so that long replies
+(e.g. a whole regenerated SVG) take longer than short ones (e.g. a patch), as
+decoding does. Usage metadata counts prompt and reply tokens like
+`count_tokens` (4 characters per token, 258 per image).
+
+`analysis_reader` can stand in for the model's reading of the image, e.g. to
+score analyses against a known ground truth.
+
+Faults can be injected through StubConfig: a share of calls can fail with an
+upstream error (e.g. 503 or 429), or hang until they are cancelled. Setting
+`faulty_models` limits the faults to those models, e.g. to test the fallback.
+
+`configure_from_env()` reads the same settings from STUB_* env vars, for stubs
+installed in separate server processes (see benchmarks.stub_app).
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, List, Optional, Set
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+SAMPLE_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100">'
+    '<rect x="10.000000" y="10.000000" width="80.000000" height="80.000000" fill="#4a90e2" stroke="#000000"/>'
+    '<circle cx="50.000000" cy="50.000000" r="25.000000" fill="#ffffff" stroke="#000000"/>'
+    '</svg>'
+)
+
+SAMPLE_ANALYSIS = (
+    "**Metadata Analysis:**\n  - Dimensions: 800x600\n  - Key Colors: #4a90e2, #ffffff\n\n"
+    "**Semantic Analysis:**\n  - A blue card with a white circle.\n\n"
+    "**Layout Analysis:**\n  - Centered square with a circle in the middle.\n\n"
+    "**Content & Styling Analysis:**\n  - Flat, minimalist style.\n\n"
+    "**OCR Analysis:**\nNo text detected."
+)
+
+# A refinement patch (see svg_utils.apply_patch); e1 is the first element inside the root of any SVG with children
+SAMPLE_PATCH = json.dumps({"ops": [{"op": "set", "id": "e1", "attributes": [{"name": "fill", "value": "#e24a4a"}]}]})
+
+# The same analysis as returned in structured-output mode (`response_mime_type="application/json"`)
+SAMPLE_ANALYSIS_JSON = json.dumps({
+    "metadata": "- Dimensions: 800x600\n- Key Colors: #4a90e2, #ffffff",
+    "semantic": "- A blue card with a white circle.",
+    "layout": "- Centered square with a circle in the middle.",
+    "content_styling": "- Flat, minimalist style.",
+    "ocr": "No text detected.",
+})
+
+
+class StubConfig:
+    """Behaviour of every installed stub: latency in seconds, streaming, canned replies and injected faults."""
+    latency = 0.2 # Mean
+    jitter = 0.05 # "uniform" only
+    distribution = "uniform" # "uniform", "exponential" or "lognormal"
+    sigma = 0.5 # "lognormal" only
+    chunk_size = 64 # Characters per streamed chunk
+    first_chunk_share: Optional[float] = None # Share of the latency before the first chunk; None = evenly spread
+    seconds_per_output_token = 0.0 # Added to the latency per reply token
+    svg_reply = SAMPLE_SVG
+    patch_reply = SAMPLE_PATCH
+    # Replaces the canned analysis replies: called with the prompt parts and whether JSON output was asked for
+    analysis_reader: Optional[Callable[[List[Any], bool], str]] = None
+    analysis_reply = SAMPLE_ANALYSIS
+    analysis_json_reply = SAMPLE_ANALYSIS_JSON
+    calls = 0
+    failure_rate = 0.0 # Share of calls that raise `failure`
+    failure = api_exceptions.ServiceUnavailable
+    hang_rate = 0.0 # Share of (async) calls that never respond until cancelled
+    faulty_models: Optional[Set[str]] = None # Models the faults apply to; None = all
+
+
+def _prompt_text(contents: Any) -> str:
+    parts: List[Any] = contents if isinstance(contents, list) else [contents]
+    return " ".join(part for part in parts if isinstance(part, str))
+
+
+def _prompt_tokens(contents: Any) -> int:
+    parts: List[Any] = contents if isinstance(contents, list) else [contents]
+    return len(_prompt_text(contents)) // 4 + 258 * sum(1 for part in parts if not isinstance(part, str))
+
+
+def _reply_for(contents: Any, generation_config: Any = None) -> str:
+    prompt = _prompt_text(contents)
+    json_output = getattr(generation_config, "response_mime_type", None) == "application/json"
+    if "Analyze the following image" in prompt:
+        if StubConfig.analysis_reader is not None:
+            return StubConfig.analysis_reader(contents if isinstance(contents, list) else [contents], json_output)
+        return StubConfig.analysis_json_reply if json_output else StubConfig.analysis_reply
+    if "data-eid" in prompt and json_output:
+        return StubConfig.patch_reply
+    return StubConfig.svg_reply
+
+
+def _delay(reply: str = "") -> float:
+    output_cost = StubConfig.seconds_per_output_token * (len(reply) // 4)
+    if StubConfig.distribution == "exponential":
+        return output_cost + (random.expovariate(1 / StubConfig.latency) if StubConfig.latency > 0 else 0.0)
+    if StubConfig.distribution == "lognormal":
+        if StubConfig.latency <= 0:
+            return output_cost
+        # mu chosen so the distribution's mean is `latency`
+        mu = math.log(StubConfig.latency) - StubConfig.sigma ** 2 / 2
+        return output_cost + random.lognormvariate(mu, StubConfig.sigma)
+    return output_cost + max(0.0, StubConfig.latency + random.uniform(-StubConfig.jitter, StubConfig.jitter))
+
+
+def _response(text: str, prompt_tokens: int = 0) -> SimpleNamespace:
+    return SimpleNamespace(
+        text=text,
+        usage_metadata=SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4,
+                                       total_token_count=prompt_tokens + len(text) // 4),
+    )
+
+
+def _faulty(model_name: str) -> bool:
+    return StubConfig.faulty_models is None or model_name.removeprefix("models/") in StubConfig.faulty_models
+
+
+def _maybe_fail(model_name: str) -> None:
+    if _faulty(model_name) and random.random() < StubConfig.failure_rate:
+        raise StubConfig.failure("Injected stub failure")
+
+
+class StubModel:
+    """Drop-in for the subset of `genai.GenerativeModel` the app uses."""
+
+    def __init__(self, model_name: str = "stub", **kwargs: Any):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+    def generate_content(self, contents: Any, generation_config: Any = None, stream: bool = False, **kwargs: Any):
+        StubConfig.calls += 1
+        text = _reply_for(contents, generation_config)
+        time.sleep(_delay(text))
+        _maybe_fail(self.model_name)
+        response = _response(text, _prompt_tokens(contents))
+        return [response] if stream else response
+
+    async def generate_content_async(self, contents: Any, generation_config: Any = None, stream: bool = False, **kwargs: Any):
+        StubConfig.calls += 1
+        text = _reply_for(contents, generation_config)
+        if _faulty(self.model_name) and random.random() < StubConfig.hang_rate:
+            await asyncio.Event().wait()
+        if stream:
+            _maybe_fail(self.model_name)
+            return self._stream(text, _prompt_tokens(contents))
+        await asyncio.sleep(_delay(text))
+        _maybe_fail(self.model_name)
+        return _response(text, _prompt_tokens(contents))
+
+    async def _stream(self, text: str, prompt_tokens: int):
+        delay = _delay(text)
+        size = StubConfig.chunk_size
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        share = StubConfig.first_chunk_share
+        if share is None or len(chunks) == 1:
+            waits = [delay / len(chunks)] * len(chunks)
+        else:
+            waits = [delay * share] + [delay * (1 - share) / (len(chunks) - 1)] * (len(chunks) - 1)
+        for chunk, wait in zip(chunks, waits):
+            await asyncio.sleep(wait)
+            yield _response(chunk, prompt_tokens)
+
+    def count_tokens(self, contents: Any) -> SimpleNamespace:
+        return SimpleNamespace(total_tokens=_prompt_tokens(contents))
+
+    async def count_tokens_async(self, contents: Any) -> SimpleNamespace:
+        return self.count_tokens(contents)
+
+
+def configure_from_env() -> None:
+    """Sets StubConfig from STUB_LATENCY, STUB_JITTER, STUB_DISTRIBUTION, STUB_SIGMA, STUB_CHUNK_SIZE,
+    STUB_FIRST_CHUNK_SHARE, STUB_SECONDS_PER_OUTPUT_TOKEN, STUB_FAILURE_RATE and STUB_HANG_RATE, where given."""
+    for name, cast in (("latency", float), ("jitter", float), ("distribution", str), ("sigma", float),
+                       ("chunk_size", int), ("first_chunk_share", float), ("seconds_per_output_token", float),
+                       ("failure_rate", float), ("hang_rate", float)):
+        value = os.getenv(f"STUB_{name.upper()}")
+        if value:
+            setattr(StubConfig, name, cast(value))
+
+
+def install() -> None:
+    """Replaces `genai.GenerativeModel` with `StubModel` for the current process."""
+    genai.GenerativeModel = StubModel
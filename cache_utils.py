@@ -0,0 +1,206 @@
+"""Response caching and request coalescing.
+
+A `ResponseCache` has a bounded in-memory LRU tier with TTL and an optional
+SQLite tier on disk that every gunicorn worker on the host can share. Values
+must be JSON-serializable or raw `bytes`. `SingleFlight` collapses identical
+concurrent calls into one execution whose result is shared by all callers.
+
+Configuration (env vars):
+    RESPONSE_CACHE_SIZE: Max entries in each in-memory tier (default 256).
+    RESPONSE_CACHE_TTL: Entry lifetime in seconds (default 3600).
+    RESPONSE_CACHE_DB: Path of the shared SQLite file. Unset disables the disk tier.
+    IMAGE_CACHE_SIZE: Max uploaded images kept in memory (default 32).
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import metrics_utils
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB") or None
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "32"))
+
+CACHE_REQUESTS = metrics_utils.counter("cache_requests", "Cache lookups by cache and result (memory_hit, disk_hit, miss).",
+                                       ["cache", "result"])
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(*parts: Any) -> str:
+    """Builds a content-addressed key (SHA-256 hex) from JSON-serializable parts.
+
+    Non-JSON values (e.g. SDK config objects) are folded in through their `repr`.
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=repr, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCache:
+    """On-disk cache tier backed by SQLite, safe to share between processes."""
+
+    def __init__(self, path: str, namespace: str, ttl: float = RESPONSE_CACHE_TTL):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value NOT NULL, expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Yields a short-lived connection in a transaction, closed afterwards."""
+        # A short-lived connection per operation keeps this safe across threads and forked workers.
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+                return None
+            if isinstance(row[0], bytes):
+                return row[0]
+            return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, value if isinstance(value, bytes) else json.dumps(value), time.time() + self.ttl),
+            )
+
+
+class ResponseCache:
+    """Two-tier cache: in-memory LRU first, then the optional shared SQLite tier."""
+
+    def __init__(self, namespace: str, max_entries: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL, db_path: Optional[str] = RESPONSE_CACHE_DB):
+        self.namespace = namespace
+        self.memory = TTLCache(max_entries, ttl)
+        self.disk: Optional[SQLiteCache] = None
+        if db_path:
+            try:
+                self.disk = SQLiteCache(db_path, namespace, ttl)
+            except sqlite3.Error as e:
+                logger.warning("Disk cache '%s' unavailable, using memory only: %s", db_path, e)
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            CACHE_REQUESTS.inc(cache=self.namespace, result="miss" if value is None else "memory_hit")
+            return value
+        try:
+            value = self.disk.get(key)
+        except sqlite3.Error as e:
+            logger.warning("Disk cache read failed: %s", e)
+            value = None
+        CACHE_REQUESTS.inc(cache=self.namespace, result="miss" if value is None else "disk_hit")
+        if value is not None:
+            self.memory.set(key, value) # Promote to the memory tier
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                logger.warning("Disk cache write failed: %s", e)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single execution."""
+
+    def __init__(self):
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Runs `fn` unless a call with the same key is already running, in which case its result is shared."""
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def join(self, key: str) -> Tuple[Future, bool]:
+        """Returns the future of the call already running under `key` and False, or registers a new call and
+        returns its future and True; the caller then leads it and must complete it with `finish`.
+
+        For callers that can't hand the work over as a function, e.g. a generator streaming the result.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = self._in_flight[key] = Future()
+            return future, True
+
+    def finish(self, key: str, future: Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        """Completes a call registered by `join`, handing its result (or error) to every caller waiting on it."""
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
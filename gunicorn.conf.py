@@ -0,0 +1,20 @@
+# Gunicorn settings for serving many concurrent Gemini calls per process.
+#
+# Model calls run on a per-process asyncio loop (see model_utils.py), so each
+# request thread just waits on a future while the loop multiplexes the network
+# I/O. gthread workers make those waiting threads cheap; size GUNICORN_THREADS
+# to roughly MAX_CONCURRENT_MODEL_CALLS so neither side is the bottleneck.
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", os.getenv("MAX_CONCURRENT_MODEL_CALLS", "64")))
+# Model round-trips routinely take 20-60 s; give them room before the worker is recycled.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+
+def on_starting(server):
+    # With METRICS_DIR set, workers share their metrics through files there; drop the previous run's
+    import metrics_utils
+    metrics_utils.clear_dir()
@@ -0,0 +1,300 @@
+"""Image preprocessing shared by the multimodal endpoints.
+
+Uploads are downscaled to a target long edge, stripped of metadata and
+re-encoded compactly before they reach the model: as PNG if transparent,
+palette or screenshot-like, else as JPEG. A PNG or JPEG that needs no resizing
+is sent as uploaded, minus its metadata, unless the re-encode is smaller. The
+result is an inline blob dict (`{"mime_type": ..., "data": ...}`) that the SDK
+sends as-is. Passing a PIL image instead would make the SDK re-encode it as
+lossless WebP on every call.
+
+Tiling: images that downscaling would make illegible (very large, or long
+screenshots) can instead be cut into overlapping tiles at close to their full
+resolution, each analysed separately (see `should_tile` and `crop_tiles`).
+
+Configuration (env vars):
+    IMAGE_MAX_EDGE: Target long edge in pixels (default 1536).
+    IMAGE_JPEG_QUALITY: JPEG quality for opaque photographic images (default 88).
+    MAX_UPLOAD_BYTES: Largest accepted image upload in bytes (default 20 MB).
+    ANALYSIS_TILE_MIN_ASPECT: Images with a long edge above IMAGE_MAX_EDGE are tiled from this
+        long/short edge ratio (default 2.5)...
+    ANALYSIS_TILE_MIN_PIXELS: ...or, if set, from this many pixels (default 0: off). Camera
+        photos and screenshots of 12+ MP are usually legible once downscaled, and tiling one
+        costs an overview plus a dozen tile calls.
+    ANALYSIS_TILE_SIZE: Tile edge in original pixels (default 1024).
+    ANALYSIS_TILE_OVERLAP: Minimum overlap of neighbouring tiles in pixels (default 128).
+    ANALYSIS_MAX_TILES: Most tiles per image; tiles grow beyond ANALYSIS_TILE_SIZE to stay
+        within it (default 12).
+"""
+import base64
+import binascii
+import math
+import os
+from io import BytesIO
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+from PIL import ExifTags, Image, ImageOps
+
+from metrics_utils import span
+
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "88"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+ANALYSIS_TILE_MIN_ASPECT = float(os.getenv("ANALYSIS_TILE_MIN_ASPECT", "2.5"))
+ANALYSIS_TILE_MIN_PIXELS = int(os.getenv("ANALYSIS_TILE_MIN_PIXELS", "0"))
+ANALYSIS_TILE_SIZE = int(os.getenv("ANALYSIS_TILE_SIZE", "1024"))
+ANALYSIS_TILE_OVERLAP = int(os.getenv("ANALYSIS_TILE_OVERLAP", "128"))
+ANALYSIS_MAX_TILES = int(os.getenv("ANALYSIS_MAX_TILES", "12"))
+
+# (left, top, right, bottom) in pixels of the original image
+Box = Tuple[int, int, int, int]
+
+_READ_CHUNK_BYTES = 256 * 1024
+# Opaque images with at most this many colours are screenshot-like and encoded as PNG
+_FLAT_MAX_COLORS = 4096
+# Modes whose PNG/JPEG originals can be sent unchanged
+_REUSABLE_MODES = ("1", "L", "P", "RGB", "RGBA", "LA")
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_KEPT_CHUNKS = (b"IHDR", b"PLTE", b"tRNS", b"IDAT", b"IEND", b"gAMA", b"cHRM", b"sRGB")
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an uploaded image exceeds MAX_UPLOAD_BYTES."""
+
+
+def read_limited(stream: IO[bytes], limit: int = MAX_UPLOAD_BYTES) -> bytes:
+    """Reads a binary stream in chunks, failing as soon as more than `limit` bytes arrive."""
+    chunks = []
+    total = 0
+    while True:
+        chunk = stream.read(_READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            raise UploadTooLarge(f"Image upload exceeds the {limit} byte limit.")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def decode_data_url(data_url: str, limit: int = MAX_UPLOAD_BYTES) -> bytes:
+    """Decodes a base64 `data:` URL (the legacy JSON upload format)."""
+    try:
+        header, encoded = data_url.split(",", 1)
+    except ValueError:
+        raise ValueError("Image data must be a base64 data URL.")
+    # Check the decoded size up front instead of after allocating it
+    if len(encoded) * 3 // 4 > limit:
+        raise UploadTooLarge(f"Image upload exceeds the {limit} byte limit.")
+    try:
+        with span("base64_decode"):
+            return base64.b64decode(encoded)
+    except binascii.Error as e:
+        raise ValueError(f"Invalid base64 image data: {e}")
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def _is_flat(image: Image.Image) -> bool:
+    """Palette images and screenshot-like ones (UI, text, diagrams: few distinct colours), which PNG keeps
+    sharp and usually compresses better than JPEG."""
+    if image.mode in ("P", "1"):
+        return True
+    return image.getcolors(maxcolors=_FLAT_MAX_COLORS) is not None
+
+
+def _encode(image: Image.Image, jpeg_quality: int) -> Tuple[str, bytes]:
+    """Encodes as PNG if the image has transparency or is flat (see `_is_flat`), else as JPEG; saving without
+    exif/icc_profile/pnginfo drops all metadata."""
+    output = BytesIO()
+    if _has_alpha(image):
+        image.convert("RGBA").save(output, format="PNG", optimize=True)
+        return "image/png", output.getvalue()
+    if _is_flat(image):
+        flat = image if image.mode in ("P", "1", "L") else image.convert("RGB")
+        flat.save(output, format="PNG", optimize=True)
+        return "image/png", output.getvalue()
+    image.convert("RGB").save(output, format="JPEG", quality=jpeg_quality, optimize=True)
+    return "image/jpeg", output.getvalue()
+
+
+def _strip_png(data: bytes) -> Optional[bytes]:
+    """Drops the ancillary PNG chunks other than transparency and colour (text, EXIF, timestamps...)."""
+    if not data.startswith(_PNG_SIGNATURE):
+        return None
+    kept = [_PNG_SIGNATURE]
+    offset = len(_PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length = int.from_bytes(data[offset:offset + 4], "big")
+        chunk_type = data[offset + 4:offset + 8]
+        end = offset + 12 + length
+        if end > len(data):
+            return None
+        if chunk_type in _PNG_KEPT_CHUNKS:
+            kept.append(data[offset:end])
+        offset = end
+        if chunk_type == b"IEND":
+            return b"".join(kept)
+    return None
+
+
+def _strip_jpeg(data: bytes) -> Optional[bytes]:
+    """Drops the APPn segments other than JFIF (APP0) and Adobe (APP14), and comments, before the scan data."""
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    kept = [b"\xff\xd8"]
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF: # Fill byte
+            offset += 1
+            continue
+        if marker == 0xDA: # Start of scan: the rest is image data
+            kept.append(data[offset:])
+            return b"".join(kept)
+        end = offset + 2 + int.from_bytes(data[offset + 2:offset + 4], "big")
+        if end > len(data):
+            return None
+        if not (0xE1 <= marker <= 0xEF and marker != 0xEE or marker == 0xFE):
+            kept.append(data[offset:end])
+        offset = end
+    return None
+
+
+def _strip_metadata(image_data: bytes, image_format: Optional[str]) -> Optional[Tuple[str, bytes]]:
+    """The original PNG or JPEG bytes without their metadata, or None for other formats or malformed files."""
+    if image_format == "PNG":
+        stripped = _strip_png(image_data)
+        return ("image/png", stripped) if stripped else None
+    if image_format == "JPEG":
+        stripped = _strip_jpeg(image_data)
+        return ("image/jpeg", stripped) if stripped else None
+    return None
+
+
+def preprocess_image(image_data: bytes, max_edge: int = IMAGE_MAX_EDGE,
+                     jpeg_quality: int = IMAGE_JPEG_QUALITY) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Downscales, normalises and re-encodes an uploaded image for a model call.
+
+    Args:
+        image_data: The raw uploaded image bytes.
+        max_edge: The longest edge of the output, in pixels.
+        jpeg_quality: Quality used when the output is encoded as JPEG.
+
+    Returns:
+        A tuple of the inline blob dict for the prompt and a stats dict with
+        before/after byte and pixel counts.
+    """
+    with span("image_decode"):
+        image = Image.open(BytesIO(image_data))
+        original_size = image.size
+        # Already small enough, upright and in a format and mode the model takes: the original bytes may do
+        reusable = (max(image.size) <= max_edge and image.mode in _REUSABLE_MODES
+                    and not getattr(image, "is_animated", False)
+                    and image.getexif().get(ExifTags.Base.Orientation, 1) == 1)
+        image_format = image.format
+
+        if max(image.size) > max_edge:
+            # JPEG only: let the decoder scale down by a power of two instead of decoding full resolution
+            image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image) # Phone photos: apply the orientation before EXIF is dropped
+
+        if max(image.size) > max_edge:
+            # Cheap integer box reduction first, then a high-quality resize for the remainder
+            factor = max(image.size) // max_edge
+            if factor >= 2:
+                image = image.reduce(factor)
+            if max(image.size) > max_edge:
+                image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    with span("image_encode"):
+        mime_type, processed = _encode(image, jpeg_quality)
+        original = _strip_metadata(image_data, image_format) if reusable else None
+        if original and len(original[1]) <= len(processed): # Re-encoding only adds bytes (and JPEG artifacts)
+            mime_type, processed = original
+
+    stats = {
+        "original_bytes": len(image_data),
+        "processed_bytes": len(processed),
+        "original_size": list(original_size),
+        "processed_size": list(image.size),
+        "original_pixels": original_size[0] * original_size[1],
+        "processed_pixels": image.size[0] * image.size[1],
+        "mime_type": mime_type,
+    }
+    return {"mime_type": mime_type, "data": processed}, stats
+
+
+def image_blob(image_data: bytes) -> Dict[str, Any]:
+    """Wraps already-preprocessed image bytes in an inline blob dict, sniffing the MIME type from the header."""
+    with Image.open(BytesIO(image_data)) as image:
+        mime_type = Image.MIME.get(image.format, "image/png")
+    return {"mime_type": mime_type, "data": image_data}
+
+
+def image_size(image_data: bytes) -> Tuple[int, int]:
+    """Returns an image's (width, height) as displayed (after EXIF rotation) from its header, without decoding
+    the pixels."""
+    with Image.open(BytesIO(image_data)) as image:
+        width, height = image.size
+        # Orientations 5-8 rotate by 90 degrees
+        return (height, width) if image.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8) else (width, height)
+
+
+def should_tile(size: Tuple[int, int], max_edge: int = IMAGE_MAX_EDGE) -> bool:
+    """Whether an image of this size loses enough detail when downscaled to `max_edge` to be analysed in tiles."""
+    long_edge, short_edge = max(size), max(1, min(size))
+    if long_edge <= max_edge:
+        return False # Sent at full resolution anyway
+    if long_edge / short_edge >= ANALYSIS_TILE_MIN_ASPECT:
+        return True
+    return 0 < ANALYSIS_TILE_MIN_PIXELS <= size[0] * size[1]
+
+
+def _tile_spans(length: int, tile: int, overlap: int) -> List[Tuple[int, int]]:
+    """Splits one axis into the fewest equal spans of at most `tile` pixels (one span up to 25% longer is
+    kept whole) that overlap their neighbours by `overlap` pixels."""
+    if length <= tile * 1.25:
+        return [(0, length)]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    span_length = math.ceil((length + (count - 1) * overlap) / count)
+    starts = [round(i * (length - span_length) / (count - 1)) for i in range(count)]
+    return [(start, start + span_length) for start in starts]
+
+
+def plan_tiles(size: Tuple[int, int], tile_size: int = ANALYSIS_TILE_SIZE, overlap: int = ANALYSIS_TILE_OVERLAP,
+               max_tiles: int = ANALYSIS_MAX_TILES) -> List[Box]:
+    """Splits an image of `size` into overlapping tile boxes in reading order (rows top to bottom, then left to right).
+
+    Tiles are at most `tile_size` on each side, grown in 25% steps while more than `max_tiles` would be needed.
+    """
+    width, height = size
+    overlap = max(0, min(overlap, tile_size // 2))
+    while True:
+        columns = _tile_spans(width, tile_size, overlap)
+        rows = _tile_spans(height, tile_size, overlap)
+        if len(columns) * len(rows) <= max(1, max_tiles):
+            break
+        tile_size = math.ceil(tile_size * 1.25)
+    return [(left, top, right, bottom) for top, bottom in rows for left, right in columns]
+
+
+def crop_tiles(image_data: bytes, boxes: List[Box], max_edge: int = IMAGE_MAX_EDGE,
+               jpeg_quality: int = IMAGE_JPEG_QUALITY) -> List[Dict[str, Any]]:
+    """Crops `boxes` (from `plan_tiles` on `image_size`) out of the full-resolution image as inline blob dicts,
+    each downscaled to `max_edge` only if the tile is larger."""
+    with span("image_decode"):
+        image = ImageOps.exif_transpose(Image.open(BytesIO(image_data))) # Same orientation as `image_size`
+    tiles = []
+    with span("image_encode"):
+        for box in boxes:
+            tile = image.crop(box)
+            if max(tile.size) > max_edge:
+                tile.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            mime_type, data = _encode(tile, jpeg_quality)
+            tiles.append({"mime_type": mime_type, "data": data})
+    return tiles
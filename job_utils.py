@@ -0,0 +1,185 @@
+"""Background jobs for long-running model pipelines.
+
+A job wraps a callable that returns `(payload, http_status)`, the same shape
+the route helpers in app.py return. It runs on a bounded thread pool in the
+process that accepted it; clients get a job ID right away and poll
+`/jobs/<id>` or subscribe to `/jobs/<id>/events` for the result.
+
+Job records (status and result) are kept in a SQLite file that every gunicorn
+worker on the host shares, so any worker can answer for any job and results
+outlive the request, and the worker, that created them. A job left queued or
+running by a process that has since exited is reported as failed
+("interrupted"). Finished jobs are purged JOB_TTL seconds after they finish.
+
+Idempotency: a submission with an idempotency key returns the job already
+created under that key, for as long as it is kept, instead of starting the
+work again. Reusing a key for a different request raises `IdempotencyConflict`.
+
+Configuration (env vars):
+    JOB_WORKERS: Max jobs executing at once per process (default 8).
+    JOB_TTL: Seconds a finished job's result is kept (default 3600).
+    JOB_DB: Path of the shared SQLite file (default `svg_jobs.sqlite3` in the temp directory);
+        "off" keeps jobs in the memory of the process that created them.
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+JOB_DB = os.getenv("JOB_DB") or os.path.join(tempfile.gettempdir(), "svg_jobs.sqlite3")
+
+FINISHED_STATUSES = ("succeeded", "failed")
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyConflict(ValueError):
+    """Raised when an idempotency key is reused for a different request."""
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # Exists, owned by another user
+    return True
+
+
+class JobStore:
+    """Runs jobs on a thread pool and keeps their status and results in SQLite until they expire."""
+
+    def __init__(self, max_workers: int = JOB_WORKERS, ttl: float = JOB_TTL, db_path: str = JOB_DB):
+        self.ttl = ttl
+        self.path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        # Notified whenever a job run by this process changes status, to wake event subscribers early
+        self._changed = threading.Condition()
+        self._memory: Optional[sqlite3.Connection] = None
+        if db_path == "off":
+            self._memory = sqlite3.connect(":memory:", check_same_thread=False)
+        with self._connect() as conn:
+            if self._memory is None:
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY, idempotency_key TEXT UNIQUE, request_hash TEXT,"
+                " pid INTEGER NOT NULL, job TEXT NOT NULL, expires_at REAL)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Yields a connection in a transaction: the process's in-memory one, or a short-lived one to the file."""
+        if self._memory is not None:
+            with self._lock, self._memory:
+                yield self._memory
+            return
+        # A short-lived connection per operation keeps this safe across threads and forked workers.
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def submit(self, kind: str, fn: Callable[[], Tuple[Dict[str, Any], int]], idempotency_key: Optional[str] = None,
+               request_hash: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+        """Queues `fn` as a new job, unless `idempotency_key` already names one.
+
+        Args:
+            kind: Short job type shown to clients, e.g. the endpoint name.
+            fn: The work; returns the result payload and HTTP status.
+            idempotency_key: Client-chosen key identifying this request across retries.
+            request_hash: Fingerprint of the request, to tell a retry from a reused key.
+
+        Returns:
+            A snapshot of the job and whether this call created it.
+
+        Raises:
+            IdempotencyConflict: If the key belongs to a job for a different request.
+        """
+        now = time.time()
+        job = {"job_id": uuid.uuid4().hex, "kind": kind, "status": "queued", "created_at": now}
+        existing = None
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+            try:
+                conn.execute(
+                    "INSERT INTO jobs (job_id, idempotency_key, request_hash, pid, job) VALUES (?, ?, ?, ?, ?)",
+                    (job["job_id"], idempotency_key, request_hash, os.getpid(), json.dumps(job)),
+                )
+            except sqlite3.IntegrityError: # Only the idempotency key can collide
+                request, pid, stored = conn.execute(
+                    "SELECT request_hash, pid, job FROM jobs WHERE idempotency_key = ?", (idempotency_key,)
+                ).fetchone()
+                if request != request_hash:
+                    raise IdempotencyConflict("This Idempotency-Key was already used for a different request.")
+                existing = (json.loads(stored), pid)
+        if existing is not None:
+            return self._check_owner(*existing), False
+        self._executor.submit(self._run, job["job_id"], fn)
+        return job, True
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Returns a snapshot of the job, or None if it is unknown or expired."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT job, pid FROM jobs WHERE job_id = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (job_id, time.time()),
+            ).fetchone()
+        return self._check_owner(json.loads(row[0]), row[1]) if row else None
+
+    def wait(self, timeout: float) -> None:
+        """Blocks until a job run by this process changes status, or for at most `timeout` seconds."""
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def _check_owner(self, job: Dict[str, Any], pid: int) -> Dict[str, Any]:
+        """Fails an unfinished job whose process is gone (e.g. a recycled worker), since nothing will finish it."""
+        if job["status"] in FINISHED_STATUSES or pid == os.getpid() or _is_alive(pid):
+            return job
+        fields = {"status": "failed", "http_status": 500, "finished_at": time.time(),
+                  "result": {"error": "The job was interrupted before it finished. Please submit it again."}}
+        self._update(job["job_id"], **fields)
+        return {**job, **fields}
+
+    def _run(self, job_id: str, fn: Callable[[], Tuple[Dict[str, Any], int]]) -> None:
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            payload, http_status = fn()
+        except Exception as e:
+            logger.exception("Error in background job %s: %s", job_id, e)
+            payload, http_status = {"error": "An internal error occurred while running the job."}, 500
+        self._update(
+            job_id,
+            status="succeeded" if http_status < 400 else "failed",
+            result=payload,
+            http_status=http_status,
+            finished_at=time.time(),
+        )
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT job FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                if row is None:
+                    return
+                job = {**json.loads(row[0]), **fields}
+                expires_at = job["finished_at"] + self.ttl if job.get("finished_at") is not None else None
+                conn.execute("UPDATE jobs SET job = ?, expires_at = ? WHERE job_id = ?",
+                             (json.dumps(job), expires_at, job_id))
+        except sqlite3.Error as e:
+            logger.error("Failed to record the status of job %s: %s", job_id, e)
+        with self._changed:
+            self._changed.notify_all()
@@ -0,0 +1,286 @@
+"""Prometheus metrics and per-request timing spans, without external dependencies.
+
+Modules declare their metrics at import with `counter()` / `histogram()` and
+update them inline; `render()` returns every metric in the Prometheus text
+exposition format for the /metrics endpoint. `span(stage)` times one stage of
+a request (JSON parse, image decode, prompt build, model call, SVG clean, ...)
+into the `stage_duration_seconds` histogram and, inside a request started
+with `start_trace()`, also into that request's trace for the request log line.
+
+Metrics live in process memory. With several gunicorn workers, set
+METRICS_DIR to a directory shared by the workers of one host: each worker
+then writes its totals there every METRICS_FLUSH_INTERVAL seconds (default 5)
+and /metrics serves the sum over all of them, like prometheus_client's
+multiprocess mode. gunicorn.conf.py clears the directory when the server starts.
+
+Configuration (env vars):
+    METRICS_DIR: Directory for the per-worker metric files. Unset keeps metrics per process.
+    METRICS_FLUSH_INTERVAL: Seconds between a worker's writes to METRICS_DIR (default 5).
+"""
+import contextvars
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRICS_DIR = os.getenv("METRICS_DIR") or None
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# Seconds; model round-trips run up to minutes, local stages take microseconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Counter:
+    """A monotonically increasing count per combination of label values."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+        _ensure_flusher()
+
+    def snapshot(self) -> Dict[LabelValues, Any]:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total: Any, value: Any) -> Any:
+        return total + value
+
+    def samples(self, values: Dict[LabelValues, Any]) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        for key, value in values.items():
+            yield self.name + "_total", dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, with their sum and count, per combination of label values."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._values: Dict[LabelValues, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+        _ensure_flusher()
+
+    def snapshot(self) -> Dict[LabelValues, Any]:
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def merge(total: Any, value: Any) -> Any:
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1]]
+
+    def samples(self, values: Dict[LabelValues, Any]) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        for key, (counts, total) in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", {**labels, "le": _format_bound(bound)}, cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+_metrics: Dict[str, Any] = {}
+_metrics_lock = threading.Lock()
+
+
+def _register(metric: Any) -> Any:
+    with _metrics_lock:
+        existing = _metrics.get(metric.name)
+        if existing is not None:
+            return existing # Re-imported module (e.g. the dev server's reloader): keep the live instance
+        _metrics[metric.name] = metric
+        return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """Declares a counter; it is exposed as `<name>_total`."""
+    return _register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    """Declares a histogram (default buckets suit latencies in seconds)."""
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+STAGE_SECONDS = histogram("stage_duration_seconds", "Time spent in each stage of request handling.", ["stage"])
+
+_trace: "contextvars.ContextVar[Optional[List[Tuple[str, float]]]]" = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace() -> List[Tuple[str, float]]:
+    """Starts collecting this request's spans (per thread/context) and returns the list they are appended to."""
+    trace: List[Tuple[str, float]] = []
+    _trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times the enclosed block as one `stage`, also when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((stage, elapsed))
+
+
+def format_trace(trace: List[Tuple[str, float]]) -> str:
+    """Formats a request's spans as `stage=milliseconds` pairs, summing repeated stages."""
+    totals: Dict[str, float] = {}
+    for stage, elapsed in trace:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return " ".join(f"{stage}={elapsed * 1000:.1f}ms" for stage, elapsed in totals.items())
+
+
+# --- Exposition ---
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _local_snapshot() -> Dict[str, Dict[LabelValues, Any]]:
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+
+def _merged_snapshot() -> Dict[str, Dict[LabelValues, Any]]:
+    """This process's values, or the sum over every worker's file when METRICS_DIR is set."""
+    if not METRICS_DIR:
+        return _local_snapshot()
+    flush()
+    merged: Dict[str, Dict[LabelValues, Any]] = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                worker = json.load(f)
+        except (OSError, ValueError):
+            continue # A worker is rewriting its file; its totals will be back on the next scrape
+        for name, rows in worker.items():
+            metric = _metrics.get(name)
+            if metric is None:
+                continue
+            values = merged.setdefault(name, {})
+            for row in rows:
+                key = tuple(row["labels"])
+                values[key] = metric.merge(values[key], row["value"]) if key in values else row["value"]
+    return merged
+
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text exposition format (version 0.0.4)."""
+    snapshot = _merged_snapshot()
+    lines = []
+    with _metrics_lock:
+        metrics = sorted(_metrics.values(), key=lambda m: m.name)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, labels, value in metric.samples(snapshot.get(metric.name, {})):
+            label_text = ",".join(f'{name}="{_escape(label)}"' for name, label in labels.items())
+            lines.append(f"{sample}{{{label_text}}} {_format_value(value)}" if label_text else f"{sample} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Multi-worker aggregation (METRICS_DIR) ---
+
+_flusher_pid: Optional[int] = None
+_flusher_lock = threading.Lock()
+
+
+def flush() -> None:
+    """Writes this process's totals to its file in METRICS_DIR (atomically, via rename).
+
+    Each write goes through its own temp file, since the flush thread and a /metrics request may overlap.
+    """
+    if not METRICS_DIR:
+        return
+    data = {name: [{"labels": list(key), "value": value} for key, value in values.items()]
+            for name, values in _local_snapshot().items()}
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    # Named metrics-<pid>.json.<random>.tmp: not read as a worker file, but removed by clear_dir
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=METRICS_DIR, prefix=os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as f:
+        json.dump(data, f)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def _ensure_flusher() -> None:
+    """Starts this process's periodic flush thread on the first update (again after a fork)."""
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                flush()
+            except OSError:
+                pass # Retried on the next tick
+
+    threading.Thread(target=run, name="metrics-flush", daemon=True).start()
+
+
+def clear_dir() -> None:
+    """Removes the worker files left in METRICS_DIR by a previous server run."""
+    if not METRICS_DIR:
+        return
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json*")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,531 @@
+"""Non-blocking execution of Gemini model calls.
+
+Every model call in the app runs on one background asyncio event loop per
+process using the SDK's `generate_content_async`. Request threads only wait on
+a future, so a single worker process can keep many upstream calls in flight
+while the network I/O is multiplexed on the loop. A single long-lived loop is
+also what the SDK's async gRPC client expects: it binds its channel to the
+loop it was first used on.
+
+Concurrency limit: at most MAX_CONCURRENT_MODEL_CALLS upstream calls run at
+once per process (env var, default 64). Extra calls queue on the loop until a
+slot frees up.
+
+Rate limits: MODEL_RATE_LIMITS is an optional JSON object of requests per
+minute per model, e.g. `{"gemini-2.5-pro-exp-03-25": 5}`; MODEL_RPM applies to
+models not listed (default 0 = unlimited). Calls are spaced out per process to
+stay under the limit instead of failing.
+
+Models: MODEL_CONFIG is an optional JSON object of the models clients may
+select, each with its call defaults, e.g.
+`{"gemini-2.0-flash": {"temperature": 0.7, "max_output_tokens": 8192, "timeout": 60}}`.
+Missing settings fall back to MODEL_DEFAULTS (temperature 1.0, no output cap,
+120 s timeout); without MODEL_CONFIG the models offered in the UI are allowed.
+`ModelRegistry` builds one client per allowed model per process, all sharing
+the SDK's async transport, and rejects any other model name.
+
+Retries and circuit breaking: `resilient_generate` and `stream_generate` give
+each request a deadline (the model's timeout) that covers every attempt.
+Rate-limit (429) and server (5xx) errors are retried up to MODEL_MAX_RETRIES
+times (default 3). Each retry waits a random delay between zero and an
+exponential backoff (MODEL_RETRY_BASE_DELAY doubling per retry, default 0.5 s,
+capped at MODEL_RETRY_MAX_DELAY, default 8 s). No retry starts if its delay
+would pass the deadline. A per-model circuit breaker opens when at least
+CIRCUIT_FAILURE_RATE (default 0.5) of the last CIRCUIT_MIN_CALLS or more
+(default 20) attempts within CIRCUIT_WINDOW seconds (default 60) failed. While
+open, calls fail fast for CIRCUIT_COOLDOWN seconds (default 30). If the model
+has a "fallback" model in MODEL_CONFIG, calls go there instead. Failures are
+raised as `ModelCallError` with a stable `code` and HTTP status.
+
+Metrics: each call's duration is recorded per model and outcome (ok,
+fallback or the `ModelCallError` code), along with retries, errors by code and
+the token counts the SDK reports (see metrics_utils).
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+from google.generativeai import client as genai_client
+
+import metrics_utils
+
+MAX_CONCURRENT_MODEL_CALLS = int(os.getenv("MAX_CONCURRENT_MODEL_CALLS", "64"))
+MODEL_RATE_LIMITS: Dict[str, float] = json.loads(os.getenv("MODEL_RATE_LIMITS") or "{}")
+MODEL_RPM = float(os.getenv("MODEL_RPM", "0"))
+MODEL_DEFAULTS: Dict[str, Any] = {"temperature": 1.0, "max_output_tokens": None, "timeout": 120.0, "fallback": None}
+MODEL_CONFIG: Dict[str, Dict[str, Any]] = json.loads(os.getenv("MODEL_CONFIG") or "{}") or {
+    "gemini-2.5-flash-preview-04-17": {},
+    "gemini-2.5-pro-exp-03-25": {},
+    "gemini-2.0-flash-thinking-exp-01-21": {},
+    "gemini-2.0-flash": {},
+}
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "3"))
+MODEL_RETRY_BASE_DELAY = float(os.getenv("MODEL_RETRY_BASE_DELAY", "0.5"))
+MODEL_RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", "8"))
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "60"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "20"))
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_lock = threading.Lock()
+_call_slots: Optional[asyncio.Semaphore] = None
+
+_STREAM_DONE = object()
+
+MODEL_CALL_SECONDS = metrics_utils.histogram(
+    "model_call_duration_seconds", "Model calls from the first attempt to the outcome, retries included; "
+    "outcome is ok, fallback (served by the fallback model) or the error code.", ["model", "outcome"]
+)
+MODEL_RETRIES = metrics_utils.counter("model_call_retries", "Retried model call attempts.", ["model"])
+MODEL_ERRORS = metrics_utils.counter("model_call_errors", "Failed model calls by error code.", ["model", "code"])
+MODEL_TOKENS = metrics_utils.counter("model_tokens", "Tokens reported by the SDK, by kind (prompt, cached, output).",
+                                     ["model", "kind"])
+
+logger = logging.getLogger(__name__)
+
+# Upstream errors worth another attempt: rate limiting (429) and server-side failures (5xx, incl. 504)
+RETRYABLE_ERRORS = (api_exceptions.TooManyRequests, api_exceptions.ServerError)
+
+T = TypeVar("T")
+# Model name -> (client, prompt, generation config) for one attempt; called on the model-call loop
+Resolver = Callable[[str], Tuple[genai.GenerativeModel, Any, Any]]
+
+
+class UnknownModel(ValueError):
+    """Raised for a model name that isn't in the configured allowlist."""
+
+
+class ModelCallError(Exception):
+    """A model call that failed for good, with a stable `code` and HTTP `status` for the client.
+
+    Codes: "deadline_exceeded" (504), "rate_limited" (429), "upstream_unavailable" (503) and
+    "circuit_open" (503). `retry_after` is the number of seconds after which a retry may succeed, if known.
+    """
+
+    def __init__(self, code: str, message: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fails calls to one model fast while its recent failure rate is high.
+
+    Closed: attempts go through and their outcomes are kept for CIRCUIT_WINDOW seconds. Once there are at
+    least CIRCUIT_MIN_CALLS of them and CIRCUIT_FAILURE_RATE failed, the breaker opens and rejects calls
+    for CIRCUIT_COOLDOWN seconds. After that one trial call is let through (half-open): success closes the
+    breaker, failure opens it again. Used from the model-call loop only, so it needs no locking.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if not self._open_until:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until or self._trial else "half_open"
+
+    def retry_after(self) -> float:
+        return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half-open state only the first caller gets through."""
+        if not self._open_until:
+            return True
+        if time.monotonic() < self._open_until or self._trial:
+            return False
+        self._trial = True
+        return True
+
+    def record(self, ok: bool) -> None:
+        """Records an attempt's outcome; failures are timeouts and retryable upstream errors only."""
+        now = time.monotonic()
+        if self._open_until:
+            if self._trial:
+                self._trial = False
+                if ok:
+                    self._open_until = 0.0
+                    self._outcomes.clear()
+                    self._failures = 0
+                    logger.info("Circuit for '%s' closed after a successful trial call.", self.name)
+                else:
+                    self._open_until = now + CIRCUIT_COOLDOWN
+            return
+        self._outcomes.append((now, ok))
+        self._failures += not ok
+        while self._outcomes[0][0] < now - CIRCUIT_WINDOW:
+            self._failures -= not self._outcomes.popleft()[1]
+        if len(self._outcomes) >= CIRCUIT_MIN_CALLS and self._failures >= CIRCUIT_FAILURE_RATE * len(self._outcomes):
+            self._open_until = now + CIRCUIT_COOLDOWN
+            logger.warning("Circuit for '%s' opened: %d/%d recent attempts failed.", self.name, self._failures,
+                           len(self._outcomes))
+
+    def abandon(self) -> None:
+        """Frees the half-open trial slot when the trial call was cancelled before it had an outcome."""
+        self._trial = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def circuit_breaker(model_name: str) -> CircuitBreaker:
+    """Returns the model's circuit breaker for this process."""
+    if model_name not in _breakers:
+        _breakers[model_name] = CircuitBreaker(model_name)
+    return _breakers[model_name]
+
+
+class ModelRegistry:
+    """The allowed models: one prebuilt client per model and process, plus each model's call defaults.
+
+    Args:
+        config: Model name -> {"temperature", "max_output_tokens", "timeout", "fallback"}; missing keys use
+            MODEL_DEFAULTS. "fallback" names another allowed model to use while this one's circuit is open.
+    """
+
+    def __init__(self, config: Dict[str, Dict[str, Any]]):
+        self.settings = {name: {**MODEL_DEFAULTS, **(options or {})} for name, options in config.items()}
+        for name, settings in self.settings.items():
+            if settings["fallback"] is not None and (settings["fallback"] not in config or settings["fallback"] == name):
+                logger.warning("Ignoring fallback '%s' for '%s': not another allowed model.", settings["fallback"], name)
+                settings["fallback"] = None
+        self._generation_configs = {
+            name: genai.types.GenerationConfig(temperature=s["temperature"], max_output_tokens=s["max_output_tokens"])
+            for name, s in self.settings.items()
+        }
+        self._models: Dict[str, genai.GenerativeModel] = {}
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: Any) -> bool:
+        return name in self.settings
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.settings)
+
+    def check(self, name: Any) -> None:
+        """Raises `UnknownModel` unless `name` is an allowed model."""
+        if not isinstance(name, str) or name not in self.settings: # A list or dict name isn't hashable
+            raise UnknownModel(f"Unknown model '{name}'. Allowed models: {', '.join(self.settings)}.")
+
+    def warm(self) -> None:
+        """Builds the clients for this process and creates the shared async transport on the model-call loop.
+
+        The SDK caches one async transport per process and every model client uses it; creating it on
+        the loop ahead of the first request keeps channel setup off the request path. Runs again in a
+        forked worker, whose parent's clients are bound to a loop that doesn't exist there.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._models = {name: genai.GenerativeModel(name) for name in self.settings}
+            self._pid = os.getpid()
+
+        async def create_transport():
+            genai_client.get_default_generative_async_client()
+
+        submit(create_transport()) # Not awaited: this may run on the loop itself, and later calls queue behind it
+
+    def get(self, name: str) -> genai.GenerativeModel:
+        """Returns the prebuilt client for an allowed model, or raises `UnknownModel`."""
+        self.check(name)
+        if self._pid != os.getpid():
+            self.warm()
+        return self._models[name]
+
+    def generation_config(self, name: str, **overrides: Any) -> genai.types.GenerationConfig:
+        """Returns the model's generation config, with any `overrides` (e.g. a response schema) applied."""
+        self.check(name)
+        if not overrides:
+            return self._generation_configs[name]
+        settings = self.settings[name]
+        return genai.types.GenerationConfig(
+            temperature=settings["temperature"], max_output_tokens=settings["max_output_tokens"], **overrides
+        )
+
+    def timeout(self, name: str) -> Optional[float]:
+        """Seconds a call to the model may take, including retries and waiting for a call slot; None for no limit."""
+        self.check(name)
+        return self.settings[name]["timeout"]
+
+    def fallback(self, name: str) -> Optional[str]:
+        """The model to call instead while this one's circuit is open, if configured."""
+        self.check(name)
+        return self.settings[name]["fallback"]
+
+
+class RateLimiter:
+    """Spaces out acquisitions so that at most `requests_per_minute` happen per minute."""
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_rate_limiters: Dict[str, Optional[RateLimiter]] = {}
+
+
+def _model_name(model: genai.GenerativeModel) -> str:
+    return getattr(model, "model_name", "").removeprefix("models/")
+
+
+async def _throttle(model: genai.GenerativeModel) -> None:
+    """Waits for the model's rate-limit slot, if it has a limit configured. Runs on the model-call loop."""
+    name = _model_name(model)
+    if name not in _rate_limiters:
+        rpm = MODEL_RATE_LIMITS.get(name, MODEL_RPM)
+        _rate_limiters[name] = RateLimiter(rpm) if rpm and rpm > 0 else None
+    limiter = _rate_limiters[name]
+    if limiter is not None:
+        await limiter.acquire()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Returns the process-wide model-call loop, starting it on first use (and again after a fork)."""
+    global _loop, _loop_pid, _call_slots
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="model-call-loop", daemon=True)
+            thread.start()
+            _loop = loop
+            _loop_pid = os.getpid()
+            _call_slots = asyncio.Semaphore(MAX_CONCURRENT_MODEL_CALLS)
+            _rate_limiters.clear()
+            _breakers.clear()
+        return _loop
+
+
+def submit(coro: Awaitable[Any]) -> Future:
+    """Schedules a coroutine on the model-call loop and returns a thread-safe future."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+async def generate_async(model: genai.GenerativeModel, prompt: Any, generation_config: Any = None,
+                         timeout: Optional[float] = None, **kwargs) -> Any:
+    """Awaits one non-streaming model call, respecting the per-process concurrency and rate limits.
+
+    `timeout` bounds the whole call, including the wait for a slot, and raises `TimeoutError`.
+    """
+    async def call():
+        await _throttle(model)
+        async with _call_slots:
+            return await model.generate_content_async(prompt, generation_config=generation_config, **kwargs)
+
+    return await asyncio.wait_for(call(), timeout)
+
+
+def _deadline_error() -> ModelCallError:
+    return ModelCallError("deadline_exceeded", "The AI model did not respond in time. Please try again.", 504)
+
+
+def _record_usage(model_name: str, response: Any) -> None:
+    """Adds the token counts the SDK reported for a call (on the response, or a stream's last chunk) to MODEL_TOKENS."""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage or not getattr(usage, "total_token_count", 0):
+        return
+    MODEL_TOKENS.inc(usage.prompt_token_count, model=model_name, kind="prompt")
+    MODEL_TOKENS.inc(getattr(usage, "cached_content_token_count", 0) or 0, model=model_name, kind="cached")
+    MODEL_TOKENS.inc(usage.candidates_token_count, model=model_name, kind="output")
+
+
+def _final_error(error: Exception) -> ModelCallError:
+    """Maps a retryable upstream error that exhausted its retries to the client-facing error."""
+    if isinstance(error, api_exceptions.TooManyRequests):
+        return ModelCallError("rate_limited", "The AI model is rate limited right now. Please try again shortly.", 429)
+    return ModelCallError("upstream_unavailable", "The AI model service is temporarily unavailable. Please try again.", 503)
+
+
+async def call_with_retries(model_name: str, attempt: Callable[[str, Optional[float]], Awaitable[T]],
+                            deadline: Optional[float] = None, fallback: Optional[str] = None) -> Tuple[T, str]:
+    """Runs `attempt(model_name, timeout)` until it succeeds, retrying retryable errors within the deadline.
+
+    Args:
+        model_name: The model to call.
+        attempt: Makes one attempt with the given model, giving up after `timeout` seconds (None = no limit).
+        deadline: `time.monotonic()` value by which the call must be done, retries included.
+        fallback: Model to call instead while `model_name`'s circuit is open.
+
+    Returns:
+        The attempt's result and the name of the model that produced it.
+
+    Raises:
+        ModelCallError: On timeout, exhausted retries or an open circuit. Other errors (e.g. invalid
+            requests) are raised unchanged and aren't retried.
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result, served_by = await _retry_loop(model_name, attempt, deadline, fallback)
+        outcome = "ok" if served_by == model_name else "fallback"
+        return result, served_by
+    except ModelCallError as e:
+        outcome = e.code
+        raise
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        MODEL_CALL_SECONDS.observe(time.perf_counter() - started, model=model_name, outcome=outcome)
+        if outcome not in ("ok", "fallback", "cancelled"):
+            MODEL_ERRORS.inc(model=model_name, code=outcome)
+
+
+async def _retry_loop(model_name: str, attempt: Callable[[str, Optional[float]], Awaitable[T]],
+                      deadline: Optional[float], fallback: Optional[str]) -> Tuple[T, str]:
+    if not circuit_breaker(model_name).allow():
+        if fallback and circuit_breaker(fallback).allow():
+            logger.info("Circuit for '%s' is open; calling fallback model '%s'.", model_name, fallback)
+            model_name = fallback
+        else:
+            raise ModelCallError("circuit_open", f"The AI model '{model_name}' is failing repeatedly. "
+                                 "Please try again later or select another model.", 503,
+                                 retry_after=round(circuit_breaker(model_name).retry_after(), 1))
+    breaker = circuit_breaker(model_name)
+    retries = 0
+    while True:
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            raise _deadline_error()
+        try:
+            result = await attempt(model_name, timeout)
+        except asyncio.TimeoutError as e:
+            breaker.record(False)
+            raise _deadline_error() from e
+        except RETRYABLE_ERRORS as e:
+            breaker.record(False)
+            # "Full jitter": a random wait up to the exponential backoff, so clients don't retry in lockstep
+            delay = random.uniform(0, min(MODEL_RETRY_MAX_DELAY, MODEL_RETRY_BASE_DELAY * 2 ** retries))
+            retries += 1
+            if (retries > MODEL_MAX_RETRIES or not breaker.allow()
+                    or (deadline is not None and time.monotonic() + delay >= deadline)):
+                raise _final_error(e) from e
+            MODEL_RETRIES.inc(model=model_name)
+            logger.info("Retrying '%s' in %.2fs (retry %d/%d) after: %s", model_name, delay, retries, MODEL_MAX_RETRIES, e)
+            await asyncio.sleep(delay)
+            continue
+        except ModelCallError:
+            breaker.record(False)
+            raise
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception:
+            breaker.record(True) # The upstream answered; the request itself was bad
+            raise
+        breaker.record(True)
+        return result, model_name
+
+
+async def resilient_generate_async(model_name: str, resolve: Resolver, deadline: Optional[float] = None,
+                                   fallback: Optional[str] = None) -> Tuple[Any, str]:
+    """`generate_async` with retries, deadline and circuit breaking (see `call_with_retries`).
+
+    Returns:
+        The SDK response and the name of the model that produced it.
+    """
+    async def attempt(name: str, timeout: Optional[float]) -> Any:
+        model, prompt, generation_config = resolve(name)
+        response = await generate_async(model, prompt, generation_config, timeout)
+        _record_usage(name, response)
+        return response
+
+    return await call_with_retries(model_name, attempt, deadline, fallback)
+
+
+def resilient_generate(model_name: str, resolve: Resolver, deadline: Optional[float] = None,
+                       fallback: Optional[str] = None) -> Tuple[Any, str]:
+    """Blocking wrapper around `resilient_generate_async` for use from Flask request threads."""
+    future = submit(resilient_generate_async(model_name, resolve, deadline, fallback))
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def stream_generate(model_name: str, resolve: Resolver, deadline: Optional[float] = None,
+                    fallback: Optional[str] = None) -> Iterator[Any]:
+    """Yields response chunks from a streamed model call running on the model-call loop.
+
+    Failures before the first chunk are retried like `resilient_generate`; once chunks were yielded, an
+    upstream error ends the stream with `ModelCallError`, as does passing the deadline. Closing the
+    generator (e.g. when the client disconnects) cancels the upstream call.
+    """
+    chunks: "queue.Queue[Any]" = queue.Queue()
+
+    async def attempt(name: str, timeout: Optional[float]) -> None:
+        model, prompt, generation_config = resolve(name)
+        started = False
+
+        async def call():
+            nonlocal started
+            await _throttle(model)
+            async with _call_slots:
+                response = await model.generate_content_async(prompt, generation_config=generation_config, stream=True)
+                chunk = None
+                async for chunk in response:
+                    chunks.put(chunk)
+                    started = True
+                _record_usage(name, chunk) # Reported on the last chunk
+
+        try:
+            await asyncio.wait_for(call(), timeout)
+        except RETRYABLE_ERRORS as e:
+            if started:
+                raise _final_error(e) from e # Chunks already went out; a retry would repeat them
+            raise
+
+    async def pump():
+        try:
+            await call_with_retries(model_name, attempt, deadline, fallback)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(_STREAM_DONE)
+
+    future = submit(pump())
+    try:
+        while True:
+            item = chunks.get()
+            if item is _STREAM_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        future.cancel()
+
+
+def count_tokens(model: genai.GenerativeModel, prompt: Any, timeout: Optional[float] = None) -> int:
+    """Counts a prompt's input tokens with the SDK (one API call), from a request thread."""
+    return submit(model.count_tokens_async(prompt)).result(timeout).total_tokens
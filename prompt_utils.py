@@ -1,6 +1,233 @@
-from typing import List, Union
+"""Prompt builders for the model endpoints, plus input-token budgeting.
+
+The static parts of every prompt (personas, section guides, instruction lists)
+are built once at import. Each prompt starts with its static prefix, so a
+provider that caches repeated prompt prefixes implicitly can reuse it (usage
+then reports `cached_tokens`). Explicit provider-side cached content isn't
+used: the static prefixes are a few hundred tokens at most, well below the
+minimum size the provider accepts for it, so creating it could only fail.
+
+Token budgets: `fit_prompt` estimates a prompt's input tokens locally and, when
+the estimate comes close to the endpoint's budget, asks the SDK to count them.
+Oversized request data (user prompt, analysis sections, SVG code) is trimmed
+to fit, and the caller gets an explicit warning.
+
+Configuration (env vars):
+    PROMPT_TOKEN_BUDGETS: JSON object of input-token budgets per endpoint overriding the
+        defaults, e.g. `{"refine": 16000}` (endpoints: generate, analyze, convert, refine).
+    PROMPT_COUNT_RATIO: Fraction of the budget above which tokens are counted by the SDK
+        instead of estimated (default 0.8).
+"""
+import json
+import logging
+import math
+import os
+import re
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+from PIL import Image as PILImage
 from PIL.Image import Image # Assuming Image is from PIL
 
+import svg_utils
+from image_utils import Box
+from metrics_utils import span
+
+logger = logging.getLogger(__name__)
+
+PROMPT_TOKEN_BUDGETS: Dict[str, int] = {
+    "generate": 4000, "analyze": 8000, "convert": 24000, "refine": 24000,
+    **json.loads(os.getenv("PROMPT_TOKEN_BUDGETS") or "{}"),
+}
+PROMPT_COUNT_RATIO = float(os.getenv("PROMPT_COUNT_RATIO", "0.8"))
+
+# Local estimate: ~4 characters per text token; Gemini bills 258 tokens per image tile of up to 768x768
+CHARS_PER_TOKEN = 4
+IMAGE_TILE_TOKENS = 258
+_IMAGE_TILE_EDGE = 768
+
+# The five /analyze_image sections in prompt order: (response key, Markdown header)
+ANALYSIS_SECTIONS = (
+    ("metadata", "Metadata Analysis"),
+    ("semantic", "Semantic Analysis"),
+    ("layout", "Layout Analysis"),
+    ("content_styling", "Content & Styling Analysis"),
+    ("ocr", "OCR Analysis"),
+)
+
+# JSON schema for structured analysis output (`response_schema`): one plain-text field per section
+ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        key: {"type": "string", "description": f"The {header} section."} for key, header in ANALYSIS_SECTIONS
+    },
+    "required": [key for key, _ in ANALYSIS_SECTIONS],
+}
+
+# JSON schema for patch-mode refinement output: edit operations on elements addressed by their `data-eid`
+# (see svg_utils.apply_patch). Attributes are a name/value list since the schema can't express free-form maps.
+PATCH_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ops": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "op": {"type": "string", "description": "One of: set, text, replace, insert, delete."},
+                    "id": {"type": "string", "description": "The data-eid of the element to edit."},
+                    "attributes": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {"name": {"type": "string"}, "value": {"type": "string"}},
+                            "required": ["name", "value"],
+                        },
+                    },
+                    "text": {"type": "string"},
+                    "svg": {"type": "string", "description": "New SVG markup for replace and insert."},
+                    "position": {"type": "string", "description": "For insert: before, after, prepend or append."},
+                },
+                "required": ["op", "id"],
+            },
+        },
+    },
+    "required": ["ops"],
+}
+
+# One alternation over all section headers, tolerating "**Layout:**", "**OCR Analysis**:" and "## Layout Analysis"
+_SECTION_HEADER_RE = re.compile(
+    r"(?:\*\*|^[ \t]*#{1,6}[ \t]*)[ \t]*"
+    r"(metadata|semantic|layout|content[ \t]*(?:&|and)[ \t]*styling|ocr)([ \t]+analysis)?"
+    r"[ \t]*(:)?[ \t]*(?:\*\*)?[ \t]*(:)?",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# --- Static prompt parts, built once ---
+
+SVG_PROMPT_PREFIX = (
+    "You are an expert graphic designer specializing in modern vector graphics and SVG creation. "
+    "You have a keen eye for aesthetics, color theory, clean design principles, and efficient SVG code. "
+    "Your goal is to translate the user's description into a high-quality, visually appealing, and technically sound SVG file."
+)
+
+_SVG_INSTRUCTIONS = (
+    "\n\nInstructions:\n"
+    "1. Generate ONLY the raw SVG code based on the User Request and Design Hints.\n"
+    "2. The root `<svg>` element MUST include `xmlns=\"http://www.w3.org/2000/svg\"` and an appropriate `viewBox`. Estimate the viewBox based on the described elements (e.g., `viewBox=\"0 0 100 100\"` for simple centered shapes). \n"
+    "3. Use standard SVG elements (`<rect>`, `<circle>`, `<path>`, `<text>`, `<g>`, etc.).\n"
+    "4. Apply colors, strokes, and fills as described or implied. Use presentation attributes (e.g., `fill`, `stroke`) over inline `style` attributes where possible.\n"
+    "5. Ensure the output starts strictly with `<svg` and ends strictly with `</svg>`. No markdown fences, no XML declaration, no explanations, no other text."
+)
+
+_ANALYSIS_OUTPUT_FORMATS = {
+    False: "Provide a structured analysis with the following sections clearly marked using Markdown headers (e.g., **Section Name:**) IN THIS EXACT ORDER: Metadata Analysis, Semantic Analysis, Layout Analysis, Content & Styling Analysis, OCR Analysis.",
+    True: (
+        "Provide a structured analysis as a JSON object with one plain-text string field per section: "
+        + ", ".join(f"`{key}` ({header})" for key, header in ANALYSIS_SECTIONS)
+        + ". Each field covers the points listed under its section below; lists and tables inside a field use Markdown."
+    ),
+}
+
+_ANALYSIS_SECTION_GUIDE = (
+    "\n**Metadata Analysis:**",
+    "  - Dimensions: Estimated width/height in pixels.",
+    "  - Aspect Ratio: Calculated width:height.",
+    "  - Key Colors: List primary, secondary, and background hex codes.",
+    "  - Fonts: Identify font families, styles (bold, italic), and relative sizes if possible.",
+
+    "\n**Semantic Analysis:**", # Renamed and refocused
+    "  - Describe the overall purpose and meaning of the image.",
+    "  - Identify the main subject, key objects, or concepts presented.",
+    "  - What is the core message or information being conveyed?",
+
+    "\n**Layout Analysis:**",
+    "  - Overall Structure: Describe the main layout areas (header, body, sidebar, footer?).",
+    "  - Element Positioning: Describe the placement of key elements (images, text blocks, shapes) using relative terms (top-left, center, bottom-right).",
+    "  - Alignment: How are elements aligned relative to each other or the page (left, center, right)?",
+    "  - Spacing: Describe the relative spacing or padding between major elements.",
+    "  - Shapes: Identify main shapes (rectangles, circles, lines) and their approximate location and size.",
+
+    "\n**Content & Styling Analysis:**", 
+    "  - Text Content: Transcribe all significant text, preserving line breaks and general formatting as seen.",
+    "  - Visual Style: Describe the overall aesthetic (e.g., flat, minimalist, illustrative, realistic).",
+    "  - Color Palette Usage: How are the key colors used across elements?",
+    "  - Borders/Lines: Describe any significant borders or lines, including thickness and style (solid, dashed).",
+    "  - Effects: Mention any shadows, gradients, or other visual effects.",
+
+    "\n**OCR Analysis:**", # Enhanced based on user feedback
+    "  - Identify any tables or structured charts first. If found:",
+    "  - Describe the structure (rows, columns).",
+    "  - Extract header text.",
+    "  - Note any merged cells or special cell alignments.",
+    "Provide cell content of the table if present, maintaining row/column relationships (e.g., using a simple markdown table or list format. NEVER indent the cell/table content.).",
+    "  - For all other text:",
+    "  - Transcribe text content sequentially (top-to-bottom, left-to-right).",
+    "  - Group text belonging to the same visual container (e.g., a specific box, paragraph). Number these containers.",
+    "  - For each text container, describe its approximate relative position (e.g., top-left, middle, bottom-right).",
+    "  - Describe the text alignment within its container (left, center, right, justified?).",
+    "  - If no text is found, state 'No text detected'.",
+)
+
+# Keyed by `structured`; the user context follows the prefix so the whole guide is a static prefix
+ANALYSIS_PROMPT_PREFIXES = {
+    structured: "\n".join([
+        "Analyze the following image to gather information for recreating it as an SVG.",
+        output_format,
+        *_ANALYSIS_SECTION_GUIDE,
+    ])
+    for structured, output_format in _ANALYSIS_OUTPUT_FORMATS.items()
+}
+
+CONVERSION_PROMPT_PREFIX = "You are an expert SVG generator. Your task is to recreate the provided image as accurately as possible in SVG format, paying close attention to text content, formatting, and layout, using the provided analysis as a guide."
+
+_CONVERSION_INSTRUCTIONS = (
+    "\n\n**SVG Generation Instructions:**",
+    "1. Recreate the visual structure, element placement, shapes, colors, and styling based *primarily* on the image, using the analysis sections to clarify details and ensure accuracy.",
+    "2. **CRITICAL:** Accurately reproduce ALL text content identified in the OCR Analysis. Preserve its formatting (bold, italic), alignment, size, and relative positioning as described in the analysis. Use appropriate `<text>` elements with relevant attributes (`x`, `y`, `font-family`, `font-size`, `font-weight`, `font-style`, `fill`, `text-anchor`).",
+    "3. Use standard SVG elements (`<rect>`, `<circle>`, `<path>`, `<line>`, `<text>`, `<g>`, etc.).",
+    "4. The root `<svg>` element MUST include `xmlns=\"http://www.w3.org/2000/svg\"` and a relevant `viewBox` (estimate based on analysis or image aspect ratio, e.g., `viewBox=\"0 0 width height\"`).",
+    "5. Pay attention to layering (e.g., text should generally be on top of background shapes). Use `<g>` elements for grouping where logical.",
+    "6. Prioritize visual accuracy and clean, standard SVG code. Use presentation attributes (e.g., `fill`, `stroke`) over inline `style` attributes unless necessary.",
+    "7. Output ONLY the raw SVG code, starting strictly with `<svg` and ending strictly with `</svg>`. No markdown fences, no XML declaration, no comments, no other text.",
+)
+
+REFINE_PROMPT_PREFIX = (
+    "You are an expert SVG editor performing a refinement task. "
+    "You will analyze the provided original SVG code, its rendered appearance (shown in the PNG image), and optional user refinement instructions. "
+    "Your goal is to improve the SVG based on both the user's feedback AND your own expert critique of the rendered PNG compared to common SVG best practices or the likely original intent."
+)
+
+_REFINE_INSTRUCTIONS = (
+    "\n\n**IMPORTANT Instructions for Refinement & Self-Correction:**\n",
+    "1. **Analyze PNG vs SVG:** Compare the rendered PNG image to the Original SVG Code. Identify any discrepancies, rendering issues, or areas where the SVG deviates from expected visual quality (e.g., incorrect layering, alignment, text formatting, missing elements, unintended artifacts).",
+    "2. **Self-Critique:** Based on your analysis in step 1, determine necessary corrections even if the user didn't mention them. Prioritize fixing obvious errors or significant visual deviations.",
+    "3. **Apply User Feedback:** If the user provided explicit instructions, address them precisely.",
+    "4. **Combine & Prioritize:** Integrate your self-corrections (from step 2) with the user's requested changes (from step 3). If there's a conflict, generally prioritize fixing rendering errors/major quality issues first, then apply user cosmetic requests.",
+    "5. **Minimal Changes:** Apply only the necessary changes. Do NOT add unrelated elements or completely redesign.",
+    "6. **Preserve Structure:** Maintain existing SVG structure (groups, IDs, classes) unless modification is essential for the fix.",
+    "7. **Validity & Format:** Ensure the output is valid SVG code starting strictly with `<svg` and ending strictly with `</svg>`. No markdown, XML declaration, comments, or explanations.",
+)
+
+REFINE_PATCH_PROMPT_PREFIX = (
+    "You are an expert SVG editor performing a refinement task by editing an existing SVG in place. "
+    "You will analyze the provided original SVG code, its rendered appearance (shown in the PNG image), and optional user refinement instructions. "
+    "Instead of rewriting the document, you describe your improvements as a short list of edit operations on its elements."
+)
+
+# Steps 1-6 are shared with full refinement; only the output format differs
+_REFINE_PATCH_INSTRUCTIONS = (
+    *_REFINE_INSTRUCTIONS[:7],
+    "7. **Edit Operations:** Every element in the Original SVG Code has a `data-eid` attribute (e.g. `data-eid=\"e12\"`). "
+    "Respond with a JSON object `{\"ops\": [...]}` listing the operations in the order to apply them, each naming its element by that value in `id`:",
+    '   - `{"op": "set", "id": "e12", "attributes": [{"name": "fill", "value": "#ff0000"}]}` sets attributes; an empty `value` removes the attribute.',
+    '   - `{"op": "text", "id": "e12", "text": "New label"}` replaces the text content of an element such as `<text>` or `<tspan>`.',
+    '   - `{"op": "replace", "id": "e12", "svg": "<circle cx=\\"5\\" cy=\\"5\\" r=\\"2\\"/>"}` replaces the element and its children with new SVG markup.',
+    '   - `{"op": "insert", "id": "e12", "position": "after", "svg": "<rect .../>"}` inserts new markup `before` or `after` the element, or as its first (`prepend`) or last (`append`) child.',
+    '   - `{"op": "delete", "id": "e12"}` removes the element and its children.',
+    "8. **Format:** New markup must be well-formed SVG elements without `data-eid` attributes. The root `<svg>` element (e0) can only be changed with `set`, "
+    "`text`, `prepend` and `append`. Elements you add can't be edited by later operations. If nothing needs to change, return `{\"ops\": []}`. Output only the JSON object.",
+)
+
 def format_svg_prompt(user_prompt: str, complexity: int | None = None, colorUsage: int | None = None) -> str:
     """Formats the user prompt with hints based on sliders and structural instructions.
 
@@ -15,13 +242,6 @@ def format_svg_prompt(user_prompt: str, complexity: int | None = None, colorUsag
     if not isinstance(user_prompt, str) or not user_prompt.strip():
         raise ValueError("User prompt cannot be empty.")
 
-    # --- Persona Prompt --- 
-    persona = (
-        "You are an expert graphic designer specializing in modern vector graphics and SVG creation. "
-        "You have a keen eye for aesthetics, color theory, clean design principles, and efficient SVG code. "
-        "Your goal is to translate the user's description into a high-quality, visually appealing, and technically sound SVG file."
-    )
-    
     # --- Slider Hints --- 
     hints = []
     if complexity is not None:
@@ -47,68 +267,430 @@ def format_svg_prompt(user_prompt: str, complexity: int | None = None, colorUsag
     hints_string = " Design Hints: " + " ".join(hints) if hints else ""
 
     # --- Core Task & Output Format --- 
-    core_task = (
-        f"\n\nUser Request: \"{user_prompt}\"{hints_string}\n\n"
-        f"Instructions:\n"
-        f"1. Generate ONLY the raw SVG code based on the User Request and Design Hints.\n"
-        f"2. The root `<svg>` element MUST include `xmlns=\"http://www.w3.org/2000/svg\"` and an appropriate `viewBox`. Estimate the viewBox based on the described elements (e.g., `viewBox=\"0 0 100 100\"` for simple centered shapes). \n"
-        f"3. Use standard SVG elements (`<rect>`, `<circle>`, `<path>`, `<text>`, `<g>`, etc.).\n"
-        f"4. Apply colors, strokes, and fills as described or implied. Use presentation attributes (e.g., `fill`, `stroke`) over inline `style` attributes where possible.\n"
-        f"5. Ensure the output starts strictly with `<svg` and ends strictly with `</svg>`. No markdown fences, no XML declaration, no explanations, no other text."
-    )
+    core_task = f"\n\nUser Request: \"{user_prompt}\"{hints_string}" + _SVG_INSTRUCTIONS
 
-    formatted_prompt = persona + core_task
+    formatted_prompt = SVG_PROMPT_PREFIX + core_task
     
     return formatted_prompt 
 
-def format_analysis_prompt(user_context: str, image: Image) -> List[Union[str, Image]]:
-    """Formats the prompt for image analysis, requesting structured output."""
+def format_analysis_prompt(user_context: str, image: Union[Image, Dict[str, Any]],
+                           structured: bool = False, tile_note: Optional[str] = None) -> List[Union[str, Image, Dict[str, Any]]]:
+    """Formats the prompt for image analysis, requesting structured output.
 
+    `image` may be a PIL image or an inline blob dict (`{"mime_type": ..., "data": ...}`).
+    With `structured`, the model is asked for a JSON object matching ANALYSIS_RESPONSE_SCHEMA
+    instead of Markdown sections; the section descriptions are the same. `tile_note` (from
+    `format_tile_note`) marks the image as one tile of a larger image.
+    """
     prompt_parts = [
-        "Analyze the following image to gather information for recreating it as an SVG.",
-        "User context/request for the final SVG: ", user_context if user_context else "None provided", "\n\n",
-        "Provide a structured analysis with the following sections clearly marked using Markdown headers (e.g., **Section Name:**) IN THIS EXACT ORDER: Metadata Analysis, Semantic Analysis, Layout Analysis, Content & Styling Analysis, OCR Analysis.",
-        
-        "\n\n**Metadata Analysis:**",
-        "  - Dimensions: Estimated width/height in pixels.",
-        "  - Aspect Ratio: Calculated width:height.",
-        "  - Key Colors: List primary, secondary, and background hex codes.",
-        "  - Fonts: Identify font families, styles (bold, italic), and relative sizes if possible.",
-
-        "\n\n**Semantic Analysis:**", # Renamed and refocused
-        "  - Describe the overall purpose and meaning of the image.",
-        "  - Identify the main subject, key objects, or concepts presented.",
-        "  - What is the core message or information being conveyed?",
-
-        "\n\n**Layout Analysis:**",
-        "  - Overall Structure: Describe the main layout areas (header, body, sidebar, footer?).",
-        "  - Element Positioning: Describe the placement of key elements (images, text blocks, shapes) using relative terms (top-left, center, bottom-right).",
-        "  - Alignment: How are elements aligned relative to each other or the page (left, center, right)?",
-        "  - Spacing: Describe the relative spacing or padding between major elements.",
-        "  - Shapes: Identify main shapes (rectangles, circles, lines) and their approximate location and size.",
-
-        "\n\n**Content & Styling Analysis:**", 
-        "  - Text Content: Transcribe all significant text, preserving line breaks and general formatting as seen.",
-        "  - Visual Style: Describe the overall aesthetic (e.g., flat, minimalist, illustrative, realistic).",
-        "  - Color Palette Usage: How are the key colors used across elements?",
-        "  - Borders/Lines: Describe any significant borders or lines, including thickness and style (solid, dashed).",
-        "  - Effects: Mention any shadows, gradients, or other visual effects.",
-
-         "\n\n**OCR Analysis:**", # Enhanced based on user feedback
-        "  - Identify any tables or structured charts first. If found:",
-        "  - Describe the structure (rows, columns).",
-        "  - Extract header text.",
-        "  - Note any merged cells or special cell alignments.",
-        "Provide cell content of the table if present, maintaining row/column relationships (e.g., using a simple markdown table or list format. NEVER indent the cell/table content.).",
-        "  - For all other text:",
-        "  - Transcribe text content sequentially (top-to-bottom, left-to-right).",
-        "  - Group text belonging to the same visual container (e.g., a specific box, paragraph). Number these containers.",
-        "  - For each text container, describe its approximate relative position (e.g., top-left, middle, bottom-right).",
-        "  - Describe the text alignment within its container (left, center, right, justified?).",
-        "  - If no text is found, state 'No text detected'.",
-        
-
+        ANALYSIS_PROMPT_PREFIXES[structured],
+        "\n\nUser context/request for the final SVG: " + (user_context if user_context else "None provided"),
+    ]
+    if tile_note:
+        prompt_parts.append(tile_note)
+    prompt_parts.extend([
         "\n\n", # Separator before image
         image
+    ])
+    return prompt_parts
+
+def _empty_sections() -> Dict[str, str]:
+    return {key: f"{header.replace(' Analysis', '')} analysis not found." for key, header in ANALYSIS_SECTIONS}
+
+
+def _section_key(name: str) -> str:
+    name = name.lower()
+    return "content_styling" if name.startswith("content") else name
+
+
+def _finish_sections(sections: Dict[str, str]) -> Dict[str, str]:
+    if not sections["ocr"]:
+        sections["ocr"] = "No text detected."
+    return sections
+
+
+def parse_analysis_sections(analysis_text: str) -> Tuple[Dict[str, str], bool]:
+    """Splits a Markdown analysis response into its five sections in a single scan over the headers.
+
+    Sections that don't appear keep a "... not found." placeholder. A repeated header appends to
+    its section.
+
+    Returns:
+        The sections dict (keyed as in ANALYSIS_SECTIONS) and whether any section header was found.
+    """
+    sections = _empty_sections()
+    found = set()
+
+    def add(key: str, body: str) -> None:
+        body = body.strip()
+        sections[key] = f"{sections[key]}\n\n{body}".strip() if key in found else body
+        found.add(key)
+
+    current = None
+    position = 0
+    for match in _SECTION_HEADER_RE.finditer(analysis_text or ""):
+        if not (match.group(2) or match.group(3) or match.group(4)):
+            continue # A bare bold word such as "**Layout**" inside a section, not a header
+        if current:
+            add(current, analysis_text[position:match.start()])
+        current = _section_key(match.group(1))
+        position = match.end()
+    if current:
+        add(current, analysis_text[position:])
+    return _finish_sections(sections), bool(found)
+
+
+def parse_analysis_json(analysis_text: str) -> Tuple[Dict[str, str], bool]:
+    """Validates a structured (JSON) analysis response against ANALYSIS_RESPONSE_SCHEMA.
+
+    A Markdown code fence around the JSON is tolerated. Falls back to the Markdown parser when the text
+    isn't a JSON object with the section fields, so a model that ignores the requested format doesn't
+    force a re-analysis.
+
+    Returns:
+        The sections dict and whether any section was found.
+    """
+    text = (analysis_text or "").strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return parse_analysis_sections(analysis_text)
+    if not isinstance(data, dict) or not any(key in data for key, _ in ANALYSIS_SECTIONS):
+        return parse_analysis_sections(analysis_text)
+
+    sections = _empty_sections()
+    for key, _ in ANALYSIS_SECTIONS:
+        value = data.get(key)
+        if isinstance(value, list): # Some models return bullet lists despite the schema
+            value = "\n".join(f"- {item}" for item in value)
+        if value is not None:
+            sections[key] = str(value).strip()
+    return _finish_sections(sections), True
+
+
+def format_conversion_prompt(image: Union[Image, Dict[str, Any]], analysis_data: Dict[str, str]) -> List[Union[str, Image, Dict[str, Any]]]:
+    """Formats the prompt for recreating an image as SVG, guided by its five analysis sections."""
+    prompt_parts = [
+        CONVERSION_PROMPT_PREFIX,
+        "\n\n**Input Image:**",
+        image,
+        "\n\n**Image Analysis Results (Use this information heavily to guide the recreation):**",
+
+        "\n\n--- METADATA ANALYSIS ---",
+        analysis_data.get('metadata', 'N/A'),
+
+        "\n\n--- SEMANTIC ANALYSIS --- (Purpose/Meaning)",
+        analysis_data.get('semantic', 'N/A'),
+
+        "\n\n--- LAYOUT ANALYSIS --- (Structure/Placement)",
+        analysis_data.get('layout', 'N/A'),
+
+        "\n\n--- CONTENT & STYLING ANALYSIS --- (Text Content/Visuals)",
+        analysis_data.get('content_styling', 'N/A'),
+
+        "\n\n--- OCR ANALYSIS --- (Detailed Text/Structure)",
+        analysis_data.get('ocr', 'N/A'),
+
+        *_CONVERSION_INSTRUCTIONS,
+    ]
+    return prompt_parts
+
+def format_refine_prompt(svg_code: str, refinement_prompt: str, png_image: Optional[Union[Image, Dict[str, Any]]] = None,
+                         png_note: Optional[str] = None, patch: bool = False) -> List[Union[str, Image, Dict[str, Any]]]:
+    """Formats the prompt for refining an SVG from its code, an optional rendered PNG and user instructions.
+
+    With `patch`, the model is asked for edit operations matching PATCH_RESPONSE_SCHEMA instead of a
+    new document; `svg_code` must then carry the element IDs from svg_utils.annotate_svg.
+
+    Args:
+        svg_code: The SVG to refine.
+        refinement_prompt: The user's instructions; may be empty.
+        png_image: The rendered SVG as a PIL image or inline blob dict, for self-critique.
+        png_note: A note to include instead when the PNG could not be loaded or rendered.
+        patch: Ask for a patch instead of the full refined SVG.
+    """
+    prompt_parts = [
+        REFINE_PATCH_PROMPT_PREFIX if patch else REFINE_PROMPT_PREFIX,
+        f"\n\n**Original SVG Code:**\n```svg\n{svg_code}\n```\n",
     ]
-    return prompt_parts 
\ No newline at end of file
+    if png_note:
+        prompt_parts.append(png_note)
+    if png_image:
+        prompt_parts.extend([
+            "\n\n**Rendered PNG of Original SVG:**",
+            png_image,
+            "(This image shows how the 'Original SVG Code' above currently renders.)"
+        ])
+    prompt_parts.append(
+        f"\n\n**User's Explicit Refinement Instructions:**\n{refinement_prompt if refinement_prompt else 'None provided.'}\n"
+    )
+    prompt_parts.extend(_REFINE_PATCH_INSTRUCTIONS if patch else _REFINE_INSTRUCTIONS)
+    return prompt_parts
+
+# --- Tiled analysis ---
+#
+# Large or dense images can be analysed as overlapping tiles (see image_utils.plan_tiles) plus one overview
+# call on the downscaled whole image. Tiles report positions as boxes relative to themselves, which
+# `merge_tile_sections` maps back onto the whole image.
+
+# A bounding box `[ymin, xmin, ymax, xmax]` normalized to 0-1000 (the convention Gemini models are trained on)
+_BOX_RE = re.compile(r"\[\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*\]")
+_PLACEHOLDER_SECTIONS = frozenset(
+    {"no text detected"} | {f"{header.replace(' Analysis', '')} analysis not found".lower() for _, header in ANALYSIS_SECTIONS}
+)
+# Lines from overlapping tiles whose boxes overlap at least this much (intersection over union) and whose
+# text is the same, or contained in the other's, are one line seen twice
+_DUPLICATE_IOU = 0.5
+
+
+def format_tile_note(index: int, count: int, box: Box, image_size: Tuple[int, int]) -> str:
+    """Tells the model which region of the whole image a tile shows, and how to report positions in it."""
+    left, top, right, bottom = box
+    width, height = image_size
+    return (
+        f"\n\n**Tile {index} of {count}:** This image is one region of a larger {width}x{height} pixel image, "
+        f"covering pixels x {left}-{right}, y {top}-{bottom}. Neighbouring tiles overlap it slightly, and the whole "
+        "image is summarised separately, so keep the Metadata, Semantic and Content & Styling sections brief and "
+        "about this tile only. In the Layout and OCR sections, end every element, text line and text container "
+        "with its bounding box `[ymin, xmin, ymax, xmax]`, normalized to 0-1000 over this tile image. Transcribe "
+        "text cut off at the tile's edge only as far as it is visible."
+    )
+
+
+def _map_box(match: re.Match, box: Box, image_size: Tuple[int, int]) -> Optional[Tuple[int, int, int, int]]:
+    values = [float(value) for value in match.groups()]
+    if any(value > 1000 for value in values):
+        return None # Not a normalized box
+    ymin, xmin, ymax, xmax = values
+    left, top, right, bottom = box
+    width, height = image_size
+    return (round((top + ymin / 1000 * (bottom - top)) / height * 1000),
+            round((left + xmin / 1000 * (right - left)) / width * 1000),
+            round((top + ymax / 1000 * (bottom - top)) / height * 1000),
+            round((left + xmax / 1000 * (right - left)) / width * 1000))
+
+
+def map_tile_boxes(text: str, box: Box, image_size: Tuple[int, int]) -> Tuple[str, List[Tuple[int, int, int, int]]]:
+    """Rewrites the tile-relative boxes in `text` as boxes over the whole image.
+
+    Returns:
+        The rewritten text and the mapped boxes, in order.
+    """
+    mapped: List[Tuple[int, int, int, int]] = []
+
+    def replace(match: re.Match) -> str:
+        global_box = _map_box(match, box, image_size)
+        if global_box is None:
+            return match.group(0)
+        mapped.append(global_box)
+        return "[" + ", ".join(str(value) for value in global_box) + "]"
+
+    return _BOX_RE.sub(replace, text), mapped
+
+
+def _iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    height = min(a[2], b[2]) - max(a[0], b[0])
+    width = min(a[3], b[3]) - max(a[1], b[1])
+    if height <= 0 or width <= 0:
+        return 0.0
+    intersection = height * width
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def _line_key(line: str) -> str:
+    return re.sub(r"\W+", " ", _BOX_RE.sub("", line)).strip().lower()
+
+
+def _is_placeholder(text: str) -> bool:
+    return not text.strip() or text.strip().rstrip(".").lower() in _PLACEHOLDER_SECTIONS
+
+
+def merge_tile_sections(overview: Dict[str, str], tiles: List[Tuple[Box, Optional[Dict[str, str]]]],
+                        image_size: Tuple[int, int]) -> Dict[str, str]:
+    """Merges an overview analysis of the whole image with the analyses of its tiles into one set of sections.
+
+    Metadata, semantic and styling come from the overview. The layout is the overview's, followed by each
+    tile's as a region; the OCR text is the tiles', in tile (reading) order. Boxes are mapped onto the whole
+    image and lines seen twice in overlapping tiles are kept once (the longer, if one was cut off).
+
+    Args:
+        overview: Sections from the analysis of the whole (downscaled) image.
+        tiles: Each tile's box in the original image and its sections, or None if its analysis failed.
+        image_size: The original image's (width, height).
+    """
+    region_layouts: List[str] = []
+    region_texts: List[Tuple[str, List[str]]] = []
+    seen: List[Tuple[str, Tuple[int, int, int, int], List[str], int]] = [] # key, box, region lines, index
+    for number, (box, sections) in enumerate(tiles, 1):
+        left, top, right, bottom = box
+        label = f"Region {number} (x {left}-{right}, y {top}-{bottom} px)"
+        if sections is None:
+            region_layouts.append(f"{label}: not analysed (the tile's model call failed).")
+            region_texts.append((label, ["Not analysed (the tile's model call failed)."]))
+            continue
+        if not _is_placeholder(sections["layout"]):
+            region_layouts.append(f"{label}:\n{map_tile_boxes(sections['layout'], box, image_size)[0]}")
+        if _is_placeholder(sections["ocr"]):
+            continue
+        lines: List[str] = []
+        for line in sections["ocr"].splitlines():
+            line, boxes = map_tile_boxes(line, box, image_size)
+            key = _line_key(line)
+            duplicate = False
+            if boxes and len(key) >= 3:
+                for i, (seen_key, seen_box, seen_lines, seen_index) in enumerate(seen):
+                    if _iou(boxes[0], seen_box) < _DUPLICATE_IOU or not (key in seen_key or seen_key in key):
+                        continue
+                    duplicate = True
+                    if len(key) > len(seen_key): # The earlier tile cut the line off; keep this one in its place
+                        seen_lines[seen_index] = line
+                        seen[i] = (key, boxes[0], seen_lines, seen_index)
+                    break
+                if not duplicate:
+                    seen.append((key, boxes[0], lines, len(lines)))
+            if not duplicate:
+                lines.append(line)
+        if any(line.strip() for line in lines):
+            region_texts.append((label, lines))
+
+    rows = len({box[1] for box, _ in tiles})
+    columns = len(tiles) // rows if rows else 0
+    merged = dict(overview)
+    merged["metadata"] = (
+        f"{overview['metadata'].rstrip()}\n- Analysed as {len(tiles)} overlapping tiles ({columns}x{rows}); "
+        "positions in the Layout and OCR sections are [ymin, xmin, ymax, xmax] boxes normalized to 0-1000 "
+        "over the whole image."
+    )
+    if region_layouts:
+        merged["layout"] = f"{overview['layout'].rstrip()}\n\n" + "\n\n".join(region_layouts)
+    ocr_text = "\n\n".join(f"{label}:\n" + "\n".join(lines).strip("\n") for label, lines in region_texts)
+    merged["ocr"] = ocr_text or "No text detected."
+    return merged
+
+# --- Token budgets ---
+
+T = TypeVar("T")
+
+_TRIMMED_MARKER = " … [trimmed]"
+# Extra trim on retries, when a first cut of exactly the overshoot wasn't enough
+_TRIM_MARGIN = 1.1
+_MAX_TRIM_PASSES = 3
+
+
+def _image_tokens(image: Union[Image, Dict[str, Any]]) -> int:
+    try:
+        if isinstance(image, dict):
+            with PILImage.open(BytesIO(image["data"])) as opened: # Reads only the header
+                width, height = opened.size
+        else:
+            width, height = image.size
+    except Exception:
+        return IMAGE_TILE_TOKENS
+    return IMAGE_TILE_TOKENS * math.ceil(width / _IMAGE_TILE_EDGE) * math.ceil(height / _IMAGE_TILE_EDGE)
+
+
+def estimate_tokens(contents: Any) -> int:
+    """Estimates the input tokens of a prompt string or parts list locally, without an API call."""
+    parts = contents if isinstance(contents, list) else [contents]
+    return sum(
+        math.ceil(len(part) / CHARS_PER_TOKEN) if isinstance(part, str) else _image_tokens(part)
+        for part in parts
+    )
+
+
+def trim_text(text: str, excess_tokens: int, label: str = "prompt") -> Tuple[str, List[str]]:
+    """Cuts `excess_tokens` worth of characters off the end of a free-text input."""
+    keep = max(0, len(text) - excess_tokens * CHARS_PER_TOKEN)
+    warning = f"The {label} was trimmed from {len(text)} to {keep} characters to fit the prompt token budget."
+    return text[:keep] + _TRIMMED_MARKER, [warning]
+
+
+def trim_analysis_data(analysis_data: Dict[str, str], excess_tokens: int) -> Tuple[Dict[str, str], List[str]]:
+    """Shortens the longest analysis sections to a common length so the total drops by `excess_tokens`."""
+    lengths = sorted(len(value) for value in analysis_data.values() if isinstance(value, str))
+    remaining = max(0, sum(lengths) - excess_tokens * CHARS_PER_TOKEN)
+    # Water-filling: sections shorter than an equal share stay whole, the rest are cut to the cap
+    cap = None
+    for i, length in enumerate(lengths):
+        share = remaining // (len(lengths) - i)
+        if length > share:
+            cap = share
+            break
+        remaining -= length
+    if cap is None:
+        return analysis_data, []
+
+    trimmed = dict(analysis_data)
+    names = []
+    for key, value in analysis_data.items():
+        if isinstance(value, str) and len(value) > cap:
+            trimmed[key] = value[:cap] + _TRIMMED_MARKER
+            names.append(key)
+    warning = (f"analysis_data was trimmed to fit the prompt token budget: "
+               f"{', '.join(names)} cut to {cap} characters each.")
+    return trimmed, [warning]
+
+
+def trim_svg_code(svg_code: str, excess_tokens: int) -> Tuple[str, List[str]]:
+    """Shrinks SVG code by `excess_tokens`: first by rounding coordinates harder, then by truncating at a tag boundary."""
+    target = max(0, len(svg_code) - excess_tokens * CHARS_PER_TOKEN)
+    compact, _ = svg_utils.optimize_svg(svg_code, precision=1)
+    if len(compact) <= target:
+        return compact, [f"The SVG code was compacted from {len(svg_code)} to {len(compact)} characters "
+                         f"(coordinates rounded to 1 decimal) to fit the prompt token budget."]
+    cut = compact.rfind(">", 0, target) + 1
+    truncated = compact[:cut] + "\n<!-- truncated to fit the prompt token budget; the rendered PNG shows the full drawing -->"
+    return truncated, [f"The SVG code was truncated from {len(svg_code)} to {cut} characters to fit the prompt "
+                       f"token budget; the model only saw the beginning of it."]
+
+
+def _measure(prompt: Any, budget: int, count_tokens: Optional[Callable[[Any], int]],
+             force_count: bool = False) -> Tuple[int, int, bool]:
+    """Returns the prompt's tokens (counted if near the budget, else estimated), the local estimate, and whether it was counted."""
+    estimate = estimate_tokens(prompt)
+    if count_tokens is not None and (force_count or estimate >= budget * PROMPT_COUNT_RATIO):
+        try:
+            with span("token_count"):
+                return count_tokens(prompt), estimate, True
+        except Exception as e:
+            logger.warning("Token counting failed, using the local estimate: %s", e)
+    return estimate, estimate, False
+
+
+def fit_prompt(build: Callable[[T], Any], value: T, trim: Callable[[T, int], Tuple[T, List[str]]], budget: int,
+               count_tokens: Optional[Callable[[Any], int]] = None) -> Tuple[Any, Dict[str, Any]]:
+    """Builds a prompt from `value`, trimming `value` until the prompt fits in `budget` input tokens.
+
+    Tokens are estimated locally; `count_tokens` (an SDK call) is only used once the estimate
+    comes within PROMPT_COUNT_RATIO of the budget.
+
+    Args:
+        build: Builds the prompt from the (possibly trimmed) value.
+        value: The oversizable request input, e.g. the SVG code for a refinement.
+        trim: Returns the value shortened by a number of tokens, and warnings describing the cut.
+        budget: Maximum input tokens for the prompt.
+        count_tokens: Counts a prompt's tokens exactly, e.g. with the target model.
+
+    Returns:
+        The prompt and an info dict with `budget`, `prompt_tokens`, `counted` and `warnings`.
+    """
+    with span("prompt_build"):
+        prompt = build(value)
+        tokens, estimate, counted = _measure(prompt, budget, count_tokens)
+        warnings: List[str] = []
+        excess = 0
+        for _ in range(_MAX_TRIM_PASSES):
+            if tokens <= budget:
+                break
+            # Trims work in estimated tokens; scale a counted overshoot by how dense the text really is
+            overshoot = math.ceil((tokens - budget) * estimate / tokens)
+            excess += math.ceil(overshoot * _TRIM_MARGIN) if excess else overshoot
+            # Always trim the original value, so the warnings describe the full cut
+            trimmed, warnings = trim(value, excess)
+            prompt = build(trimmed)
+            # Once counted, keep counting: the estimate already proved off for this prompt
+            tokens, estimate, counted = _measure(prompt, budget, count_tokens, force_count=counted)
+    return prompt, {"budget": budget, "prompt_tokens": tokens, "counted": counted, "warnings": warnings}
@@ -0,0 +1,104 @@
+"""Server-side SVG rasterization for the /refine_svg self-critique step.
+
+Renders SVG to PNG without a browser, so headless/API clients can use the
+self-critique path and browsers don't have to upload a multi-megabyte PNG with
+every refine request. Rendering uses `resvg_py` (self-contained native wheel,
+no system libraries) and falls back to `cairosvg` (needs libcairo). Both are
+optional; when neither is installed `is_available()` is False and refinement
+relies on a client-supplied PNG as before.
+
+Rendered PNGs are cached by (SVG hash, size), so repeated refinement rounds on
+the same SVG don't re-render.
+
+Configuration (env vars):
+    RASTER_SIZE: Default long edge of rendered PNGs in pixels (default 1000).
+    RASTER_MAX_SIZE: Largest long edge a request may ask for (default 2048).
+"""
+import os
+import re
+from typing import Optional, Tuple
+
+import cache_utils
+
+try:
+    import resvg_py
+except ImportError:
+    resvg_py = None
+
+try:
+    import cairosvg
+except (ImportError, OSError): # OSError: package installed but libcairo missing
+    cairosvg = None
+
+RASTER_SIZE = int(os.getenv("RASTER_SIZE", "1000"))
+RASTER_MAX_SIZE = int(os.getenv("RASTER_MAX_SIZE", "2048"))
+
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_ROOT_TAG_RE = re.compile(r"<svg\b[^>]*>", re.IGNORECASE)
+_VIEWBOX_RE = re.compile(rf"\bviewBox\s*=\s*[\"']\s*{_NUMBER}[\s,]+{_NUMBER}[\s,]+({_NUMBER})[\s,]+({_NUMBER})", re.IGNORECASE)
+_WIDTH_RE = re.compile(rf"\bwidth\s*=\s*[\"']\s*({_NUMBER})(?:px)?\s*[\"']")
+_HEIGHT_RE = re.compile(rf"\bheight\s*=\s*[\"']\s*({_NUMBER})(?:px)?\s*[\"']")
+
+_png_cache = cache_utils.ResponseCache("raster", max_entries=cache_utils.IMAGE_CACHE_SIZE)
+
+
+class RasterizeError(ValueError):
+    """Raised when an SVG cannot be rendered (no renderer installed, or invalid SVG)."""
+
+
+def is_available() -> bool:
+    """Whether a server-side renderer is installed."""
+    return resvg_py is not None or cairosvg is not None
+
+
+def _intrinsic_size(svg_code: str) -> Tuple[float, float]:
+    """Reads the root element's width/height (or viewBox) to get the aspect ratio; defaults to 300x150 like browsers."""
+    root = _ROOT_TAG_RE.search(svg_code)
+    tag = root.group(0) if root else ""
+    width = _WIDTH_RE.search(tag)
+    height = _HEIGHT_RE.search(tag)
+    if width and height:
+        return float(width.group(1)), float(height.group(1))
+    view_box = _VIEWBOX_RE.search(tag)
+    if view_box:
+        return float(view_box.group(1)), float(view_box.group(2))
+    return 300.0, 150.0
+
+
+def render_png(svg_code: str, size: Optional[int] = None) -> bytes:
+    """Renders SVG code to PNG bytes with the given long edge, using the cache when possible.
+
+    Args:
+        svg_code: The SVG document to render.
+        size: Long edge of the output in pixels; defaults to RASTER_SIZE and is clamped to RASTER_MAX_SIZE.
+
+    Raises:
+        RasterizeError: If no renderer is installed or the SVG cannot be rendered.
+    """
+    if not is_available():
+        raise RasterizeError("No server-side SVG renderer is installed (install resvg-py or cairosvg).")
+
+    size = max(16, min(int(size or RASTER_SIZE), RASTER_MAX_SIZE))
+    key = cache_utils.make_key(svg_code, size)
+    cached = _png_cache.get(key)
+    if cached is not None:
+        return cached
+
+    width, height = _intrinsic_size(svg_code)
+    if width <= 0 or height <= 0:
+        width, height = 300.0, 150.0
+    if width >= height:
+        out_width, out_height = size, max(1, round(size * height / width))
+    else:
+        out_width, out_height = max(1, round(size * width / height)), size
+
+    try:
+        if resvg_py is not None:
+            png = bytes(resvg_py.svg_to_bytes(svg_string=svg_code, width=out_width, height=out_height))
+        else:
+            png = cairosvg.svg2png(bytestring=svg_code.encode("utf-8"), output_width=out_width, output_height=out_height)
+    except Exception as e:
+        raise RasterizeError(f"Failed to render SVG: {e}")
+
+    _png_cache.set(key, png)
+    return png
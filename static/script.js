@@ -71,6 +71,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Store image data temporarily
     let currentImageDataUrl = null;
+    let currentImageFile = null; // The selected File, uploaded as binary multipart instead of a base64 data URL
+    let currentImageId = null; // Server-side ID of the analyzed image, lets /convert_to_svg skip the re-upload
 
     let debounceTimer;
     const MAX_HISTORY_ITEMS = 15; // Limit the number of history items
@@ -229,6 +231,97 @@ document.addEventListener('DOMContentLoaded', () => {
         return 3; // Default if none selected (shouldn't happen with default active)
     }
 
+    // Draw whatever complete elements a partially streamed SVG already contains
+    function previewPartialSvg(partialCode) {
+        const start = partialCode.search(/<svg[\s>]/i);
+        const lastTagEnd = partialCode.lastIndexOf('>');
+        if (start === -1 || lastTagEnd <= start) {
+            return;
+        }
+        let candidate = partialCode.substring(start, lastTagEnd + 1);
+        if (!/<\/svg>\s*$/i.test(candidate)) {
+            candidate += '</svg>'; // Temporarily close the root so the browser can render it
+        }
+        const doc = new DOMParser().parseFromString(candidate, "image/svg+xml");
+        const svgElement = doc.querySelector('svg');
+        if (!doc.querySelector('parsererror') && svgElement) {
+            // Only replace the preview when the partial document parses (e.g. no half-open <g>)
+            svgPreview.innerHTML = '';
+            svgPreview.appendChild(svgElement);
+        }
+    }
+
+    // POST a JSON body (or FormData for binary uploads) to an SVG endpoint in streaming mode (Server-Sent Events).
+    // Calls onPartial(accumulatedText) for every chunk and resolves with the final cleaned SVG.
+    async function fetchSvgStream(url, payload, onPartial, errorPrefix) {
+        const isForm = payload instanceof FormData;
+        const headers = { 'Accept': 'text/event-stream' };
+        if (!isForm) headers['Content-Type'] = 'application/json'; // Browser sets the multipart boundary itself
+        const response = await fetch(url + '?stream=1', {
+            method: 'POST',
+            headers: headers,
+            body: isForm ? payload : JSON.stringify(payload),
+        });
+
+        const contentType = response.headers.get('content-type') || '';
+        if (!response.ok || !contentType.includes('text/event-stream')) {
+            let errorMsg = `${errorPrefix} (status ${response.status})`;
+            try {
+                if (contentType.includes('application/json')) {
+                    const errorData = await response.json();
+                    errorMsg = `${errorPrefix}: ${errorData.error || JSON.stringify(errorData)}`;
+                } else {
+                    const errorText = await response.text();
+                    console.error(`Non-JSON error response from ${url}:`, errorText);
+                    errorMsg = `${errorPrefix}: Server returned an unexpected response (status ${response.status}). Check console for details.`;
+                }
+            } catch (parseError) {
+                console.error(`Error processing the error response from ${url}:`, parseError);
+                errorMsg = `${errorPrefix}: Could not process error response (status ${response.status}).`;
+            }
+            const error = new Error(errorMsg);
+            error.status = response.status;
+            throw error;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let accumulated = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // SSE events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.substring(0, boundary);
+                buffer = buffer.substring(boundary + 2);
+
+                let eventName = 'message';
+                let dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.substring(6).trim();
+                    else if (line.startsWith('data:')) dataLines.push(line.substring(5).trim());
+                });
+                if (dataLines.length === 0) continue;
+                const eventData = JSON.parse(dataLines.join('\n'));
+
+                if (eventName === 'chunk') {
+                    accumulated += eventData.text;
+                    if (onPartial) onPartial(accumulated);
+                } else if (eventName === 'done') {
+                    return eventData.svg_code;
+                } else if (eventName === 'error') {
+                    throw new Error(`${errorPrefix}: ${eventData.error}`);
+                }
+            }
+        }
+        throw new Error(`${errorPrefix}: Stream ended before the SVG was complete.`);
+    }
+
     // Function to handle generation request
     async function handleGenerate() {
         const currentPrompt = promptInput.value.trim();
@@ -246,46 +339,21 @@ document.addEventListener('DOMContentLoaded', () => {
         updatePreview('');
 
         try {
-            const response = await fetch('/generate', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    prompt: currentPrompt,
-                    complexity: complexity,
-                    colorUsage: colorUsage,
-                    model: selectedModel
-                }),
-            });
-
-            if (!response.ok) {
-                let errorMsg = `Generation failed (status ${response.status})`;
-                try {
-                    const contentType = response.headers.get('content-type');
-                    if (contentType && contentType.includes('application/json')) {
-                        const errorData = await response.json();
-                        errorMsg = `Generation failed: ${errorData.error || JSON.stringify(errorData)}`;
-                    } else {
-                        const errorText = await response.text();
-                        console.error("Non-JSON error response from /generate:", errorText);
-                        errorMsg = `Generation failed: Server returned an unexpected response (status ${response.status}). Check console for details.`;
-                    }
-                } catch (parseError) {
-                    console.error("Error processing the error response from /generate:", parseError);
-                    errorMsg = `Generation failed: Could not process error response (status ${response.status}).`;
-                }
-                throw new Error(errorMsg); // Throw specific error
-            }
-
-            // If response.ok, it should be JSON
-            const data = await response.json();
-
-            if (data.svg_code) {
-                svgCodeEditor.value = data.svg_code;
-                updatePreview(data.svg_code);
+            const svgCode = await fetchSvgStream('/generate', {
+                prompt: currentPrompt,
+                complexity: complexity,
+                colorUsage: colorUsage,
+                model: selectedModel
+            }, (partial) => {
+                svgCodeEditor.value = partial;
+                previewPartialSvg(partial);
+            }, 'Generation failed');
+
+            if (svgCode) {
+                svgCodeEditor.value = svgCode;
+                updatePreview(svgCode);
                 _update_generation_ui(false, 'SVG generated successfully!');
-                saveHistoryItem(currentPrompt, complexity, colorUsage, selectedModel, data.svg_code);
+                saveHistoryItem(currentPrompt, complexity, colorUsage, selectedModel, svgCode);
             } else {
                 // Handle defensively
                 _update_generation_ui(false, 'Generation completed, but no SVG code received.', true);
@@ -619,6 +687,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 imagePreviewContainer.style.display = 'block';
                 // Store base64 data URL when image is loaded
                 currentImageDataUrl = e.target.result;
+                currentImageFile = file;
+                currentImageId = null;
                 // Hide analysis results when new image is loaded
                 if (analysisResultsSection) analysisResultsSection.style.display = 'none';
                 // Clear previous analysis status
@@ -766,14 +836,14 @@ document.addEventListener('DOMContentLoaded', () => {
             // --- End Immediate UI Creation ---
 
             try {
+                // Upload the file as binary multipart rather than a ~33% larger base64 string in JSON
+                const formData = new FormData();
+                formData.append('image_data', currentImageFile);
+                formData.append('context_prompt', contextPrompt);
+                formData.append('model', selectedModel); // Send extractor's selected model
                 const response = await fetch('/analyze_image', {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json', },
-                    body: JSON.stringify({
-                        image_data: currentImageDataUrl, 
-                        context_prompt: contextPrompt,
-                        model: selectedModel // Send extractor's selected model
-                    })
+                    body: formData
                 });
 
                 if (!response.ok) {
@@ -796,6 +866,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
 
                 const data = await response.json();
+                currentImageId = data.image_id || null;
                 console.log("--- Data Received by Frontend ---"); // Keep logs for now
                 console.log(data);
                 console.log("--------------------------------");
@@ -858,6 +929,15 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // Multipart body carrying the selected image file plus the analysis for /convert_to_svg
+    function buildImageForm(analysisData, selectedModel) {
+        const formData = new FormData();
+        formData.append('image_data', currentImageFile);
+        formData.append('analysis_data', JSON.stringify(analysisData));
+        formData.append('model', selectedModel);
+        return formData;
+    }
+
     // --- Recreate SVG Button Listener (Renamed) ---
     async function handleRecreateSvg() {
         if (!currentImageDataUrl) {
@@ -882,56 +962,35 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         try {
-            const response = await fetch('/convert_to_svg', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    image_data: currentImageDataUrl,
+            const onPartial = (partial) => {
+                svgCodeEditor.value = partial;
+                previewPartialSvg(partial);
+            };
+            let generatedSvgCode;
+            try {
+                // Refer to the already-uploaded image by ID; send the (possibly edited) analysis text
+                generatedSvgCode = await fetchSvgStream('/convert_to_svg', currentImageId ? {
+                    image_id: currentImageId,
                     analysis_data: analysisData,
                     model: selectedModel
-                }),
-            });
-
-            if (!response.ok) {
-                let errorMsg = `SVG recreation failed (status ${response.status})`;
-                try {
-                    const contentType = response.headers.get('content-type');
-                    if (contentType && contentType.includes('application/json')) {
-                        const errorData = await response.json();
-                        errorMsg = `SVG recreation failed: ${errorData.error || JSON.stringify(errorData)}`;
-                    } else {
-                        const errorText = await response.text();
-                        console.error("Non-JSON error response from /convert_to_svg:", errorText);
-                        errorMsg = `SVG recreation failed: Server returned an unexpected response (status ${response.status}). Check console for details.`;
-                    }
-                } catch (parseError) {
-                    console.error("Error processing the error response from /convert_to_svg:", parseError);
-                    errorMsg = `SVG recreation failed: Could not process error response (status ${response.status}).`;
-                }
-                throw new Error(errorMsg);
+                } : buildImageForm(analysisData, selectedModel), onPartial, 'SVG recreation failed');
+            } catch (error) {
+                if (error.status !== 404 || !currentImageId) throw error;
+                // The server no longer has the image (expired or another instance); upload it again
+                currentImageId = null;
+                generatedSvgCode = await fetchSvgStream('/convert_to_svg', buildImageForm(analysisData, selectedModel), onPartial, 'SVG recreation failed');
             }
 
-            const data = await response.json();
-
-            if (response.ok) {
-                // ... (Success handling: update editor/preview, clear prompt, show success) ...
-                const generatedSvgCode = data.svg_code;
-                svgCodeEditor.value = generatedSvgCode;
-                updatePreview(generatedSvgCode);
-                if (recreateStatusDisplay) {
-                     recreateStatusDisplay.textContent = 'Recreation successful!';
-                     recreateStatusDisplay.className = 'status';
-                     recreateStatusDisplay.style.color = 'green';
-                }
-                // TODO: Save extractor result to history
-                // saveHistoryItemExtractor(...) 
-                // updateHistoryList();
-
-            } else {
-                throw new Error(data.error || 'Unknown recreation error');
+            svgCodeEditor.value = generatedSvgCode;
+            updatePreview(generatedSvgCode);
+            if (recreateStatusDisplay) {
+                 recreateStatusDisplay.textContent = 'Recreation successful!';
+                 recreateStatusDisplay.className = 'status';
+                 recreateStatusDisplay.style.color = 'green';
             }
+            // TODO: Save extractor result to history
+            // saveHistoryItemExtractor(...) 
+            // updateHistoryList();
 
         } catch (error) {
             console.error("Recreation Error:", error);
@@ -954,8 +1013,8 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    // --- Helper: Generate High-Res PNG Data URL from SVG Preview ---
-    function generatePngFromSvgPreview(minDimension = 1000) {
+    // --- Helper: Generate High-Res PNG (data URL, or Blob when asBlob is set) from SVG Preview ---
+    function generatePngFromSvgPreview(minDimension = 1000, asBlob = false) {
         return new Promise((resolve, reject) => {
             const svgPreviewDiv = document.getElementById('svg-preview');
             const svgElement = svgPreviewDiv.querySelector('svg');
@@ -1000,6 +1059,14 @@ document.addEventListener('DOMContentLoaded', () => {
 
             img.onload = () => {
                 ctx.drawImage(img, 0, 0, canvasWidth, canvasHeight);
+                if (asBlob) {
+                    canvas.toBlob((blob) => {
+                        URL.revokeObjectURL(url);
+                        if (blob) resolve(blob);
+                        else reject(new Error("Error converting canvas to PNG."));
+                    }, 'image/png');
+                    return;
+                }
                 try {
                     const pngUrl = canvas.toDataURL('image/png');
                     URL.revokeObjectURL(url);
@@ -1019,6 +1086,9 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // The server renders the SVG for self-critique itself when it has a renderer installed
+    const serverRenderAvailable = document.body.dataset.serverRender === 'true';
+
     // --- Update Refine SVG Button Listener ---
     async function handleRefineSvg() {
         const refinementPrompt = refinementPromptInput.value.trim();
@@ -1044,68 +1114,44 @@ document.addEventListener('DOMContentLoaded', () => {
         refineStatus.style.color = '';
         refineSpinner.classList.add('visible'); // Show spinner initially for PNG gen
 
-        let pngDataUrl = null;
+        let pngBlob = null;
         try {
-            // --- Generate PNG --- 
-            pngDataUrl = await generatePngFromSvgPreview(1000); // Default to 1000px min
+            // --- Generate PNG (skipped when the server renders the SVG itself) --- 
+            if (!serverRenderAvailable) {
+                pngBlob = await generatePngFromSvgPreview(1000, true); // Default to 1000px min, as binary
+            }
 
             refineStatus.textContent = 'Refining SVG with analysis...'; // Update status (spinner stays visible)
 
-            // --- Fetch Call --- 
-            const response = await fetch('/refine_svg', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json', },
-                body: JSON.stringify({
-                    original_svg: currentSvg,
-                    refinement_prompt: refinementPrompt,
-                    model: selectedModel,
-                    png_data: pngDataUrl // Include the generated PNG data URL
-                })
-            });
-
-            if (!response.ok) {
-                let errorMsg = `Refinement failed (status ${response.status})`;
-                try {
-                    const contentType = response.headers.get('content-type');
-                    if (contentType && contentType.includes('application/json')) {
-                        const errorData = await response.json();
-                        errorMsg = `Refinement failed: ${errorData.error || JSON.stringify(errorData)}`;
-                    } else {
-                        const errorText = await response.text();
-                        console.error("Non-JSON error response from /refine_svg:", errorText);
-                        errorMsg = `Refinement failed: Server returned an unexpected response (status ${response.status}). Check console for details.`;
-                    }
-                } catch (parseError) {
-                    console.error("Error processing the error response from /refine_svg:", parseError);
-                    errorMsg = `Refinement failed: Could not process error response (status ${response.status}).`;
-                }
-                throw new Error(errorMsg);
-            }
-
-            const data = await response.json();
-
-            if (response.ok) {
-                // ... (Success handling: update editor/preview, clear prompt, show success) ...
-                const refinedSvgCode = data.svg_code;
-                svgCodeEditor.value = refinedSvgCode;
-                updatePreview(refinedSvgCode);
-                refinementPromptInput.value = ''; // Clear refinement input
-                refineStatus.textContent = 'Refinement successful!';
-                refineStatus.className = 'status';
-                refineStatus.style.color = 'green';
-                // ... (Save to history) ...
-                const currentPrompt = promptInput.value.trim(); 
-                // FIX: Convert NodeList to Array before using .find()
-                const activeComplexityButton = Array.from(complexityButtons).find(btn => btn.classList.contains('active'));
-                const complexity = activeComplexityButton ? parseInt(activeComplexityButton.dataset.value, 10) : 3; // Default 3 if not found
-                // FIX: Convert NodeList to Array before using .find()
-                const activeColorUsageButton = Array.from(colorUsageButtons).find(btn => btn.classList.contains('active'));
-                const colorUsage = activeColorUsageButton ? parseInt(activeColorUsageButton.dataset.value, 10) : 3; // Default 3 if not found
-                saveHistoryItem(currentPrompt + ` (Refined${refinementPrompt ? ': ' + refinementPrompt.substring(0,20) + '...': ' - Auto'})`, complexity, colorUsage, selectedModel, refinedSvgCode);
-                updateHistoryList();
-            } else {
-                throw new Error(data.error || 'Unknown refinement error');
+            // --- Streamed Fetch Call --- 
+            const refineForm = new FormData();
+            refineForm.append('svg_code', currentSvg);
+            refineForm.append('refinement_prompt', refinementPrompt);
+            refineForm.append('model', selectedModel);
+            if (pngBlob) {
+                refineForm.append('png_data', pngBlob, 'preview.png'); // Include the generated PNG as a binary part
             }
+            const refinedSvgCode = await fetchSvgStream('/refine_svg', refineForm, (partial) => {
+                svgCodeEditor.value = partial;
+                previewPartialSvg(partial);
+            }, 'Refinement failed');
+
+            svgCodeEditor.value = refinedSvgCode;
+            updatePreview(refinedSvgCode);
+            refinementPromptInput.value = ''; // Clear refinement input
+            refineStatus.textContent = 'Refinement successful!';
+            refineStatus.className = 'status';
+            refineStatus.style.color = 'green';
+            // ... (Save to history) ...
+            const currentPrompt = promptInput.value.trim(); 
+            // FIX: Convert NodeList to Array before using .find()
+            const activeComplexityButton = Array.from(complexityButtons).find(btn => btn.classList.contains('active'));
+            const complexity = activeComplexityButton ? parseInt(activeComplexityButton.dataset.value, 10) : 3; // Default 3 if not found
+            // FIX: Convert NodeList to Array before using .find()
+            const activeColorUsageButton = Array.from(colorUsageButtons).find(btn => btn.classList.contains('active'));
+            const colorUsage = activeColorUsageButton ? parseInt(activeColorUsageButton.dataset.value, 10) : 3; // Default 3 if not found
+            saveHistoryItem(currentPrompt + ` (Refined${refinementPrompt ? ': ' + refinementPrompt.substring(0,20) + '...': ' - Auto'})`, complexity, colorUsage, selectedModel, refinedSvgCode);
+            updateHistoryList();
 
         } catch (error) {
             console.error("Refinement/PNG Error:", error);
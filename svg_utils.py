@@ -0,0 +1,641 @@
+"""Local SVG checks, post-processing and patch application that don't need a model call.
+
+Configuration (env vars):
+    SVG_OPTIMIZE: Optimizer mode for generated SVGs: "lossy" (default), "lossless" or "off".
+    SVG_PRECISION: Decimal places kept for coordinates in lossy mode (default 3).
+"""
+import json
+import math
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional, Tuple
+from xml.parsers import expat
+
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+SVG_OPTIMIZE = os.getenv("SVG_OPTIMIZE", "lossy").lower()
+SVG_PRECISION = int(os.getenv("SVG_PRECISION", "3"))
+
+# Serialize SVG elements without an `ns0:` prefix
+ET.register_namespace("", SVG_NAMESPACE)
+ET.register_namespace("xlink", XLINK_NAMESPACE)
+
+# Candidates beyond this many elements/bytes earn no extra credit / start losing points
+_ELEMENT_TARGET = 200
+_BYTE_BUDGET = 200_000
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+# --- Extraction ---
+
+# Case-insensitive, as before single-pass extraction: models occasionally write <SVG> in upper case
+_SVG_START_RE = re.compile(r"<svg[\s>/]", re.IGNORECASE)
+_SVG_TAG_RE = re.compile(r"<(/?)svg\b[^>]*?(/?)>", re.IGNORECASE)
+# How many `<svg` starts to try when the first ones don't yield an element (e.g. "<svg>" quoted in prose)
+_MAX_SVG_STARTS = 3
+
+
+class SvgExtractor:
+    """Extracts the outermost `<svg>` element from model output in a single pass, optionally chunk by chunk.
+
+    Text before the first `<svg` (prose, code fences) is skipped without being kept; from there the
+    output goes through expat, which tracks element depth, so nested `<svg>` elements and anything after
+    the closing tag (fences, explanations) are handled without rescanning. Output that isn't well-formed
+    XML falls back to balancing `<svg>`/`</svg>` tags, and the report says so. If no element closes, a
+    later `<svg` start is tried (a couple at most), for "<svg>" quoted in the prose before the code.
+
+    Usage:
+        extractor = SvgExtractor()
+        for chunk in chunks:
+            extractor.feed(chunk)
+            if extractor.complete:
+                break
+        svg_code, report = extractor.close()
+    """
+
+    def __init__(self, attempt: int = 1):
+        self._attempt = attempt
+        self.complete = False # The outermost <svg> has closed; further input is ignored
+        self._pending = "" # Unmatched tail of the text before the <svg> start
+        self._buffer = bytearray() # UTF-8 bytes from the <svg> start on
+        self._parser: Optional[Any] = None
+        self._depth = 0
+        self._end: Optional[int] = None
+        self.report: Dict[str, Any] = {
+            "found": False, "complete": False, "well_formed": False,
+            "has_xmlns": False, "has_viewbox": False, "errors": [],
+        }
+
+    def feed(self, text: str) -> None:
+        """Adds the next chunk of model output."""
+        if self.complete or not text:
+            return
+        if not self.report["found"]:
+            text = self._pending + text
+            match = _SVG_START_RE.search(text)
+            if not match:
+                self._pending = text[-4:] # Enough to catch a "<svg" split across chunks
+                return
+            self.report["found"] = True
+            self._pending = ""
+            self._parser = expat.ParserCreate("utf-8")
+            self._parser.StartElementHandler = self._start_element
+            self._parser.EndElementHandler = self._end_element
+            text = text[match.start():]
+
+        data = text.encode("utf-8")
+        self._buffer += data
+        if self._parser is None:
+            return # Not well-formed; close() balances tags instead
+        try:
+            self._parser.Parse(data, False)
+        except expat.ExpatError as e:
+            if self._end is None: # Errors after the closing tag (e.g. a trailing fence) don't matter
+                self.report["errors"].append(f"{expat.ErrorString(e.code)} (line {e.lineno}, column {e.offset})")
+                self._parser = None
+        self.complete = self._end is not None
+
+    def close(self) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Finishes extraction; returns the SVG code (None if no complete `<svg>` element was found) and the report."""
+        report = self.report
+        if self._end is None and report["errors"]:
+            self._balance_tags()
+        if self._end is None:
+            if not report["found"]:
+                report["errors"].append("No <svg> element found in the output.")
+                return None, report
+            if not report["errors"]:
+                report["errors"].append("Output ended before the outermost <svg> element was closed.")
+            return self._retry_from_next_start()
+        report["complete"] = True
+        report["well_formed"] = not report["errors"]
+        for key, attribute in (("has_xmlns", "xmlns"), ("has_viewbox", "viewBox")):
+            if not report[key]:
+                report.setdefault("warnings", []).append(f"Root <svg> has no {attribute} attribute.")
+        return self._buffer[:self._end].decode("utf-8"), report
+
+    def _retry_from_next_start(self) -> Tuple[Optional[str], Dict[str, Any]]:
+        text = self._buffer.decode("utf-8")
+        next_start = _SVG_START_RE.search(text, 1)
+        if next_start is None or self._attempt >= _MAX_SVG_STARTS:
+            return None, self.report
+        retry = SvgExtractor(self._attempt + 1)
+        retry.feed(text[next_start.start():])
+        svg_code, report = retry.close()
+        if svg_code is None:
+            return None, self.report
+        report.setdefault("warnings", []).insert(0, "Skipped an earlier '<svg' that did not start a complete element.")
+        return svg_code, report
+
+    def _start_element(self, name: str, attributes: Dict[str, str]) -> None:
+        if self._depth == 0:
+            self.report["has_xmlns"] = attributes.get("xmlns") == SVG_NAMESPACE
+            self.report["has_viewbox"] = "viewBox" in attributes
+        self._depth += 1
+
+    def _end_element(self, name: str) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._end is None:
+            index = self._parser.CurrentByteIndex
+            # At an end tag, the index is its start; for an empty element (`<svg .../>`), already past it
+            self._end = self._buffer.index(b">", index) + 1 if self._buffer[index:index + 2] == b"</" else index
+
+    def _balance_tags(self) -> None:
+        """Fallback for output that isn't well-formed XML: match `<svg>`/`</svg>` tags by nesting depth."""
+        text = self._buffer.decode("utf-8")
+        root = _SVG_TAG_RE.match(text)
+        if root:
+            self.report["has_xmlns"] = f'xmlns="{SVG_NAMESPACE}"' in root.group(0)
+            self.report["has_viewbox"] = "viewBox=" in root.group(0)
+        depth = 0
+        for match in _SVG_TAG_RE.finditer(text):
+            if match.group(1):
+                depth -= 1
+                if depth == 0:
+                    self._end = len(text[:match.end()].encode("utf-8"))
+                    return
+            elif not match.group(2):
+                depth += 1
+
+
+def extract_svg(text: str) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Extracts the outermost `<svg>` element from complete model output; see `SvgExtractor`."""
+    extractor = SvgExtractor()
+    extractor.feed(text)
+    return extractor.close()
+
+
+def score_svg(svg_code: str) -> Dict[str, Any]:
+    """Scores a cleaned SVG candidate so parallel generations can be compared quickly.
+
+    Well-formed XML with an `<svg>` root is required to be `valid`. Among valid
+    candidates, a viewBox, an xmlns declaration and more drawn elements (up to a
+    point) raise the score, while a large byte size lowers it.
+
+    Returns:
+        A dict with `valid`, `score` (None when invalid) and the individual checks.
+    """
+    report: Dict[str, Any] = {
+        "valid": False,
+        "score": None,
+        "well_formed": False,
+        "has_viewbox": False,
+        "has_xmlns": False,
+        "element_count": 0,
+        "bytes": len(svg_code.encode("utf-8")),
+    }
+    try:
+        root = ET.fromstring(svg_code)
+    except ET.ParseError as e:
+        report["error"] = str(e)
+        return report
+
+    report["well_formed"] = True
+    if _local_name(root.tag) != "svg":
+        report["error"] = "Root element is not <svg>."
+        return report
+
+    report["has_viewbox"] = root.get("viewBox") is not None
+    report["has_xmlns"] = root.tag.startswith("{" + SVG_NAMESPACE + "}")
+    report["element_count"] = sum(1 for _ in root.iter()) - 1
+    report["valid"] = True
+    report["score"] = round(
+        1.0
+        + 0.5 * report["has_viewbox"]
+        + 0.5 * report["has_xmlns"]
+        + min(report["element_count"], _ELEMENT_TARGET) / _ELEMENT_TARGET
+        - min(report["bytes"] / _BYTE_BUDGET, 1.0),
+        4,
+    )
+    return report
+
+
+# --- Optimizer ---
+
+_NUMBER_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_NUMBER_PARTS_RE = re.compile(r"([-+]?)(\d*)(?:\.(\d*))?([eE][-+]?\d+)?")
+_PATH_TOKEN_RE = re.compile(r"([MmZzLlHhVvCcSsQqTtAa])|" + _NUMBER_RE.pattern)
+_PATH_ARITY = {"m": 2, "z": 0, "l": 2, "h": 1, "v": 1, "c": 6, "s": 4, "q": 4, "t": 2, "a": 7}
+
+# Attributes holding coordinates/lengths whose numbers may be rounded
+_NUMERIC_ATTRIBUTES = frozenset({
+    "x", "y", "x1", "y1", "x2", "y2", "cx", "cy", "r", "rx", "ry", "fx", "fy", "dx", "dy",
+    "width", "height", "points", "stroke-width", "font-size",
+})
+# Transforms mix scale factors and angles with translations, so their numbers keep significant digits
+# rather than decimals: scale(0.0004) must not become scale(0)
+_TRANSFORM_ATTRIBUTES = frozenset({"transform", "gradientTransform", "patternTransform"})
+_TRANSFORM_SIGNIFICANT_DIGITS = 6
+# Presentation attributes that children inherit from a parent <g>
+_INHERITED_ATTRIBUTES = frozenset({
+    "fill", "fill-opacity", "fill-rule", "stroke", "stroke-width", "stroke-opacity", "stroke-linecap",
+    "stroke-linejoin", "stroke-miterlimit", "stroke-dasharray", "color", "font-family", "font-size",
+    "font-weight", "font-style", "text-anchor",
+})
+# Elements whose whitespace is content, and containers a <g> may be inserted into
+_TEXT_ELEMENTS = frozenset({"text", "tspan", "textPath", "style", "script", "title", "desc"})
+_GROUPING_PARENTS = frozenset({"svg", "g", "a"})
+_GROUPABLE_ELEMENTS = frozenset({
+    "g", "path", "rect", "circle", "ellipse", "line", "polyline", "polygon", "text", "use", "image",
+})
+# Hoisting a shared attribute into a new <g> only pays off from this many siblings
+_MIN_HOIST_RUN = 3
+
+
+def _format_number(token: str, precision: Optional[int]) -> str:
+    """Writes a number in its shortest form, rounded to `precision` decimals (None = exact)."""
+    if precision is not None:
+        token = f"{round(float(token), precision):.{precision}f}"
+    sign, whole, fraction, exponent = _NUMBER_PARTS_RE.fullmatch(token).groups()
+    whole = whole.lstrip("0")
+    fraction = (fraction or "").rstrip("0")
+    if not whole and not fraction:
+        return "0"
+    return ("-" if sign == "-" else "") + whole + ("." + fraction if fraction else "") + (exponent or "")
+
+
+def _round_numbers(value: str, precision: Optional[int]) -> str:
+    return _NUMBER_RE.sub(lambda m: _format_number(m.group(0), precision), value)
+
+
+def _round_significant(value: str, digits: Optional[int]) -> str:
+    """Like `_round_numbers`, but rounds to `digits` significant digits (None = exact)."""
+    if digits is None:
+        return _round_numbers(value, None)
+    return _NUMBER_RE.sub(lambda m: _format_number(f"{float(m.group(0)):.{digits}g}", None), value)
+
+
+def _compact_path(d: str, precision: Optional[int]) -> str:
+    """Rewrites path data with minimal separators and without repeated command letters.
+
+    Data that doesn't tokenize cleanly into commands with the right argument counts is returned unchanged.
+    """
+    if _PATH_TOKEN_RE.sub("", d).strip(" \t\r\n,"):
+        return d
+    commands: List[Tuple[str, List[str]]] = []
+    for match in _PATH_TOKEN_RE.finditer(d):
+        if match.group(1):
+            commands.append((match.group(1), []))
+        elif commands:
+            commands[-1][1].append(match.group(0))
+        else:
+            return d
+    for command, args in commands:
+        arity = _PATH_ARITY[command.lower()]
+        if (arity == 0 and args) or (arity and (not args or len(args) % arity)):
+            return d
+
+    out: List[str] = []
+    implicit = None # The command a bare number list continues with
+    last_number = None
+    for command, args in commands:
+        if command != implicit or command in "Zz":
+            out.append(command)
+            last_number = None
+        implicit = {"M": "L", "m": "l"}.get(command, command)
+        for arg in args:
+            number = _format_number(arg, precision)
+            # A separator is only needed where the next number would otherwise merge into the previous one
+            if last_number is not None and not (
+                number.startswith("-")
+                or (number.startswith(".") and "." in last_number and "e" not in last_number.lower())
+            ):
+                out.append(" ")
+            out.append(number)
+            last_number = number
+    return "".join(out)
+
+
+def _effective_precision(root: ET.Element, precision: int) -> int:
+    """Adds decimals for drawings in small coordinate systems (e.g. a 0-1 viewBox) so rounding stays invisible."""
+    extents = [float(n) for n in _NUMBER_RE.findall(root.get("viewBox", ""))[2:4]]
+    if not extents:
+        extents = [float(m.group(0)) for m in map(_NUMBER_RE.match, (root.get("width", ""), root.get("height", ""))) if m]
+    extent = max(extents, default=0.0)
+    if extent <= 0:
+        return precision
+    return precision + max(0, 2 - int(math.floor(math.log10(extent))))
+
+
+def _is_empty_shape(element: ET.Element, name: str) -> bool:
+    """Shapes the SVG spec says render nothing (zero size, no geometry)."""
+    def is_zero(attribute):
+        value = element.get(attribute)
+        match = _NUMBER_RE.fullmatch(value.strip()) if value is not None else None
+        return match is not None and float(match.group(0)) == 0
+    if name == "rect":
+        return is_zero("width") or is_zero("height")
+    if name == "circle":
+        return is_zero("r")
+    if name == "ellipse":
+        return is_zero("rx") or is_zero("ry")
+    if name == "path":
+        return not element.get("d", "").strip()
+    if name in ("polyline", "polygon"):
+        return not element.get("points", "").strip()
+    return False
+
+
+def _clean_tree(parent: ET.Element, precision: Optional[int], preserve_space: bool = False) -> None:
+    """Strips insignificant whitespace, compacts numbers and drops/unwraps no-op elements, depth first."""
+    preserve_space = (preserve_space or _local_name(parent.tag) in _TEXT_ELEMENTS
+                      or parent.get(_XML_SPACE) == "preserve")
+    if not preserve_space and parent.text and not parent.text.strip():
+        parent.text = None
+
+    for name, value in parent.attrib.items():
+        if name == "d":
+            parent.set(name, _compact_path(value, precision))
+        elif name in _NUMERIC_ATTRIBUTES:
+            parent.set(name, _round_numbers(value, precision))
+        elif name in _TRANSFORM_ATTRIBUTES:
+            parent.set(name, _round_significant(value, None if precision is None else _TRANSFORM_SIGNIFICANT_DIGITS))
+        elif name == "viewBox":
+            parent.set(name, _round_numbers(value, None))
+
+    # A <switch> renders its first matching child, so removing or unwrapping one changes what renders
+    keep_children = _local_name(parent.tag) == "switch"
+    children: List[ET.Element] = []
+    for child in list(parent):
+        _clean_tree(child, precision, preserve_space)
+        if preserve_space:
+            children.append(child)
+            continue
+        if child.tail and not child.tail.strip():
+            child.tail = None
+        if keep_children:
+            children.append(child)
+            continue
+        name = _local_name(child.tag)
+        if name == "metadata" or _is_empty_shape(child, name):
+            continue
+        if name in ("g", "defs") and len(child) == 0 and not (child.text or "").strip():
+            continue
+        if name == "g" and not child.attrib and not (child.text or "").strip():
+            children.extend(child) # A bare <g> has no effect; keep its children in its place
+            continue
+        children.append(child)
+    parent[:] = children
+
+
+def _hoist_attributes(parent: ET.Element) -> None:
+    """Moves inherited presentation attributes shared by runs of sibling elements onto a common <g>, depth first.
+
+    Elements with an `id` are left alone: a `<use>` of them inherits from the `<use>`, not from their parent.
+    """
+    for child in parent:
+        _hoist_attributes(child)
+    if _local_name(parent.tag) not in _GROUPING_PARENTS:
+        return
+
+    runs: List[List[ET.Element]] = [[]]
+    for child in parent:
+        if _local_name(child.tag) in _GROUPABLE_ELEMENTS and child.get("id") is None and not (child.tail or "").strip():
+            runs[-1].append(child)
+        elif runs[-1]:
+            runs.append([])
+
+    children = list(parent)
+    for run in runs:
+        if len(run) < 2:
+            continue
+        shared = {
+            name: value for name, value in run[0].attrib.items()
+            if name in _INHERITED_ATTRIBUTES and all(el.get(name) == value for el in run[1:])
+        }
+        if not shared:
+            continue
+        whole_group = len(run) == len(children) and _local_name(parent.tag) == "g"
+        if whole_group:
+            # Every child agrees: move it onto the group itself unless the group sets something else
+            shared = {name: value for name, value in shared.items() if parent.get(name) in (None, value)}
+            parent.attrib.update(shared)
+        elif len(run) >= _MIN_HOIST_RUN:
+            group = ET.Element(f"{{{SVG_NAMESPACE}}}g" if parent.tag.startswith("{") else "g", shared)
+            start = children.index(run[0])
+            children[start:start + len(run)] = [group]
+            group.extend(run)
+        else:
+            continue
+        for el in run:
+            for name in shared:
+                del el.attrib[name]
+    parent[:] = children
+
+
+def optimize_svg(svg_code: str, precision: Optional[int] = SVG_PRECISION,
+                 lossless: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """Shrinks a cleaned SVG without changing how it renders (beyond rounding, in lossy mode).
+
+    Comments, metadata and insignificant whitespace are dropped, zero-size shapes and empty or
+    attribute-less groups are removed, presentation attributes shared by sibling elements are
+    hoisted into a `<g>`, numbers are written in their shortest form and path data is compacted.
+    Lossy mode additionally rounds coordinates to `precision` decimals (more for small viewBoxes), and
+    transform parameters to 6 significant digits.
+    Hoisting is skipped when the document has a `<style>` element, since CSS selectors may depend
+    on the tree structure.
+
+    Args:
+        svg_code: A cleaned SVG document.
+        precision: Decimal places kept for coordinates in lossy mode.
+        lossless: Only apply changes that are exact (no rounding).
+
+    Returns:
+        The optimized SVG (or the input, if it doesn't parse or wouldn't get smaller) and a stats
+        dict with before/after byte counts.
+    """
+    started = time.perf_counter()
+    original_bytes = len(svg_code.encode("utf-8"))
+    stats: Dict[str, Any] = {"mode": "lossless" if lossless else "lossy", "original_bytes": original_bytes}
+    try:
+        root = ET.fromstring(svg_code)
+    except ET.ParseError as e:
+        stats.update({"optimized_bytes": original_bytes, "bytes_saved": 0, "skipped": f"Not well-formed XML: {e}"})
+        return svg_code, stats
+
+    if not lossless and precision is not None:
+        stats["precision"] = precision = _effective_precision(root, precision)
+    _clean_tree(root, None if lossless else precision)
+    if not any(_local_name(el.tag) == "style" for el in root.iter()):
+        _hoist_attributes(root)
+
+    # ElementTree escapes ">" in text and attribute values, so " />" only occurs at empty-element ends
+    optimized = ET.tostring(root, encoding="unicode").replace(" />", "/>")
+    optimized_bytes = len(optimized.encode("utf-8"))
+    if optimized_bytes >= original_bytes:
+        optimized, optimized_bytes = svg_code, original_bytes
+    stats.update({
+        "optimized_bytes": optimized_bytes,
+        "bytes_saved": original_bytes - optimized_bytes,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+    })
+    return optimized, stats
+
+
+# --- Patch-based editing ---
+#
+# For refinements the model is shown the SVG with an ID on every element (assigned in document order, so
+# the same source always gets the same IDs) and answers with edit operations instead of a new document.
+
+PATCH_ID_ATTRIBUTE = "data-eid"
+PATCH_INSERT_POSITIONS = ("before", "after", "prepend", "append")
+_ATTRIBUTE_NAME_RE = re.compile(r"(?:(xlink|xml):)?([A-Za-z_][\w.\-]*)")
+_ATTRIBUTE_PREFIXES = {"xlink": XLINK_NAMESPACE, "xml": "http://www.w3.org/XML/1998/namespace"}
+
+
+class PatchError(ValueError):
+    """Raised when an edit patch is malformed or doesn't apply to the document."""
+
+
+def _parse_document(svg_code: str) -> ET.Element:
+    try:
+        return ET.fromstring(svg_code)
+    except ET.ParseError as e:
+        raise PatchError(f"The SVG is not well-formed XML: {e}") from e
+
+
+def annotate_svg(svg_code: str) -> str:
+    """Returns the SVG with a `data-eid` attribute ("e0" for the root, then "e1", ... in document order)
+    on every element, for a patch prompt. Comments are dropped.
+
+    Raises:
+        PatchError: If the SVG isn't well-formed XML.
+    """
+    root = _parse_document(svg_code)
+    for index, element in enumerate(root.iter()):
+        # First, so the ID is the first thing the model reads in each tag
+        element.attrib = {PATCH_ID_ATTRIBUTE: f"e{index}", **element.attrib}
+    return ET.tostring(root, encoding="unicode").replace(" />", "/>")
+
+
+def parse_patch(text: str) -> List[Dict[str, Any]]:
+    """Parses a model's patch reply (`{"ops": [...]}` or a bare list) into its list of operations.
+
+    Raises:
+        PatchError: If the reply isn't a JSON list of operation objects.
+    """
+    text = text.strip()
+    if text.startswith("```"): # Tolerate a Markdown code fence around the JSON
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise PatchError(f"The patch is not valid JSON: {e}") from e
+    ops = data.get("ops") if isinstance(data, dict) else data
+    if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+        raise PatchError('The patch must be a JSON object with an "ops" list of operation objects.')
+    return ops
+
+
+def _qualified_attribute(name: Any) -> str:
+    match = _ATTRIBUTE_NAME_RE.fullmatch(name) if isinstance(name, str) else None
+    if not match or name == PATCH_ID_ATTRIBUTE:
+        raise PatchError(f"invalid attribute name {name!r}")
+    prefix, local = match.groups()
+    return f"{{{_ATTRIBUTE_PREFIXES[prefix]}}}{local}" if prefix else local
+
+
+def _parse_fragment(markup: Any, root: ET.Element) -> List[ET.Element]:
+    """Parses one or more SVG elements, in the document's namespace."""
+    if not isinstance(markup, str) or not markup.strip():
+        raise PatchError("missing 'svg' markup")
+    namespace = f' xmlns="{SVG_NAMESPACE}"' if root.tag.startswith(f"{{{SVG_NAMESPACE}}}") else ""
+    try:
+        wrapper = ET.fromstring(f'<svg{namespace} xmlns:xlink="{XLINK_NAMESPACE}">{markup}</svg>')
+    except ET.ParseError as e:
+        raise PatchError(f"the 'svg' markup is not well-formed: {e}") from e
+    for element in wrapper.iter():
+        element.attrib.pop(PATCH_ID_ATTRIBUTE, None) # Copied IDs would alias the original elements
+    elements = list(wrapper)
+    if not elements:
+        raise PatchError("the 'svg' markup contains no elements")
+    return elements
+
+
+def _apply_op(op: Dict[str, Any], root: ET.Element, elements: Dict[str, ET.Element],
+              parents: Dict[ET.Element, ET.Element]) -> None:
+    kind, eid = op.get("op"), op.get("id")
+    target = elements.get(eid) if isinstance(eid, str) else None
+    if target is None:
+        raise PatchError(f"unknown or removed element ID {eid!r}")
+    is_root = target is root
+
+    if kind == "set":
+        attributes = op.get("attributes")
+        if not isinstance(attributes, list) or not attributes:
+            raise PatchError("'set' needs a non-empty 'attributes' list")
+        for attribute in attributes:
+            if not isinstance(attribute, dict):
+                raise PatchError("each attribute must be an object with 'name' and 'value'")
+            name = _qualified_attribute(attribute.get("name"))
+            value = attribute.get("value")
+            if value is None or value == "":
+                target.attrib.pop(name, None)
+            else:
+                target.set(name, str(value))
+    elif kind == "text":
+        text = op.get("text")
+        if not isinstance(text, str):
+            raise PatchError("'text' needs a 'text' string")
+        target.text = text or None
+    elif kind in ("replace", "insert", "delete"):
+        position = op.get("position", "append") if kind == "insert" else None
+        if kind == "insert" and position not in PATCH_INSERT_POSITIONS:
+            raise PatchError(f"invalid insert position {position!r}")
+        if is_root and position not in ("prepend", "append"):
+            raise PatchError(f"the root element can't be used with '{kind}'" +
+                             (f" at position {position!r}" if position else ""))
+        new = _parse_fragment(op.get("svg"), root) if kind != "delete" else []
+        if position in ("prepend", "append"):
+            parent, index = target, 0 if position == "prepend" else len(target)
+        else:
+            parent = parents[target]
+            index = list(parent).index(target) + (position == "after")
+        if kind in ("replace", "delete"):
+            if new:
+                new[-1].tail = target.tail
+            parent.remove(target)
+            for removed in target.iter():
+                elements.pop(removed.get(PATCH_ID_ATTRIBUTE, ""), None)
+        for offset, element in enumerate(new):
+            parent.insert(index + offset, element)
+    else:
+        raise PatchError(f"unknown operation {kind!r}")
+
+
+def apply_patch(svg_code: str, ops: List[Dict[str, Any]]) -> str:
+    """Applies edit operations, addressed by the IDs `annotate_svg` gives `svg_code`, and returns the new SVG.
+
+    Operations (applied in order; elements they add can't be addressed by later ones):
+        {"op": "set", "id": ..., "attributes": [{"name": ..., "value": ...}]}: Set attributes;
+            an empty value removes the attribute.
+        {"op": "text", "id": ..., "text": ...}: Replace the element's text content.
+        {"op": "replace", "id": ..., "svg": ...}: Replace the element with new markup.
+        {"op": "insert", "id": ..., "position": ..., "svg": ...}: Insert markup "before" or "after"
+            the element, or as its first ("prepend") or last ("append") child.
+        {"op": "delete", "id": ...}: Remove the element.
+
+    Raises:
+        PatchError: If the SVG doesn't parse or any operation is invalid; nothing is applied then.
+    """
+    root = _parse_document(svg_code)
+    elements: Dict[str, ET.Element] = {}
+    for index, element in enumerate(root.iter()):
+        element.set(PATCH_ID_ATTRIBUTE, f"e{index}")
+        elements[f"e{index}"] = element
+    parents = {child: parent for parent in root.iter() for child in parent}
+    for number, op in enumerate(ops, 1):
+        try:
+            _apply_op(op, root, elements, parents)
+        except PatchError as e:
+            raise PatchError(f"Operation {number} ({op.get('op')!r} on {op.get('id')!r}): {e}") from e
+    for element in root.iter():
+        element.attrib.pop(PATCH_ID_ATTRIBUTE, None)
+    return ET.tostring(root, encoding="unicode").replace(" />", "/>")